@@ -2,12 +2,24 @@ from flask import Flask, request, jsonify
 import os
 import re
 import util
+import bot_sessions
 import whatsappservice
 from models import db, User, Session, Message, State, SessionContext, PolicyConsent
-from php_leads_service import create_or_update_php_lead
+import php_leads_service
 import config
+import conversation_flow
+import logs
+import metrics
+import request_deadline
+import serializers
+import sql_profiler
+import tracing
+import session_deadlines  # también registra el recálculo de next_deadline
+import session_health
+import outbound
+from serializers import json_response, format_datetime
 from datetime import datetime, timedelta, timezone
-import requests
+import time
 
 
 INACTIVITY_MINUTES = int(os.getenv("INACTIVITY_MINUTES", "10"))
@@ -15,9 +27,17 @@ WARNING_EXTRA_MINUTES = int(os.getenv("WARNING_EXTRA_MINUTES", "3"))
 IGNORE_SAVED_CONTACTS = os.getenv("IGNORE_SAVED_CONTACTS", "false").lower() == "true"
 CRM_API_TOKEN = os.getenv("CRM_API_TOKEN", "").strip()
 
+webhook_log = logs.get_logger("webhook")
+conversation_log = logs.get_logger("conversation")
+
 app = Flask(__name__)
 app.config.from_object(config)
 db.init_app(app)
+with app.app_context():
+    whatsappservice.use_shared_pace(db.engine)
+app.after_request(serializers.compress_response)
+metrics.init_app(app)
+sql_profiler.init_app(app)
 
 
 # ============================================================
@@ -62,18 +82,18 @@ def require_crm_token():
 
 
 def normalize_bot_session(session_name):
-    session_name = (session_name or os.getenv("WPPCONNECT_SESSION", "alestur_ventas")).strip()
-    return session_name or "alestur_ventas"
+    return bot_sessions.normalize(session_name)
 
 
-def save_policy_consent(session, accepted: bool):
+def save_policy_consent(session, accepted: bool, commit=True):
     consent = PolicyConsent(
         user_id=session.user_id,
         session_id=session.id,
         accepted=accepted
     )
     db.session.add(consent)
-    db.session.commit()
+    if commit:
+        db.session.commit()
     return consent
 
 
@@ -126,7 +146,7 @@ def get_active_session(user):
     )
 
 
-def close_session(session, reason=None):
+def close_session(session, reason=None, commit=True):
     if not session or not session.is_active:
         return
 
@@ -153,10 +173,11 @@ def close_session(session, reason=None):
         ctx.context_value = reason
         ctx.updated_at = now
 
-    db.session.commit()
+    if commit:
+        db.session.commit()
 
 
-def log_message(session, direction, text, message_type="text", update_last_message=None):
+def log_message(session, direction, text, message_type="text", update_last_message=None, commit=True):
     now = datetime.now(timezone.utc)
 
     msg = Message(
@@ -175,26 +196,33 @@ def log_message(session, direction, text, message_type="text", update_last_messa
     if direction == "in":
         session.last_message_time = now
 
-    db.session.commit()
+    if commit:
+        db.session.commit()
     return msg
 
 
-def send_text(session, number, text, update_last_message=True):
+def send_text(session, number, text, update_last_message=True, commit=True):
     bot_session = session.user.bot_session if session and session.user else None
     delivery_target = get_delivery_target(session, number)
     data = util.TextMessage(text, number=delivery_target)
-    whatsappservice.SendMessageWhatsapp(data, session_name=bot_session)
+    sent = whatsappservice.SendMessageWhatsapp(data, session_name=bot_session)
+
+    # Solo se registra lo que WPPConnect confirmó.
+    if not sent:
+        return False
 
     log_message(
         session,
         "out",
         text,
         message_type="text",
-        update_last_message=update_last_message
+        update_last_message=update_last_message,
+        commit=commit
     )
+    return True
 
 
-def send_yes_no_buttons(session, number, text, yes_label="Sí", no_label="No", update_last_message=True):
+def send_yes_no_buttons(session, number, text, yes_label="Sí", no_label="No", update_last_message=True, commit=True):
     bot_session = session.user.bot_session if session and session.user else None
     delivery_target = get_delivery_target(session, number)
     data = util.YesNoButtonMessage(number=delivery_target, text=text, yes_label=yes_label, no_label=no_label)
@@ -202,19 +230,20 @@ def send_yes_no_buttons(session, number, text, yes_label="Sí", no_label="No", u
 
     if not sent:
         fallback = f"{text}\n\nResponde con una opción:\n- {yes_label}\n- {no_label}"
-        send_text(session, number, fallback, update_last_message=update_last_message)
-        return
+        return send_text(session, number, fallback, update_last_message=update_last_message, commit=commit)
 
     log_message(
         session,
         "out",
         text,
         message_type="interactive",
-        update_last_message=update_last_message
+        update_last_message=update_last_message,
+        commit=commit
     )
+    return True
 
 
-def send_policy_buttons(session, number):
+def send_policy_buttons(session, number, commit=True):
     bot_session = session.user.bot_session if session and session.user else None
     delivery_target = get_delivery_target(session, number)
     data_button = util.PolicyButtonMessage(number=delivery_target)
@@ -227,30 +256,29 @@ def send_policy_buttons(session, number):
             body_text
             + "\n\nResponde con una opción:\n- Acepto\n- No acepto"
         )
-        send_text(session, number, fallback)
-        return
+        return send_text(session, number, fallback, commit=commit)
 
-    log_message(session, "out", body_text, message_type="interactive")
+    log_message(session, "out", body_text, message_type="interactive", commit=commit)
+    return True
 
 
-def send_policy_documents(session, number):
-    filenames = [
-        "politica_datos.pdf",
-        "autorizacion_datos.pdf",
-    ]
-
+def send_policy_documents(session, number, commit=True):
+    """Se corta (False) en el primer documento que WPPConnect no confirma."""
     bot_session = session.user.bot_session if session and session.user else None
     delivery_target = get_delivery_target(session, number)
 
-    for filename in filenames:
-        data = util.TextDocumentMessage(delivery_target, filename)
-        whatsappservice.SendMessageWhatsapp(data, session_name=bot_session)
+    for filename, display_name in util.POLICY_DOCUMENTS:
+        data = util.TextDocumentMessage(delivery_target, filename, display_name=display_name)
+        if not whatsappservice.SendMessageWhatsapp(data, session_name=bot_session):
+            return False
         log_message(
             session,
             "out",
-            f"Documento enviado: {filename}",
-            message_type="document"
+            f"Documento enviado: {display_name}",
+            message_type="document",
+            commit=commit
         )
+    return True
 
 
 def mark_session_abandoned(session):
@@ -276,18 +304,11 @@ def mark_session_abandoned(session):
     db.session.commit()
 
 
-def clear_inactivity_warning(session):
-    ctx = SessionContext.query.filter_by(
-        session_id=session.id,
-        context_key="inactivity_warning_sent"
-    ).first()
-
-    if ctx:
-        db.session.delete(ctx)
-        db.session.commit()
+def clear_inactivity_warning(session, commit=True):
+    clear_session_context(session, "inactivity_warning_sent", commit=commit)
 
 
-def clear_session_context(session, key):
+def clear_session_context(session, key, commit=True):
     ctx = SessionContext.query.filter_by(
         session_id=session.id,
         context_key=key
@@ -295,12 +316,13 @@ def clear_session_context(session, key):
 
     if ctx:
         db.session.delete(ctx)
-        db.session.commit()
+        if commit:
+            db.session.commit()
 
 
-def clear_survey_context(session):
-    clear_session_context(session, "timeout_poll_sent")
-    clear_session_context(session, "inactivity_warning_sent")
+def clear_survey_context(session, commit=True):
+    clear_session_context(session, "timeout_poll_sent", commit=commit)
+    clear_session_context(session, "inactivity_warning_sent", commit=commit)
 
 
 def current_session_has_accepted_policy(session):
@@ -319,11 +341,6 @@ def current_session_has_accepted_policy(session):
     )
 
 
-def move_session_to_accepted(session):
-    session.current_state_id = get_or_create_state("aceptado").id
-    db.session.commit()
-
-
 def get_session_context(session, key):
     return SessionContext.query.filter_by(
         session_id=session.id,
@@ -331,7 +348,7 @@ def get_session_context(session, key):
     ).first()
 
 
-def set_session_context(session, key, value):
+def set_session_context(session, key, value, commit=True):
     now = datetime.now(timezone.utc)
     ctx = get_session_context(session, key)
 
@@ -341,7 +358,8 @@ def set_session_context(session, key, value):
 
     ctx.context_value = value
     ctx.updated_at = now
-    db.session.commit()
+    if commit:
+        db.session.commit()
     return ctx
 
 
@@ -364,13 +382,13 @@ def normalize_delivery_phone(value):
     return None
 
 
-def save_delivery_phone(session, delivery_phone):
+def save_delivery_phone(session, delivery_phone, commit=True):
     """Guarda el número real de entrega en SessionContext sin requerir migración."""
     normalized = normalize_delivery_phone(delivery_phone)
     if not session or not normalized:
         return None
 
-    set_session_context(session, "delivery_phone", normalized)
+    set_session_context(session, "delivery_phone", normalized, commit=commit)
     return normalized
 
 
@@ -381,12 +399,20 @@ def get_delivery_target(session, fallback_number):
     2. Número entrante si ya es @c.us o un número normal.
     3. JID @lid como último recurso.
     """
+    saved_delivery_phone = None
     if session:
         ctx = get_session_context(session, "delivery_phone")
         if ctx:
-            normalized = normalize_delivery_phone(ctx.context_value)
-            if normalized:
-                return normalized
+            saved_delivery_phone = ctx.context_value
+
+    return resolve_delivery_target(saved_delivery_phone, fallback_number)
+
+
+def resolve_delivery_target(saved_delivery_phone, fallback_number):
+    """Igual que get_delivery_target, con el delivery_phone ya leído (envíos en lote)."""
+    normalized = normalize_delivery_phone(saved_delivery_phone)
+    if normalized:
+        return normalized
 
     fallback = str(fallback_number or "").strip()
     if fallback.endswith("@c.us"):
@@ -402,260 +428,296 @@ def get_delivery_target(session, fallback_number):
     return fallback
 
 
-def normalize_answer(text):
-    text = (text or "").strip().lower()
-    text = text.replace("í", "i")
-    text = re.sub(r"\s+", " ", text)
-    return text
+# ============================================================
+# LÓGICA DE MENSAJES
+# ============================================================
+def lead_delivery_phone(session, phone_number):
+    """Número real del contacto para el lead (vacío si solo hay JID @lid)."""
+    return normalize_delivery_phone(get_delivery_target(session, phone_number)) or ""
 
 
-def is_yes(text):
-    return normalize_answer(text) in ["si", "s", "yes", "acepto calificar", "calificar"]
+def enqueue_lead(session, first_message=None):
+    """
+    Deja el lead en la cola persistente, sin commit: se confirma junto con
+    el consentimiento y el worker de php_leads_service lo envía a PHP.
+    """
+    user = session.user
+    return php_leads_service.enqueue_lead(
+        user,
+        session,
+        lead_delivery_phone(session, user.phone_number or ""),
+        first_message,
+        commit=False,
+    )
 
 
-def is_no(text):
-    return normalize_answer(text) in ["no", "n", "no calificar"]
+# ============================================================
+# FLUJO DE CONVERSACIÓN
+# ============================================================
+# Intenciones que dependen de la sesión y no del texto; las de texto
+# (accept, reject, yes, no) salen del vocabulario de intents.py.
+FLOW_GUARDS = {
+    "policy_already_accepted": current_session_has_accepted_policy,
+}
 
 
-def is_accept(text):
-    t = normalize_answer(text)
-    return t in ["acepto", "aceptar", "si acepto", "de acuerdo", "estoy de acuerdo"]
+def resolve_state_id(name):
+    return get_or_create_state(name).id
 
 
-def is_reject(text):
-    t = normalize_answer(text)
-    return t in ["no acepto", "no aceptar", "rechazo", "no"]
+def get_conversation_flow(bot_session):
+    """Flujo compilado de la sesión WPP; se compila una vez por proceso."""
+    return conversation_flow.get_flow(bot_sessions.get(bot_session).flow, resolve_state_id, FLOW_GUARDS)
 
 
-# ============================================================
-# LÓGICA DE MENSAJES
-# ============================================================
-def send_lead_to_php(user, session, first_message=None):
+def stage_transition(transition, session, number, text):
+    """
+    Aplica el estado y las escrituras en BD de una transición, sin commit.
+    Devuelve los efectos salientes, que se guardan en outbound_messages.
     """
-    Envía el contacto aceptado hacia la página PHP para crear/actualizar un lead.
-    No rompe el flujo del chatbot si la API PHP falla.
+    bot_session = session.user.bot_session if session.user else None
+    sends = []
+
+    if transition.next_state_id is not None:
+        session.current_state_id = transition.next_state_id
+
+    for effect in transition.effects:
+        if isinstance(effect, conversation_flow.OUTBOUND_EFFECTS):
+            sends.append(effect)
+        elif isinstance(effect, conversation_flow.SaveConsent):
+            save_policy_consent(session, accepted=effect.accepted, commit=False)
+        elif isinstance(effect, conversation_flow.SetContext):
+            set_session_context(session, effect.key, effect.value, commit=False)
+        elif isinstance(effect, conversation_flow.ClearContext):
+            for key in effect.keys:
+                clear_session_context(session, key, commit=False)
+        elif isinstance(effect, conversation_flow.CloseSession):
+            close_session(session, effect.reason, commit=False)
+        elif isinstance(effect, conversation_flow.PushLead):
+            enqueue_lead(session, text)
+        elif isinstance(effect, conversation_flow.Log):
+            conversation_log.info(effect.message, number=number, bot_session=bot_session)
+
+    return sends
+
+
+def execute_outbound(effect, session, number):
     """
+    Un efecto saliente: envío a WPPConnect y su mensaje saliente, sin commit.
+    Si WPPConnect no confirma el envío lanza outbound.NotDelivered y la fila
+    sigue abierta para reintentarse (los documentos se reenvían todos).
+    """
+    sent = True
+    if isinstance(effect, conversation_flow.SendText):
+        sent = send_text(session, number, effect.text, commit=False)
+    elif isinstance(effect, conversation_flow.SendYesNo):
+        sent = send_yes_no_buttons(
+            session,
+            number,
+            effect.text,
+            yes_label=effect.yes_label,
+            no_label=effect.no_label,
+            commit=False
+        )
+    elif isinstance(effect, conversation_flow.SendPolicyButtons):
+        sent = send_policy_buttons(session, number, commit=False)
+    elif isinstance(effect, conversation_flow.SendPolicyDocuments):
+        sent = send_policy_documents(session, number, commit=False)
 
-    api_url = os.getenv("PHP_LEADS_API_URL", "").strip()
-    api_token = os.getenv("PHP_LEADS_API_TOKEN", "").strip()
+    if not sent:
+        raise outbound.NotDelivered(type(effect).__name__)
 
-    if not api_url or not api_token:
-        print("⚠️ PHP_LEADS_API_URL o PHP_LEADS_API_TOKEN no configurado. No se envió lead a PHP.", flush=True)
-        return False
 
-    phone_value = user.phone_number or ""
-    delivery_phone = get_delivery_target(session, phone_value)
-    delivery_phone = normalize_delivery_phone(delivery_phone) or ""
+def drain_outbound(bot_session, number):
+    """
+    Envía en orden lo pendiente del contacto en outbound_messages. Se corta
+    (y lo que falta queda pendiente) si la sesión WPP se pausa o, dentro de
+    una petición, antes del envío que ya no entra en su presupuesto.
+    """
+    reserve = bot_sessions.get(bot_session).send_delay_seconds
+    return outbound.drain(
+        bot_session,
+        number,
+        execute_outbound,
+        should_stop=lambda: bot_sessions.is_paused(bot_session) or request_deadline.exhausted(reserve),
+    )
 
-    payload = {
-        # Campos que espera tu PHP
-        "accepted": True,
-        "phone": delivery_phone or (phone_value.replace("@lid", "").replace("@c.us", "") if phone_value else ""),
-        "phone_number": phone_value,
-        "phone_jid": phone_value if "@" in phone_value else "",
-        "jid": phone_value if "@" in phone_value else "",
-        "delivery_phone": delivery_phone,
-        "name": user.name or "Contacto externo / WhatsApp",
-        "bot_session": user.bot_session,
-        "session": user.bot_session,
-        "last_message": first_message or "Aceptó la política de tratamiento de datos personales",
-        "message": first_message or "Aceptó la política de tratamiento de datos personales",
-        "chatbot_user_id": user.id,
-        "chatbot_session_id": session.id,
-        "consent_at": datetime.now(timezone.utc).isoformat(),
-
-        # Compatibilidad adicional
-        "source": "chatbot_whatsapp",
-        "channel": "whatsapp",
-        "policy_accepted": True,
-    }
 
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Authorization": f"Bearer {api_token}",
-    }
+def _drain_job(bot_session, number):
+    def job():
+        with app.app_context():
+            drain_outbound(bot_session, number)
+    return job
 
-    try:
-        response = requests.post(api_url, json=payload, headers=headers, timeout=15)
 
-        print(
-            f"📤 Lead enviado a PHP: {response.status_code} {response.text}",
-            flush=True
-        )
+def wake_outbound(bot_session, number):
+    """Para el barrido de outbound.py: encola el drenado sin esperar lugar."""
+    return bot_sessions.defer(bot_session, number, _drain_job(bot_session, number))
 
-        return 200 <= response.status_code < 300
 
-    except Exception as e:
-        print(f"❌ Error enviando lead a PHP: {e}", flush=True)
-        return False
-    
-    
-def handle_new_message(text, number, bot_session=None, delivery_number=None):
-    now = datetime.now(timezone.utc)
-    bot_session = normalize_bot_session(bot_session)
-
-    user = get_or_create_user(number, bot_session=bot_session)
-    session = get_active_session(user)
+def dispatch_outbound(bot_session, number):
+    """
+    Después del commit: los envíos ya están en outbound_messages y el carril
+    del contacto dentro de su sesión WPP (bot_sessions) los drena. Si la
+    cola sigue llena, esperan en la tabla detrás de los anteriores del
+    contacto y los retoma el barrido. Con las colas desactivadas se drenan
+    en este hilo mientras entren en el presupuesto de la petición y el
+    resto pasa al carril.
+    """
+    put_timeout = request_deadline.timeout(bot_sessions.SESSION_QUEUE_PUT_TIMEOUT_SECONDS)
+    if bot_sessions.SESSION_QUEUES_ENABLED:
+        bot_sessions.submit(bot_session, number, _drain_job(bot_session, number), timeout=put_timeout)
+        return
 
-    if not session:
-        session = Session(
-            user_id=user.id,
-            start_time=now,
-            is_active=True,
-            current_state_id=get_or_create_state("inicio").id,
-            last_message_time=now
+    _, left = drain_outbound(bot_session, number)
+    if left:
+        request_deadline.record_deferred()
+        conversation_log.warning(
+            "⏳ Envíos diferidos al carril de la sesión",
+            deferred=left, paused=bot_sessions.is_paused(bot_session), bot_session=bot_session, number=number,
         )
-        db.session.add(session)
-        db.session.commit()
-    else:
-        # Si el cliente vuelve después de una encuesta pendiente, el warning viejo no aplica.
-        clear_inactivity_warning(session)
+        wake_outbound(bot_session, number)
 
-    # Conserva el JID @lid como identidad, pero guarda el número real para responder por @c.us.
-    saved_delivery_phone = save_delivery_phone(session, delivery_number)
-    if saved_delivery_phone:
-        print(
-            f"📞 Destino real guardado para entrega: {saved_delivery_phone} | JID={number}",
-            flush=True,
-        )
 
-    log_message(session, "in", text)
+def open_session(user, flow, now):
+    session = Session(
+        user_id=user.id,
+        start_time=now,
+        is_active=True,
+        current_state_id=flow.initial_state_id,
+        last_message_time=now
+    )
+    db.session.add(session)
+    db.session.flush()
+    return session
 
-    current_state = db.session.get(State, session.current_state_id)
-    state_name = current_state.state_name.lower() if current_state else "inicio"
-    text_lower = normalize_answer(text)
 
-    print(f"🌀 Estado actual: {state_name} | sesión WPP: {bot_session} | cliente: {number}", flush=True)
+def handle_new_message(text, number, bot_session=None, delivery_number=None):
+    # Dentro del webhook corre con su deadline (request_deadline): los envíos
+    # que se drenan en la petición no empiezan si ya no entran en él.
+    handle_conversation_messages([{"text": text}], number, bot_session=bot_session, delivery_number=delivery_number)
 
-    # ================== ESTADO INICIO ==================
-    # La política se pide por ciclo/conversación, no de forma global.
-    # Si por algún bug esta sesión ya tiene aceptación, se repara y pasa a aceptado.
-    if state_name == "inicio":
-        if current_session_has_accepted_policy(session):
-            move_session_to_accepted(session)
-            print(
-                f"✅ Sesión actual ya tenía política aceptada. No se vuelve a solicitar. "
-                f"Cliente={number} | sesión={bot_session}",
-                flush=True
-            )
-            return
 
-        send_policy_buttons(session, number)
-        send_policy_documents(session, number)
+def log_inbound_message(session, item):
+    """
+    Registra un mensaje entrante sin commit. Si trae multimedia queda en
+    media_status='pending' para el worker de media_store.py: la descarga
+    nunca ocurre dentro del webhook.
+    """
+    media = item.get("media")
+    if not media:
+        msg = log_message(session, "in", item["text"], commit=False)
+    else:
+        message_type, message_text = media_store.media_message_fields(
+            media["type"], caption=item["text"], filename=media.get("filename")
+        )
+        msg = log_message(session, "in", message_text, message_type=message_type, commit=False)
+        msg.media_filename = media.get("filename")
+        msg.media_mime_type = media.get("mime_type")
+        msg.media_status = "pending" if item.get("message_id") else "error"
 
-        session.current_state_id = get_or_create_state("esperando_aceptacion").id
-        db.session.commit()
-        return
+    msg.external_id = item.get("message_id")
+    return msg
 
-    # ================== ACEPTACIÓN ==================
-    if state_name == "esperando_aceptacion":
-        if is_accept(text_lower):
-            save_policy_consent(session, accepted=True)
 
-            send_lead_to_php(
-                user=user,
-                session=session,
-                first_message=text
+def handle_conversation_messages(messages, number, bot_session=None, delivery_number=None):
+    """
+    Procesa en orden los mensajes de una conversación (uno, o el lote que
+    WPPConnect entrega tras una reconexión) en una sola transacción:
+    mensajes entrantes, estados y escrituras de todas las transiciones van
+    en un commit (con los leads y los envíos encolados); después el carril
+    de la sesión WPP drena los envíos (ver dispatch_outbound).
+
+    Cada mensaje es un dict con "text" y, si viene de WPPConnect,
+    "message_id" y "media" (ver extract_wppconnect_item).
+    """
+    now = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    bot_session = normalize_bot_session(bot_session)
+    flow = get_conversation_flow(bot_session)
+
+    with tracing.span("conversation.load", **{"wpp.session": bot_session}) as load_span:
+        user = get_or_create_user(number, bot_session=bot_session)
+        session = get_active_session(user)
+
+        if not session:
+            session = open_session(user, flow, now)
+            start_state = conversation_flow.INITIAL_STATE
+        else:
+            start_state = (
+                session_deadlines.state_name_for(db.session, session.current_state_id)
+                or conversation_flow.INITIAL_STATE
             )
+            # Si el cliente vuelve después de una encuesta pendiente, el warning viejo no aplica.
+            clear_inactivity_warning(session, commit=False)
 
-            session.current_state_id = get_or_create_state("aceptado").id
-            db.session.commit()
+        load_span.set_attribute("chatbot.session_id", session.id)
+        load_span.set_attribute("chatbot.state", start_state)
 
-            send_text(
-                session,
-                number,
-                "Perfecto. Uno de nuestros Asesores se comunicará con usted"
-            )
-            return
-
-        if is_reject(text_lower):
-            save_policy_consent(session, accepted=False)
+    # Conserva el JID @lid como identidad, pero guarda el número real para responder por @c.us.
+    saved_delivery_phone = save_delivery_phone(session, delivery_number, commit=False)
+    if saved_delivery_phone:
+        conversation_log.info("📞 Destino real guardado para entrega", delivery_phone=saved_delivery_phone, number=number)
 
-            session.current_state_id = get_or_create_state("rechazado").id
-            db.session.commit()
+    sends = 0
+    transitions = []
 
-            send_text(session, number, "Sin aceptar la política no podemos continuar. La sesión será cerrada.")
-            close_session(session, "no_acepta_politica")
-            return
+    for item in messages:
+        text = item["text"]
 
-        send_policy_buttons(session, number)
-        return
+        if not session.is_active:
+            # Un mensaje anterior del lote cerró la sesión: este abre un ciclo nuevo.
+            session = open_session(user, flow, now)
+            save_delivery_phone(session, delivery_number, commit=False)
 
-    # ================== PREGUNTA ENCUESTA ==================
-    if state_name == "esperando_calificacion":
-        if is_yes(text_lower):
-            session.current_state_id = get_or_create_state("encuesta_satisfaccion").id
-            db.session.commit()
+        log_inbound_message(session, item)
 
-            send_yes_no_buttons(
-                session,
-                number,
-                "¿Quedaste satisfecho con la atención?",
-                yes_label="Sí",
-                no_label="No"
-            )
-            return
-
-        if is_no(text_lower):
-            send_text(session, number, "Gracias por tu tiempo.")
-            close_session(session, "no_quiso_calificar")
-            return
-
-        # Regla dura:
-        # Si el cliente escribe algo distinto de sí/no, quiere retomar la conversación.
-        # Se cancela la encuesta, la sesión sigue abierta y NO se vuelve a pedir política.
-        clear_survey_context(session)
-        move_session_to_accepted(session)
-
-        print(
-            f"🔁 Encuesta cancelada por mensaje normal. Cliente={number} | sesión={bot_session}",
-            flush=True
-        )
-        return
+        if item.get("media") and not text.strip():
+            # Multimedia sin caption: queda registrada pero no es una respuesta
+            # del flujo (no reenvía la política ni cancela la encuesta).
+            conversation_log.debug("📎 Multimedia sin texto: sin transición", number=number)
+            continue
 
-    # ================== ENCUESTA ==================
-    if state_name == "encuesta_satisfaccion":
-        ctx = SessionContext.query.filter_by(
-            session_id=session.id,
-            context_key="satisfaccion"
-        ).first()
+        state_name = session_deadlines.state_name_for(db.session, session.current_state_id) or "inicio"
+        conversation_log.debug("🌀 Estado actual", state=state_name, bot_session=bot_session, number=number)
 
-        if not ctx:
-            ctx = SessionContext(session_id=session.id, context_key="satisfaccion")
-            db.session.add(ctx)
+        with tracing.span("transition", **{"chatbot.state": state_name}) as transition_span:
+            transition, match = flow.dispatch(session.current_state_id, text, session)
+            transition_span.set_attribute("chatbot.intent", match.intent)
+            transition_span.set_attribute("chatbot.confidence", match.confidence)
+            if 0 < match.confidence < 1:
+                conversation_log.info(
+                    "🔎 Intención aproximada", intent=match.intent, confidence=round(match.confidence, 2), text=text,
+                )
 
-        if is_yes(text_lower):
-            ctx.context_value = "satisfecho"
-            ctx.updated_at = now
-            db.session.commit()
+            if transition is None:
+                continue
 
-            send_text(session, number, "Gracias por permitirnos estar conectados con usted a través de este canal. Hasta luego.")
-            close_session(session, "encuesta_satisfecho")
-            return
+            transition_span.set_attribute("chatbot.transition", transition.name)
+            transitions.append(transition.name)
+            effects = stage_transition(transition, session, number, text)
+            # En la misma transacción: confirmada la conversación, sus envíos no se pierden.
+            outbound.stage(session, number, bot_session, effects)
+            sends += len(effects)
 
-        if is_no(text_lower):
-            ctx.context_value = "no_satisfecho"
-            ctx.updated_at = now
-            db.session.commit()
+    db.session.commit()
 
-            send_text(session, number, "Gracias por tu sinceridad. Hasta luego.")
-            close_session(session, "encuesta_no_satisfecho")
-            return
+    if sends:
+        with tracing.span("conversation.outbound", **{"chatbot.sends": sends}):
+            dispatch_outbound(bot_session, number)
 
-        # También en la segunda pregunta: si escribe algo normal, retoma conversación.
-        clear_survey_context(session)
-        move_session_to_accepted(session)
+    metrics.CONVERSATION_SECONDS.labels(start_state).observe(time.perf_counter() - started)
 
-        print(
-            f"🔁 Encuesta de satisfacción cancelada por mensaje normal. Cliente={number} | sesión={bot_session}",
-            flush=True
+    if transitions:
+        conversation_log.info(
+            "⏱️ Transiciones",
+            transitions=transitions,
+            ms=round((time.perf_counter() - started) * 1000, 1),
+            messages=len(messages),
+            sends=sends,
+            bot_session=bot_session,
+            number=number,
         )
-        return
-
-    # ================== ASESOR HUMANO ==================
-    # Estado aceptado: el bot no responde; solo registra mensajes.
-    return
 
 
 # ============================================================
@@ -682,6 +744,8 @@ def VerifyToken():
 
 
 @app.route('/whatsapp', methods=['POST'])
+@tracing.traced_view("webhook.meta")
+@request_deadline.bounded_view("webhook.meta")
 def RecievedMessage():
     try:
         body = request.get_json()
@@ -689,95 +753,170 @@ def RecievedMessage():
         message = entry['changes'][0]['value']['messages'][0]
 
         number = message['from']
-        text = util.GetTextUser(message)
+        media, caption = util.GetMediaUser(message)
+        text = caption if media else util.GetTextUser(message)
 
-        handle_new_message(
-            text,
+        # Sin message_id de WPPConnect, media_store no puede descargar el
+        # archivo: queda registrado con media_status='error'.
+        handle_conversation_messages(
+            [{"text": text, "media": media}],
             number,
-            bot_session=os.getenv("WPPCONNECT_SESSION", "alestur_ventas"),
+            bot_session=bot_sessions.DEFAULT_SESSION,
             delivery_number=number,
         )
 
-        print("💬 Mensaje Meta recibido:", text, flush=True)
+        webhook_log.info("💬 Mensaje Meta recibido", number=number, text=text)
         return "EVENT_RECEIVED"
     except Exception as e:
-        print("❌ Error procesando mensaje Meta:", e, flush=True)
+        webhook_log.error("❌ Error procesando mensaje Meta", error=repr(e))
         return "EVENT_RECEIVED"
 
 
 @app.route('/wppconnect', methods=['POST'])
+@tracing.traced_view("webhook.wppconnect")
+@request_deadline.bounded_view("webhook.wppconnect")
 def WppconnectWebhook():
     try:
-        body = request.get_json() or {}
-        print("📥 Webhook WPPConnect recibido:", body, flush=True)
+        body = request.get_json(silent=True) or {}
+        webhook_log.debug("📥 Webhook WPPConnect recibido", body=body)
 
-        event = body.get("event")
+        with tracing.span("webhook.extract") as extract_span:
+            messages = extract_wppconnect_messages(body)
+            conversations = group_by_conversation(messages)
+            extract_span.set_attribute("webhook.messages", len(messages))
+            extract_span.set_attribute("webhook.conversations", len(conversations))
 
-        # Solo procesamos mensajes reales.
-        if event and event not in ["onmessage", "onMessage", "message"]:
-            print(f"⏭️ Evento ignorado de WPPConnect: {event}", flush=True)
-            return jsonify({"status": "ignored_event"}), 200
+        if not messages:
+            return jsonify({"status": "ignored"}), 200
 
-        # Ignorar ACKs/mensajes enviados por nosotros mismos
-        msg_id = body.get("id") or {}
-        if isinstance(msg_id, dict) and msg_id.get("fromMe") is True:
-            print("⏭️ Mensaje propio/ACK ignorado", flush=True)
-            return jsonify({"status": "ignored_from_me"}), 200
+        processed = 0
+        failed = 0
 
-        if body.get("fromMe") is True:
-            print("⏭️ Mensaje propio ignorado", flush=True)
-            return jsonify({"status": "ignored_from_me"}), 200
+        for (bot_session, number), items in conversations.items():
+            delivery_number = next(
+                (item["delivery_number"] for item in reversed(items) if item["delivery_number"]),
+                None,
+            )
 
-        data = body.get("data") or body.get("message") or {}
+            for item in items:
+                media_type = item["media"]["type"] if item["media"] else None
+                webhook_log.info(
+                    "💬 WPPConnect mensaje recibido",
+                    number=number,
+                    bot_session=bot_session,
+                    text=item["text"],
+                    media=media_type,
+                    delivery_number=delivery_number,
+                )
+
+            # Cada conversación en su transacción: un error no frena las demás.
+            try:
+                handle_conversation_messages(
+                    items,
+                    number,
+                    bot_session=bot_session,
+                    delivery_number=delivery_number,
+                )
+                processed += len(items)
+            except Exception as e:
+                db.session.rollback()
+                failed += len(items)
+                webhook_log.error(
+                    "❌ Error procesando conversación", number=number, bot_session=bot_session, error=repr(e),
+                    exc_info=True,
+                )
+
+        if len(messages) > 1:
+            webhook_log.info(
+                "📦 Lote WPPConnect", messages=len(messages), conversations=len(conversations), failed=failed,
+            )
 
-        if isinstance(data, dict) and data.get("fromMe") is True:
-            print("⏭️ Mensaje propio ignorado desde data", flush=True)
-            return jsonify({"status": "ignored_from_me"}), 200
+        return jsonify({
+            "status": "ok" if not failed else "partial",
+            "processed": processed,
+            "failed": failed,
+            "conversations": len(conversations),
+        }), 200
 
-        extracted = extract_wppconnect_message(body)
+    except Exception as e:
+        webhook_log.error("❌ Error procesando webhook WPPConnect", error=repr(e), exc_info=True)
+        return jsonify({"status": "error"}), 200
 
-        if not extracted:
-            return jsonify({"status": "ignored"}), 200
 
-        text = extracted["text"]
-        number = extracted["number"]
-        delivery_number = extracted.get("delivery_number")
-        bot_session = normalize_bot_session(extracted.get("bot_session") or body.get("session"))
+WPPCONNECT_MESSAGE_EVENTS = {"onmessage", "onMessage", "message"}
 
-        if not text or not number:
-            return jsonify({"status": "ignored_empty"}), 200
 
-        print(
-            f"💬 WPPConnect mensaje recibido de {number} para {bot_session}: {text} "
-            f"| destino_real={delivery_number or 'no_disponible'}",
-            flush=True,
-        )
+def iter_wppconnect_items(body):
+    """
+    Recorre todos los mensajes de un webhook: el cuerpo puede ser un evento o
+    una lista de eventos, y cada evento traer `data`/`message` como objeto o
+    como lista. Descarta eventos que no son mensajes y mensajes propios/ACKs.
+    """
+    events = body if isinstance(body, list) else [body]
 
-        handle_new_message(
-            text,
-            number,
-            bot_session=bot_session,
-            delivery_number=delivery_number,
-        )
+    for event_body in events:
+        if not isinstance(event_body, dict):
+            continue
 
-        return jsonify({"status": "ok"}), 200
+        event = event_body.get("event")
+        if event and event not in WPPCONNECT_MESSAGE_EVENTS:
+            webhook_log.debug("⏭️ Evento ignorado de WPPConnect", event=event)
+            continue
 
-    except Exception as e:
-        print("❌ Error procesando webhook WPPConnect:", repr(e), flush=True)
-        return jsonify({"status": "error"}), 200
+        # Ignorar ACKs/mensajes enviados por nosotros mismos
+        msg_id = event_body.get("id") or {}
+        if event_body.get("fromMe") is True or (isinstance(msg_id, dict) and msg_id.get("fromMe") is True):
+            webhook_log.debug("⏭️ Mensaje propio/ACK ignorado")
+            continue
 
+        data = event_body.get("data") or event_body.get("message") or event_body
+        items = data if isinstance(data, list) else [data]
 
-def extract_wppconnect_message(body):
-    data = body.get("data") or body.get("message") or body
+        for item in items:
+            if isinstance(item, dict):
+                yield item, event_body
 
-    if isinstance(data, list):
-        if not data:
-            return None
-        data = data[0]
 
-    if not isinstance(data, dict):
-        return None
+def extract_wppconnect_messages(body):
+    """Todos los mensajes útiles del webhook, sin duplicados por id."""
+    messages = []
+    seen_ids = set()
+
+    for data, event_body in iter_wppconnect_items(body):
+        extracted = extract_wppconnect_item(data, event_body)
+        if not extracted or not (extracted["text"] or extracted["media"]):
+            continue
 
+        message_id = extracted["message_id"]
+        if message_id:
+            if message_id in seen_ids:
+                continue
+            seen_ids.add(message_id)
+
+        messages.append(extracted)
+
+    return messages
+
+
+def group_by_conversation(messages):
+    """
+    {(bot_session, number): [mensajes]} en orden de llegada de la primera
+    aparición; dentro de cada conversación, ordenados por timestamp de
+    WPPConnect (orden estable si falta).
+    """
+    conversations = {}
+
+    for message in messages:
+        key = (normalize_bot_session(message["bot_session"]), message["number"])
+        conversations.setdefault(key, []).append(message)
+
+    for items in conversations.values():
+        items.sort(key=lambda item: item["timestamp"] or 0)
+
+    return conversations
+
+
+def extract_wppconnect_item(data, body):
     if data.get("fromMe") is True:
         return None
 
@@ -786,27 +925,41 @@ def extract_wppconnect_message(body):
         return None
 
     sender = data.get("sender") or body.get("sender") or {}
+    if not isinstance(sender, dict):
+        sender = {}
 
     if IGNORE_SAVED_CONTACTS and sender.get("isMyContact") is True:
-        print("⏭️ Contacto guardado ignorado:", sender.get("formattedName") or data.get("from"), flush=True)
+        webhook_log.debug("⏭️ Contacto guardado ignorado", contact=sender.get("formattedName") or data.get("from"))
         return None
 
     # Número del cliente
     number = (
         data.get("from")
         or data.get("chatId")
-        or data.get("sender", {}).get("id")
+        or sender.get("id")
         or data.get("author")
     )
 
-    # Texto del mensaje
-    text = (
-        data.get("body")
-        or data.get("text")
-        or data.get("content")
-        or data.get("message")
-        or ""
-    )
+    # En multimedia `body` trae la miniatura en base64: el texto es el caption.
+    wpp_type = data.get("type")
+    media = None
+
+    if wpp_type in media_store.MEDIA_TYPES:
+        media = {
+            "type": wpp_type,
+            "mime_type": data.get("mimetype"),
+            "filename": data.get("filename"),
+        }
+        text = data.get("caption") or ""
+    else:
+        # Texto del mensaje
+        text = (
+            data.get("body")
+            or data.get("text")
+            or data.get("content")
+            or data.get("message")
+            or ""
+        )
 
     if isinstance(text, dict):
         text = (
@@ -841,11 +994,20 @@ def extract_wppconnect_message(body):
     if not delivery_number and not str(number).endswith("@lid"):
         delivery_number = normalize_delivery_phone(number)
 
+    message_id = data.get("id")
+    if isinstance(message_id, dict):
+        message_id = message_id.get("_serialized") or message_id.get("id")
+
+    timestamp = data.get("t") or data.get("timestamp")
+
     return {
         "number": number,
         "delivery_number": delivery_number,
         "text": str(text).strip(),
         "bot_session": body.get("session") or data.get("session"),
+        "message_id": str(message_id) if message_id else None,
+        "timestamp": timestamp if isinstance(timestamp, (int, float)) else None,
+        "media": media,
     }
 
 
@@ -880,24 +1042,165 @@ def close_session_manual(session_id):
     return jsonify({"message": "Sesión marcada para calificación"}), 200
 
 
+def parse_list_arg(name):
+    """Lee un parámetro que puede venir repetido o separado por comas."""
+    values = []
+    for raw in request.args.getlist(name):
+        values.extend(part.strip() for part in raw.split(",") if part.strip())
+    return values
+
+
+def filter_active_sessions_query(query, bot_sessions, state_names):
+    query = query.filter(Session.is_active.is_(True))
+
+    if bot_sessions:
+        query = query.filter(User.bot_session.in_(bot_sessions))
+
+    if state_names:
+        query = query.filter(State.state_name.in_([name.lower() for name in state_names]))
+
+    return query
+
+
+def active_sessions_summary(bot_sessions, state_names):
+    """
+    Resumen del tablero en UNA sola consulta agrupada por (estado, bot_session).
+    Los totales por estado y por número se suman en Python sobre pocas filas.
+    """
+    last_activity = db.func.coalesce(Session.last_message_time, Session.start_time)
+
+    query = (
+        db.session.query(
+            State.state_name,
+            User.bot_session,
+            db.func.count(Session.id),
+            db.func.min(last_activity),
+        )
+        .select_from(Session)
+        .join(User, User.id == Session.user_id)
+        .outerjoin(State, State.id == Session.current_state_id)
+    )
+    query = filter_active_sessions_query(query, bot_sessions, state_names)
+    rows = query.group_by(State.state_name, User.bot_session).all()
+
+    by_state = {}
+    by_bot_session = {}
+    total = 0
+    oldest = None
+
+    for state_name, bot_session, count, oldest_activity in rows:
+        state_key = state_name or "sin_estado"
+        by_state[state_key] = by_state.get(state_key, 0) + count
+        by_bot_session[bot_session] = by_bot_session.get(bot_session, 0) + count
+        total += count
+
+        if oldest_activity and (oldest is None or oldest_activity < oldest):
+            oldest = oldest_activity
+
+    inactivity_seconds = None
+    if oldest:
+        inactivity_seconds = int((datetime.now(timezone.utc) - make_aware(oldest)).total_seconds())
+
+    return {
+        "total": total,
+        "by_state": by_state,
+        "by_bot_session": by_bot_session,
+        "oldest_last_message_time": iso(oldest),
+        "oldest_inactivity_seconds": inactivity_seconds,
+    }
+
+
 @app.route('/sessions/active', methods=['GET'])
 def list_active_sessions():
-    sessions = Session.query.filter_by(is_active=True).all()
-    data = [{
-        "id": s.id,
-        "bot_session": s.user.bot_session,
-        "user_phone": s.user.phone_number,
-        "start_time": s.start_time.isoformat() if s.start_time else None,
-        "last_message_time": s.last_message_time.isoformat() if s.last_message_time else None,
-        "state": s.state.state_name if s.state else None
-    } for s in sessions]
+    """
+    Tablero de sesiones activas.
+
+    Filtros opcionales:
+    - ?bot_session=alestur_ventas (repetible o separado por comas)
+    - ?state=aceptado,esperando_calificacion
+    - ?limit=100 (máximo 500)
+    - ?cursor=<next_cursor de la página anterior>
+    - ?summary=false para omitir el resumen
+    """
+    bot_sessions = parse_list_arg("bot_session")
+    state_names = parse_list_arg("state")
+
+    try:
+        limit = int(request.args.get("limit", 100))
+    except Exception:
+        limit = 100
+
+    try:
+        after_id = int(request.args.get("cursor", 0) or 0)
+    except Exception:
+        return jsonify({"status": "error", "message": "cursor inválido"}), 400
+
+    limit = max(1, min(limit, 500))
 
-    return jsonify(data), 200
+    # Paginación por keyset sobre sessions.id: el costo de cada página no
+    # depende de cuántas páginas se hayan recorrido (no hay OFFSET).
+    query = (
+        db.session.query(
+            Session.id,
+            User.bot_session,
+            User.phone_number,
+            Session.start_time,
+            Session.last_message_time,
+            State.state_name,
+        )
+        .select_from(Session)
+        .join(User, User.id == Session.user_id)
+        .outerjoin(State, State.id == Session.current_state_id)
+    )
+    query = filter_active_sessions_query(query, bot_sessions, state_names)
+
+    if after_id:
+        query = query.filter(Session.id > after_id)
+
+    rows = query.order_by(Session.id.asc()).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    data = serializers.ACTIVE_SESSION_ENCODER.encode_many(rows)
+
+    payload = {
+        "status": "ok",
+        "limit": limit,
+        "next_cursor": str(rows[-1][0]) if has_more and rows else None,
+        "sessions": data,
+    }
+
+    if request.args.get("summary", "true").lower() not in ["false", "0", "no"]:
+        payload["summary"] = active_sessions_summary(bot_sessions, state_names)
+
+    return json_response(payload, 200, aliases={"data": "sessions"})
+
+
+def warm_up():
+    """
+    Deja un proceso listo para atender (lo llama post_fork en gunicorn.conf.py):
+    pool de BD con conexión abierta, estados y flujos de conversación
+    compilados, caché de estados del barrido y PDFs de política codificados.
+    """
+    with app.app_context():
+        db.session.execute(db.text("SELECT 1"))
+        seed_default_states()
+        flow = get_conversation_flow(normalize_bot_session(None))
+        session_deadlines.state_name_for(db.session, flow.initial_state_id)
+        db.session.commit()
+
+    whatsappservice.preload_files(
+        os.path.join(util.ARCHIVOS_DIR, filename) for filename, _ in util.POLICY_DOCUMENTS
+    )
 
 
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({"status": "ok"}), 200
+    """Siempre 200; "degraded" si alguna sesión WPP está pausada (ver session_health)."""
+    sessions = session_health.snapshot()
+    status = "degraded" if any(item["paused"] for item in sessions.values()) else "ok"
+    return jsonify({"status": status, "sessions": sessions}), 200
 
 
 # ============================================================
@@ -905,9 +1208,12 @@ def health():
 # ============================================================
 
 from functools import wraps
-from flask import Response
+from flask import Response, send_file, url_for
 import csv
 import io
+import contact_import
+import export_jobs
+import media_store
 
 
 CRM_API_TOKEN = os.getenv("CRM_API_TOKEN", "")
@@ -943,16 +1249,6 @@ def crm_auth_required(fn):
     return wrapper
 
 
-def format_datetime(value):
-    if not value:
-        return None
-
-    try:
-        return value.strftime("%Y-%m-%d %H:%M:%S")
-    except Exception:
-        return str(value)
-
-
 def get_policy_status_for_user(user_id):
     """
     Retorna el último consentimiento registrado del usuario.
@@ -1056,6 +1352,148 @@ def build_contact_payload(user):
     }
 
 
+CONTACT_PAYLOAD_BATCH_SIZE = 1000
+
+
+def build_contact_payloads(users, compact=False):
+    """
+    Igual que build_contact_payload, pero para un lote de usuarios:
+    4 consultas por cada 1000 usuarios en lugar de 4 por usuario.
+    En modo compacto se omite el alias user_id.
+    """
+    users = list(users)
+    payloads = []
+
+    for start in range(0, len(users), CONTACT_PAYLOAD_BATCH_SIZE):
+        chunk = users[start:start + CONTACT_PAYLOAD_BATCH_SIZE]
+        payloads.extend(_build_contact_payloads_chunk(chunk, compact))
+
+    return payloads
+
+
+def _build_contact_payloads_chunk(users, compact):
+    user_ids = [user.id for user in users]
+
+    if not user_ids:
+        return []
+
+    consent_rank = db.func.row_number().over(
+        partition_by=PolicyConsent.user_id,
+        order_by=(PolicyConsent.created_at.desc(), PolicyConsent.id.desc()),
+    ).label("rn")
+    consent_sq = (
+        db.session.query(PolicyConsent.user_id, PolicyConsent.accepted, PolicyConsent.created_at, consent_rank)
+        .filter(PolicyConsent.user_id.in_(user_ids))
+        .subquery()
+    )
+    consents = {
+        row.user_id: row
+        for row in db.session.query(consent_sq).filter(consent_sq.c.rn == 1)
+    }
+
+    session_rank = db.func.row_number().over(
+        partition_by=Session.user_id,
+        order_by=(Session.last_message_time.desc().nullslast(), Session.id.desc()),
+    ).label("rn")
+    session_sq = (
+        db.session.query(
+            Session.user_id,
+            Session.is_active,
+            Session.last_message_time,
+            Session.current_state_id,
+            session_rank,
+        )
+        .filter(Session.user_id.in_(user_ids))
+        .subquery()
+    )
+    latest_sessions = {
+        row.user_id: row
+        for row in (
+            db.session.query(session_sq, State.state_name)
+            .outerjoin(State, State.id == session_sq.c.current_state_id)
+            .filter(session_sq.c.rn == 1)
+        )
+    }
+
+    message_rank = db.func.row_number().over(
+        partition_by=Session.user_id,
+        order_by=(Message.timestamp.desc().nullslast(), Message.id.desc()),
+    ).label("rn")
+    message_sq = (
+        db.session.query(
+            Session.user_id,
+            Message.id,
+            Message.direction,
+            Message.message_text,
+            Message.message_type,
+            Message.timestamp,
+            message_rank,
+        )
+        .join(Session, Session.id == Message.session_id)
+        .filter(Session.user_id.in_(user_ids))
+        .subquery()
+    )
+    latest_messages = {
+        row.user_id: row
+        for row in db.session.query(message_sq).filter(message_sq.c.rn == 1)
+    }
+
+    message_counts = dict(
+        db.session.query(Session.user_id, db.func.count(Message.id))
+        .join(Message, Message.session_id == Session.id)
+        .filter(Session.user_id.in_(user_ids))
+        .group_by(Session.user_id)
+        .all()
+    )
+
+    payloads = []
+
+    for user in users:
+        consent = consents.get(user.id)
+        latest_session = latest_sessions.get(user.id)
+        latest_message = latest_messages.get(user.id)
+
+        if not consent:
+            policy_status, policy_accepted, policy_date = "Pendiente", None, None
+        else:
+            policy_status = "Aceptó" if consent.accepted is True else "No aceptó"
+            policy_accepted = bool(consent.accepted)
+            policy_date = format_datetime(consent.created_at)
+
+        payload = {
+            "id": user.id,
+            "user_id": user.id,
+            "phone_number": user.phone_number,
+            "name": user.name,
+            "bot_session": user.bot_session,
+            "created_at": format_datetime(user.created_at),
+
+            "policy_status": policy_status,
+            "policy_accepted": policy_accepted,
+            "policy_date": policy_date,
+
+            "last_message_time": format_datetime(latest_session.last_message_time) if latest_session else None,
+            "current_state": latest_session.state_name if latest_session else None,
+            "is_active": bool(latest_session.is_active) if latest_session else False,
+            "total_messages": message_counts.get(user.id, 0),
+
+            "latest_message": {
+                "id": latest_message.id,
+                "direction": latest_message.direction,
+                "message_text": latest_message.message_text,
+                "message_type": latest_message.message_type,
+                "timestamp": format_datetime(latest_message.timestamp),
+            } if latest_message else None,
+        }
+
+        if compact:
+            del payload["user_id"]
+
+        payloads.append(payload)
+
+    return payloads
+
+
 @app.route("/api/crm/health", methods=["GET"])
 @crm_auth_required
 def crm_health():
@@ -1117,7 +1555,8 @@ def crm_contacts():
         .all()
     )
 
-    contacts = [build_contact_payload(user) for user in users]
+    compact = serializers.wants_compact()
+    contacts = build_contact_payloads(users, compact=compact)
 
     if policy_filter:
         if policy_filter in ["accepted", "acepto", "aceptó"]:
@@ -1136,14 +1575,13 @@ def crm_contacts():
     total = len(contacts)
     contacts_page = contacts[offset:offset + limit]
 
-    return jsonify({
+    return json_response({
         "status": "ok",
         "total": total,
         "limit": limit,
         "offset": offset,
         "contacts": contacts_page,
-        "data": contacts_page,
-    }), 200
+    }, 200, aliases={"data": "contacts"}, compact=compact)
 
 
 @app.route("/api/crm/contacts/<int:user_id>", methods=["GET"])
@@ -1157,43 +1595,42 @@ def crm_contact_detail(user_id):
             "message": "Contacto no encontrado"
         }), 404
 
-    return jsonify({
+    compact = serializers.wants_compact()
+
+    return json_response({
         "status": "ok",
-        "contact": build_contact_payload(user),
-    }), 200
+        "contact": build_contact_payloads([user], compact=compact)[0],
+    }, 200, compact=compact)
 
 
-def get_messages_payload_for_user(user_id):
-    user = User.query.get(user_id)
+def get_messages_payload_for_user(user_id, compact=False):
+    user = db.session.get(User, user_id)
 
     if not user:
         return None
 
-    messages = (
-        Message.query
+    # Solo las columnas necesarias: filas livianas en lugar de objetos ORM.
+    rows = (
+        db.session.query(
+            Message.id,
+            Message.session_id,
+            Message.direction,
+            Message.message_text,
+            Message.message_type,
+            Message.timestamp,
+            Message.media_status,
+        )
         .join(Session, Session.id == Message.session_id)
         .filter(Session.user_id == user_id)
         .order_by(Message.timestamp.asc().nullslast(), Message.id.asc())
         .all()
     )
 
-    data = []
-
-    for message in messages:
-        data.append({
-            "id": message.id,
-            "session_id": message.session_id,
-            "direction": message.direction,
-            "message_text": message.message_text,
-            "content": message.message_text,  # Alias para compatibilidad con PHP viejo
-            "message_type": message.message_type,
-            "timestamp": format_datetime(message.timestamp),
-        })
+    data = serializers.MESSAGE_ENCODER.encode_many(rows, compact=compact)
 
     return {
-        "contact": build_contact_payload(user),
+        "contact": build_contact_payloads([user], compact=compact)[0],
         "messages": data,
-        "data": data,
         "total": len(data),
     }
 
@@ -1201,7 +1638,8 @@ def get_messages_payload_for_user(user_id):
 @app.route("/api/crm/contacts/<int:user_id>/messages", methods=["GET"])
 @crm_auth_required
 def crm_contact_messages(user_id):
-    payload = get_messages_payload_for_user(user_id)
+    compact = serializers.wants_compact()
+    payload = get_messages_payload_for_user(user_id, compact=compact)
 
     if payload is None:
         return jsonify({
@@ -1209,10 +1647,10 @@ def crm_contact_messages(user_id):
             "message": "Contacto no encontrado"
         }), 404
 
-    return jsonify({
+    return json_response({
         "status": "ok",
         **payload,
-    }), 200
+    }, 200, aliases={"data": "messages"}, compact=compact)
 
 
 # Alias para evitar 404 si tu PHP quedó usando otra ruta
@@ -1228,11 +1666,39 @@ def crm_conversation_messages(user_id):
     return crm_contact_messages(user_id)
 
 
+@app.route("/api/crm/contacts/import", methods=["POST"])
+@crm_auth_required
+def crm_contacts_import():
+    """
+    Importa contactos desde un CSV: multipart (campo `file`) o el CSV crudo
+    como cuerpo (Content-Type text/csv). ?bot_session= aplica a las filas sin
+    columna bot_session. Archivos muy grandes: mejor `python contact_import.py`.
+    """
+    upload = request.files.get("file")
+    stream = upload.stream if upload else request.stream
+    bot_session = normalize_bot_session(request.args.get("bot_session") or request.form.get("bot_session"))
+
+    try:
+        summary = contact_import.import_contacts(
+            io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""),
+            bot_session,
+            phone_column=request.args.get("phone_column"),
+            name_column=request.args.get("name_column"),
+        )
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({
+            "status": "error",
+            "message": f"CSV inválido: {e}"
+        }), 400
+
+    return jsonify({"status": "ok", "bot_session": bot_session, **summary}), 200
+
+
 @app.route("/api/crm/contacts/export", methods=["GET"])
 @crm_auth_required
 def crm_contacts_export():
     users = User.query.order_by(User.created_at.desc(), User.id.desc()).all()
-    contacts = [build_contact_payload(user) for user in users]
+    contacts = build_contact_payloads(users)
 
     output = io.StringIO()
     writer = csv.writer(output)
@@ -1331,4 +1797,135 @@ def crm_contact_messages_export(user_id):
         headers={
             "Content-Disposition": f"attachment; filename={filename}"
         }
-    )
\ No newline at end of file
+    )
+
+
+# ============================================================
+# EXPORTACIONES EN SEGUNDO PLANO
+# ============================================================
+# Las exportaciones completas pueden tardar minutos: aquí solo se crea el
+# trabajo; el archivo lo genera el worker de export_jobs.py.
+
+def export_download_url(job):
+    return url_for("crm_export_download", job_id=job.id)
+
+
+@app.route("/api/crm/exports", methods=["POST"])
+@crm_auth_required
+def crm_export_create():
+    """
+    Crea un trabajo de exportación.
+
+    Body JSON:
+    - kind: contacts | messages | conversation
+    - format: csv | jsonl (por defecto csv; el archivo siempre va comprimido en gzip)
+    - bot_session: opcional
+    - from / to: requeridos para kind=messages (ISO 8601)
+    - user_id: requerido para kind=conversation
+    """
+    try:
+        kind, export_format, params = export_jobs.validate_export_request(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    if kind == "conversation" and not db.session.get(User, params["user_id"]):
+        return jsonify({
+            "status": "error",
+            "message": "Contacto no encontrado"
+        }), 404
+
+    job = export_jobs.create_export_job(kind, export_format, params)
+
+    return jsonify({
+        "status": "ok",
+        "job": export_jobs.job_to_dict(job),
+        "status_url": url_for("crm_export_status", job_id=job.id),
+    }), 202
+
+
+@app.route("/api/crm/exports/<int:job_id>", methods=["GET"])
+@crm_auth_required
+def crm_export_status(job_id):
+    job = db.session.get(export_jobs.ExportJob, job_id)
+
+    if not job:
+        return jsonify({
+            "status": "error",
+            "message": "Exportación no encontrada"
+        }), 404
+
+    return jsonify({
+        "status": "ok",
+        "job": export_jobs.job_to_dict(job, download_url=export_download_url(job)),
+    }), 200
+
+
+@app.route("/api/crm/exports/<int:job_id>/download", methods=["GET"])
+@crm_auth_required
+def crm_export_download(job_id):
+    job = db.session.get(export_jobs.ExportJob, job_id)
+
+    if not job:
+        return jsonify({
+            "status": "error",
+            "message": "Exportación no encontrada"
+        }), 404
+
+    if job.status != "done" or not job.file_path or not os.path.exists(job.file_path):
+        return jsonify({
+            "status": "error",
+            "message": "La exportación todavía no está disponible",
+            "job": export_jobs.job_to_dict(job),
+        }), 409
+
+    return send_file(
+        job.file_path,
+        mimetype="application/gzip",
+        as_attachment=True,
+        download_name=export_jobs.artifact_filename(job),
+        conditional=True,
+    )
+
+
+# ============================================================
+# MULTIMEDIA DE MENSAJES
+# ============================================================
+@app.route("/api/crm/messages/<int:message_id>/media", methods=["GET"])
+@crm_auth_required
+def crm_message_media(message_id):
+    """
+    Sirve el archivo de un mensaje multimedia. send_file con conditional=True
+    atiende Range (audio/video con seek, descargas reanudables) e
+    If-None-Match: el ETag es el SHA-256, así que el contenido nunca cambia.
+    """
+    message = db.session.get(Message, message_id)
+
+    if not message or not message.media_status:
+        return jsonify({
+            "status": "error",
+            "message": "El mensaje no tiene multimedia"
+        }), 404
+
+    asset = message.media_asset
+    path = media_store.asset_path(asset.sha256) if asset else None
+
+    if message.media_status != "ready" or not path or not os.path.exists(path):
+        return jsonify({
+            "status": "error",
+            "message": "El archivo todavía no está disponible",
+            "media_status": message.media_status,
+        }), 409
+
+    response = send_file(
+        path,
+        mimetype=asset.mime_type or "application/octet-stream",
+        download_name=message.media_filename or asset.sha256,
+        conditional=True,
+        etag=asset.sha256,
+        max_age=86400,
+    )
+    response.cache_control.private = True
+    return response
@@ -0,0 +1,122 @@
+"""
+Benchmark de la importación de contactos.
+
+Sin base de datos mide la parte en Python: leer el CSV, normalizar teléfonos
+por lote (contra normalize_delivery_phone fila por fila) y serializar los
+lotes para COPY. Con --database (Postgres) corre import_contacts completo
+dentro de una transacción que se revierte al final.
+
+Uso:
+    python benchmarks/bench_contact_import.py [--rows 1000000] [--database postgresql://...]
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import contact_import  # noqa: E402
+
+
+def make_csv(rows):
+    """CSV en disco, como llegaría al importador (no en memoria)."""
+    rng = random.Random(7)
+    formats = ["3{:09d}", "+57 3{:09d}", "57-3{:09d}", "(57) 3{:09d}", "{:05d}"]
+    fileobj = tempfile.NamedTemporaryFile("w+", encoding="utf-8", newline="", suffix=".csv")
+    writer = csv.writer(fileobj)
+    writer.writerow(["Nombre", "Teléfono", "Ciudad"])
+
+    for i in range(rows):
+        number = rng.randrange(10 ** 9) if i % 10 else i % 5000  # ~10 % repetidos
+        phone = formats[i % len(formats)].format(number)
+        writer.writerow([f"Contacto {i}", phone, "Bogotá"])
+
+    fileobj.flush()
+    return fileobj
+
+
+def to_copy_batches(source):
+    source.seek(0)
+    staged = 0
+    copy_bytes = 0
+
+    for batch, _, _ in contact_import.iter_batches(source, "alestur_ventas"):
+        staged += len(batch)
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        copy_bytes += buffer.tell()
+
+    return staged, copy_bytes
+
+
+def normalize_one_by_one(values):
+    from app import normalize_delivery_phone
+
+    return [normalize_delivery_phone(value) for value in values]
+
+
+def bench_python(rows):
+    source = make_csv(rows)
+
+    started = time.perf_counter()
+    staged, copy_bytes = to_copy_batches(source)
+    elapsed = time.perf_counter() - started
+
+    # Segunda pasada solo para el pico de memoria (tracemalloc enlentece).
+    tracemalloc.start()
+    to_copy_batches(source)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"CSV -> lotes COPY: {rows} filas en {elapsed:.2f}s "
+        f"({rows / elapsed:,.0f} filas/s), válidas={staged}, "
+        f"COPY={copy_bytes / 1e6:.1f} MB, pico memoria={peak / 1e6:.1f} MB"
+    )
+
+    values = [f"+57 3{i:09d}" for i in range(contact_import.IMPORT_BATCH_SIZE)]
+    for name, fn in [("lote (regex único)", contact_import.normalize_phone_batch), ("uno por uno", normalize_one_by_one)]:
+        started = time.perf_counter()
+        fn(values)
+        per_row = (time.perf_counter() - started) / len(values) * 1e6
+        print(f"Normalización {name:<20}{per_row:>8.2f} µs/fila")
+
+
+def bench_database(rows, url):
+    os.environ["DATABASE_URL"] = url
+    from app import app
+    from models import db
+
+    source = make_csv(rows)
+    source.seek(0)
+    with app.app_context():
+        commit = db.session.commit
+        db.session.commit = lambda: None  # se revierte al final
+        try:
+            summary = contact_import.import_contacts(source, "bench_import")
+        finally:
+            db.session.commit = commit
+            db.session.rollback()
+
+    print(f"Importación completa: {summary}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--database", default=None, help="URL de Postgres para la prueba completa")
+    args = parser.parse_args()
+
+    bench_python(args.rows)
+    if args.database:
+        bench_database(args.rows, args.database)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark del envío de documentos: CPU y memoria por envío.
+
+Compara armar el cuerpo de send-file-base64 de forma ingenua (leer el PDF,
+codificar en base64 y serializar con json.dumps en cada envío, como haría
+requests con json=) contra la caché de whatsappservice (mmap + base64 una
+vez + valor JSON preserializado). No hace llamadas HTTP.
+
+Uso:
+    python benchmarks/bench_documents.py [--sends 200]
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import util  # noqa: E402
+import whatsappservice  # noqa: E402
+
+
+NUMBER = "573001112233@c.us"
+
+
+def naive_body(path, filename):
+    with open(path, "rb") as fileobj:
+        encoded = base64.b64encode(fileobj.read()).decode("ascii")
+
+    payload = whatsappservice.build_wpp_phone_payload(NUMBER)
+    payload.update({
+        "filename": filename,
+        "caption": "Documento adjunto",
+        "base64": f"data:application/pdf;base64,{encoded}",
+    })
+    return json.dumps(payload).encode("utf-8")
+
+
+def cached_body(path, filename):
+    encoded = whatsappservice._file_cache.get(path)
+
+    payload = whatsappservice.build_wpp_phone_payload(NUMBER)
+    payload.update({"filename": filename, "caption": "Documento adjunto"})
+
+    head = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    return b"".join([head[:-1], b', "base64": ', encoded.json_value, b"}"])
+
+
+def measure(build, documents, sends):
+    cpu_started = time.process_time()
+    wall_started = time.perf_counter()
+    total_bytes = 0
+
+    for i in range(sends):
+        path, filename = documents[i % len(documents)]
+        total_bytes += len(build(path, filename))
+
+    cpu_ms = (time.process_time() - cpu_started) / sends * 1000
+    wall_ms = (time.perf_counter() - wall_started) / sends * 1000
+
+    # Pico de memoria de un envío, aparte para no inflar los tiempos.
+    path, filename = documents[0]
+    tracemalloc.start()
+    build(path, filename)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return cpu_ms, wall_ms, peak, total_bytes // sends
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sends", type=int, default=200)
+    args = parser.parse_args()
+
+    documents = [
+        (os.path.join(util.ARCHIVOS_DIR, filename), display_name)
+        for filename, display_name in util.POLICY_DOCUMENTS
+    ]
+
+    # La caché se llena una vez, como en el primer envío del proceso.
+    whatsappservice.preload_files(path for path, _ in documents)
+
+    print(f"{'variante':<12}{'CPU ms/envío':>14}{'ms/envío':>10}{'pico KiB':>12}{'cuerpo KiB':>12}")
+    for name, build in [("ingenuo", naive_body), ("caché", cached_body)]:
+        cpu_ms, wall_ms, peak, body = measure(build, documents, args.sends)
+        print(f"{name:<12}{cpu_ms:>14.3f}{wall_ms:>10.3f}{peak / 1024:>12.0f}{body / 1024:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
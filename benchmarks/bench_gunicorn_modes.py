@@ -0,0 +1,153 @@
+"""
+Benchmark de carga de gunicorn.conf.py: gthread contra gevent.
+
+Levanta gunicorn en cada modo contra una BD SQLite temporal y un WPPConnect
+falso que tarda WPP_DELAY en responder cada envío (lo que en producción
+ocupa un worker mientras espera). Dispara webhooks de clientes distintos
+en paralelo mezclados con /health y reporta rendimiento y latencias.
+
+Con SQLite los escritores se serializan (lock de archivo) y las cifras
+absolutas salen pesimistas; --database-url apunta a un Postgres de prueba
+(las tablas deben existir). El modo gevent se omite si gevent no está
+instalado.
+
+Uso:
+    python benchmarks/bench_gunicorn_modes.py [--requests 200] [--concurrency 32] [--wpp-delay 0.2]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+ROOT = harness.ROOT
+
+
+def create_database(path):
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}")
+    subprocess.run(
+        [sys.executable, "-c", "from app import app, db\nwith app.app_context(): db.create_all()"],
+        cwd=ROOT, env=env, check=True,
+    )
+
+
+def post_webhook(base_url, index):
+    body = json.dumps({
+        "event": "onmessage",
+        "session": "alestur_ventas",
+        "data": {"id": f"bench-{index}", "from": f"57300{index:07d}@c.us", "body": "hola"},
+    }).encode("utf-8")
+    request = urllib.request.Request(
+        f"{base_url}/wppconnect", data=body, headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=120) as response:
+        response.read()
+
+
+def get_health(base_url, index):
+    with urllib.request.urlopen(f"{base_url}/health", timeout=120) as response:
+        response.read()
+
+
+def timed(call, base_url, index):
+    started = time.perf_counter()
+    call(base_url, index)
+    return call.__name__, time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+def run_mode(mode, args, wpp_url, workdir):
+    database_url = args.database_url
+    if not database_url:
+        db_path = os.path.join(workdir, f"{mode}.sqlite")
+        create_database(db_path)
+        database_url = f"sqlite:///{db_path}"
+
+    port = harness.free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = {
+        "DATABASE_URL": database_url,
+        "WPPCONNECT_URL": wpp_url,
+        "WPPCONNECT_SEND_DELAY_SECONDS": "0",
+        "PHP_LEADS_API_URL": "",
+        "MEDIA_DIR": os.path.join(workdir, "media"),
+        "GUNICORN_MODE": mode,
+        "GUNICORN_WORKERS": str(args.workers),
+        "GUNICORN_THREADS": str(args.threads),
+        "GUNICORN_LOGLEVEL": "warning",
+    }
+
+    process = harness.start_gunicorn(env, port)
+
+    try:
+        calls = [
+            (get_health if i % 4 == 3 else post_webhook, i)
+            for i in range(args.requests)
+        ]
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda call: timed(call[0], base_url, call[1]), calls))
+        elapsed = time.perf_counter() - started
+
+    finally:
+        harness.stop_gunicorn(process)
+
+    webhook = [seconds for name, seconds in results if name == "post_webhook"]
+    health = [seconds for name, seconds in results if name == "get_health"]
+
+    return {
+        "mode": mode,
+        "req_per_s": round(len(results) / elapsed, 1),
+        "webhook_p50_ms": round(percentile(webhook, 0.5), 1),
+        "webhook_p95_ms": round(percentile(webhook, 0.95), 1),
+        "health_p50_ms": round(percentile(health, 0.5), 1),
+        "health_p95_ms": round(percentile(health, 0.95), 1),
+        "health_mean_ms": round(statistics.mean(health) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--wpp-delay", type=float, default=0.2)
+    parser.add_argument("--modes", default="gthread,gevent")
+    parser.add_argument("--database-url", default=None, help="Por defecto, un SQLite temporal por modo")
+    args = parser.parse_args()
+
+    wpp = harness.WppStub(latency=args.wpp_delay).start()
+    wpp_url = wpp.url
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in args.modes.split(","):
+            if mode == "gevent":
+                try:
+                    import gevent  # noqa: F401
+                except ImportError:
+                    print("gevent: omitido (no instalado)")
+                    continue
+
+            result = run_mode(mode, args, wpp_url, workdir)
+            print(" ".join(f"{key}={value}" for key, value in result.items()))
+
+    wpp.stop()
+
+
+if __name__ == "__main__":
+    main()
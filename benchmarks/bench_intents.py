@@ -0,0 +1,98 @@
+"""
+Benchmark y corpus etiquetado del reconocimiento de intenciones.
+
+Verifica cada caso de intent_corpus.json contra los vocabularios por estado
+del flujo por defecto (sale con código 1 si alguno falla) y mide el costo
+por mensaje de fold() e IntentMatcher.match() en cada camino: exacto,
+muletillas, estirado o cortado, aproximado, pregunta y sin coincidencia.
+
+Uso:
+    python benchmarks/bench_intents.py [--repeat 20000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import conversation_flow  # noqa: E402
+import intents  # noqa: E402
+
+
+def state_matchers():
+    matchers = {}
+    for state_name, spec in conversation_flow.DEFAULT_FLOW.items():
+        text_intents = [intent for intent in spec.get("intents", []) if intent in intents.VOCABULARY]
+        if text_intents:
+            matchers[state_name] = intents.build_matcher(text_intents)
+    return matchers
+
+
+def classify(matcher, text):
+    match = matcher.match(text)
+    if match is None or match.confidence < intents.INTENT_MIN_CONFIDENCE:
+        return intents.IntentMatch("*", 0.0)
+    return match
+
+
+def check_corpus(matchers):
+    with open(os.path.join(BENCH_DIR, "intent_corpus.json"), encoding="utf-8") as fh:
+        corpus = json.load(fh)
+
+    failures = 0
+    for case in corpus:
+        match = classify(matchers[case["state"]], case["text"])
+        if match.intent != case["intent"]:
+            failures += 1
+            print(f"FALLA {case['state']}: {case['text']!r} -> {match.intent} (esperado {case['intent']})")
+
+    print(f"Corpus: {len(corpus) - failures}/{len(corpus)} correctos")
+    return failures
+
+
+def per_call_us(fn, text, repeat, rounds=5):
+    """Mejor de `rounds` vueltas: el ruido de la máquina solo suma."""
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            fn(text)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / repeat * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20000)
+    args = parser.parse_args()
+
+    matchers = state_matchers()
+    failures = check_corpus(matchers)
+
+    matcher = matchers["esperando_aceptacion"]
+    cases = [
+        ("exacto ascii", "acepto"),
+        ("exacto con tildes", "Sí, acepto"),
+        ("muletillas", "ok acepto, gracias"),
+        ("estirado", "siii"),
+        ("cortado", "acept"),
+        ("aproximado", "acepyo"),
+        ("pregunta", "¿aceptas?"),
+        ("sin coincidencia", "Hola, quisiera información del paquete a San Andrés"),
+    ]
+
+    print(f"\n{'caso':<20}{'fold µs':>10}{'match µs':>10}")
+    for name, text in cases:
+        fold_us = per_call_us(intents.fold, text, args.repeat)
+        match_us = per_call_us(matcher.match, text, args.repeat)
+        print(f"{name:<20}{fold_us:>10.2f}{match_us:>10.2f}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
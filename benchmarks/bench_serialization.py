@@ -0,0 +1,198 @@
+"""
+Benchmark de serialización del CRM: tiempo de encode y bytes en el cable.
+
+Compara el armado anterior (dict campo por campo + strftime + jsonify con
+alias duplicados) contra serializers.py en modo completo y compacto, con y
+sin gzip, para una página de 500 contactos y una conversación de 10k mensajes.
+
+Uso:
+    python benchmarks/bench_serialization.py [--repeat 20]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serializers  # noqa: E402
+
+
+MessageRow = namedtuple(
+    "MessageRow",
+    ["id", "session_id", "direction", "message_text", "message_type", "timestamp", "media_status"],
+)
+
+
+def legacy_format_datetime(value):
+    if not value:
+        return None
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def legacy_dumps(payload):
+    # Equivalente a jsonify en producción: claves ordenadas y ensure_ascii.
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"))
+
+
+def make_messages(count):
+    base = datetime(2026, 1, 1, 8, 0, 0)
+    texts = [
+        "Hola, quisiera información del paquete a San Andrés",
+        "Acepto",
+        "Perfecto. Uno de nuestros Asesores se comunicará con usted",
+        "¿Cuánto cuesta para 2 adultos y un niño en temporada alta?",
+    ]
+    return [
+        MessageRow(
+            id=i + 1,
+            session_id=1 + i // 200,
+            direction="in" if i % 2 == 0 else "out",
+            message_text=texts[i % len(texts)],
+            message_type="text",
+            timestamp=base + timedelta(seconds=37 * i),
+            media_status=None,
+        )
+        for i in range(count)
+    ]
+
+
+def make_contacts(count):
+    base = datetime(2026, 1, 1, 8, 0, 0)
+    contacts = []
+
+    for i in range(count):
+        created = base + timedelta(minutes=i)
+        contacts.append({
+            "id": i + 1,
+            "phone_number": f"57300{i:07d}@c.us",
+            "name": "Contacto externo / WhatsApp",
+            "bot_session": "alestur_ventas",
+            "created_at": created,
+            "policy_accepted": i % 3 != 0,
+            "policy_date": created,
+            "last_message_time": created + timedelta(hours=2),
+            "current_state": "aceptado",
+            "is_active": True,
+            "total_messages": 12,
+            "latest_message": make_messages(1)[0],
+        })
+
+    return contacts
+
+
+def legacy_messages_payload(rows):
+    data = []
+    for message in rows:
+        data.append({
+            "id": message.id,
+            "session_id": message.session_id,
+            "direction": message.direction,
+            "message_text": message.message_text,
+            "content": message.message_text,
+            "message_type": message.message_type,
+            "timestamp": legacy_format_datetime(message.timestamp),
+        })
+    return {"status": "ok", "messages": data, "data": data, "total": len(data)}
+
+
+def contact_dict(contact, fmt, compact=False):
+    latest = contact["latest_message"]
+    payload = {
+        "id": contact["id"],
+        "user_id": contact["id"],
+        "phone_number": contact["phone_number"],
+        "name": contact["name"],
+        "bot_session": contact["bot_session"],
+        "created_at": fmt(contact["created_at"]),
+        "policy_status": "Aceptó" if contact["policy_accepted"] else "No aceptó",
+        "policy_accepted": contact["policy_accepted"],
+        "policy_date": fmt(contact["policy_date"]),
+        "last_message_time": fmt(contact["last_message_time"]),
+        "current_state": contact["current_state"],
+        "is_active": contact["is_active"],
+        "total_messages": contact["total_messages"],
+        "latest_message": {
+            "id": latest.id,
+            "direction": latest.direction,
+            "message_text": latest.message_text,
+            "message_type": latest.message_type,
+            "timestamp": fmt(latest.timestamp),
+        },
+    }
+    if compact:
+        del payload["user_id"]
+    return payload
+
+
+def legacy_contacts_payload(contacts):
+    data = [contact_dict(c, legacy_format_datetime) for c in contacts]
+    return legacy_dumps({"status": "ok", "total": len(data), "contacts": data, "data": data})
+
+
+def new_contacts_payload(contacts, compact):
+    data = [contact_dict(c, serializers.format_datetime, compact) for c in contacts]
+    payload = {"status": "ok", "total": len(data), "contacts": data}
+    if not compact:
+        payload["data"] = data
+    return serializers._json_encoder.encode(payload)
+
+
+def new_messages_payload(rows, compact):
+    data = serializers.MESSAGE_ENCODER.encode_many(rows, compact=compact)
+    payload = {"status": "ok", "messages": data, "total": len(data)}
+    if not compact:
+        payload["data"] = data
+    return serializers._json_encoder.encode(payload)
+
+
+def measure(fn, repeat):
+    best = float("inf")
+    body = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, body
+
+
+def report(title, cases, repeat):
+    print(f"\n{title}")
+    print(f"{'variante':<22}{'encode ms':>12}{'bytes':>12}{'gzip bytes':>12}{'gzip ms':>10}")
+
+    for name, fn in cases:
+        seconds, body = measure(fn, repeat)
+        raw = body.encode("utf-8") if isinstance(body, str) else body
+        gz_started = time.perf_counter()
+        compressed = gzip.compress(raw, compresslevel=serializers.COMPRESS_LEVEL)
+        gz_ms = (time.perf_counter() - gz_started) * 1000
+        print(f"{name:<22}{seconds * 1000:>12.2f}{len(raw):>12}{len(compressed):>12}{gz_ms:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    contacts = make_contacts(500)
+    messages = make_messages(10_000)
+
+    report("Página de 500 contactos", [
+        ("anterior (jsonify)", lambda: legacy_contacts_payload(contacts)),
+        ("nuevo completo", lambda: new_contacts_payload(contacts, compact=False)),
+        ("nuevo compacto", lambda: new_contacts_payload(contacts, compact=True)),
+    ], args.repeat)
+
+    report("Conversación de 10k mensajes", [
+        ("anterior (jsonify)", lambda: legacy_dumps(legacy_messages_payload(messages))),
+        ("nuevo completo", lambda: new_messages_payload(messages, compact=False)),
+        ("nuevo compacto", lambda: new_messages_payload(messages, compact=True)),
+    ], args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Presupuesto de consultas SQL de los endpoints calientes.
+
+Carga una BD SQLite temporal con CONTACTS contactos (sesiones, mensajes y
+consentimientos) y ejecuta cada endpoint dentro de sql_profiler.max_queries:
+el número de consultas no debe crecer con la cantidad de contactos ni
+repetir una misma forma (N+1). Los envíos a WPPConnect se reemplazan por
+una función local y la cola outbound_messages se drena en la petición
+(SESSION_QUEUES_ENABLED=false);
+los leads solo se encolan (los envía php_leads_service). Sale con código 1
+si algún presupuesto se supera.
+
+Uso:
+    python benchmarks/check_query_budgets.py [--contacts 50] [-v]
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_workdir = tempfile.mkdtemp(prefix="query_budgets_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_workdir, 'db.sqlite')}"
+os.environ["CRM_API_TOKEN"] = "budget-token"
+# Los envíos corren en la petición, así se cuentan sus consultas.
+os.environ["SESSION_QUEUES_ENABLED"] = "false"
+
+from datetime import datetime, timedelta, timezone  # noqa: E402
+
+import app as chatbot  # noqa: E402
+import sql_profiler  # noqa: E402
+import whatsappservice  # noqa: E402
+from models import db, User, Session, Message, PolicyConsent  # noqa: E402
+
+
+CRM_HEADERS = {"Authorization": "Bearer budget-token"}
+
+# (nombre, método, ruta, cuerpo, máx. consultas, máx. repeticiones de una forma)
+# Los webhooks con respuesta incluyen la cola outbound_messages: insertar los
+# envíos, tomarlos, marcar cada uno como enviado y releer la cola al final.
+BUDGETS = [
+    ("webhook contacto nuevo", "POST", "/wppconnect", "nuevo", 25, 3),
+    # Incluye encolar el lead (lead_outbox) en la misma transacción.
+    ("webhook acepta política", "POST", "/wppconnect", "acepta", 21, 4),
+    ("webhook asesor (aceptado)", "POST", "/wppconnect", "aceptado", 10, 2),
+    ("crm contactos", "GET", "/api/crm/contacts", None, 6, 1),
+    ("crm contacto", "GET", "/api/crm/contacts/{user_id}", None, 6, 1),
+    ("crm mensajes", "GET", "/api/crm/contacts/{user_id}/messages", None, 7, 1),
+    ("sesiones activas", "GET", "/sessions/active", None, 3, 1),
+]
+
+
+def seed(contacts):
+    now = datetime.now(timezone.utc)
+    waiting = chatbot.get_or_create_state("esperando_aceptacion").id
+    accepted = chatbot.get_or_create_state("aceptado").id
+
+    for i in range(contacts):
+        user = User(phone_number=f"57301{i:07d}@c.us", bot_session="alestur_ventas", name=f"Cliente {i}")
+        db.session.add(user)
+        db.session.flush()
+
+        session = Session(
+            user_id=user.id,
+            is_active=True,
+            current_state_id=accepted if i % 2 else waiting,
+            start_time=now - timedelta(minutes=i),
+            last_message_time=now - timedelta(minutes=i),
+        )
+        db.session.add(session)
+        db.session.flush()
+
+        for j in range(5):
+            db.session.add(Message(
+                session_id=session.id,
+                direction="in" if j % 2 else "out",
+                message_text=f"mensaje {j}",
+                message_type="text",
+                timestamp=now - timedelta(minutes=i, seconds=j),
+            ))
+
+        if i % 2:
+            db.session.add(PolicyConsent(user_id=user.id, session_id=session.id, accepted=True))
+
+    db.session.commit()
+
+
+def webhook_body(kind, index):
+    number, text = {
+        "nuevo": (f"57309{index:07d}@c.us", "hola"),
+        "acepta": ("573010000000@c.us", "acepto"),
+        "aceptado": ("573010000001@c.us", "tengo una pregunta"),
+    }[kind]
+    return {
+        "event": "onmessage",
+        "session": "alestur_ventas",
+        "data": {"id": f"budget-{kind}-{index}", "from": number, "body": text},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Presupuesto de consultas de los endpoints calientes")
+    parser.add_argument("--contacts", type=int, default=50)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    whatsappservice.SendMessageWhatsapp = lambda data, session_name=None: True
+
+    client = chatbot.app.test_client()
+
+    with chatbot.app.app_context():
+        db.create_all()
+        chatbot.seed_default_states()
+        seed(args.contacts)
+        user_id = db.session.query(db.func.min(User.id)).scalar()
+        # Caché de estados y flujo compilado, como en un worker ya precalentado.
+        chatbot.warm_up()
+
+    failures = 0
+
+    for index, (name, method, path, body, limit, duplicates) in enumerate(BUDGETS):
+        path = path.format(user_id=user_id)
+
+        try:
+            with sql_profiler.max_queries(limit, max_duplicates=duplicates) as profile:
+                if method == "POST":
+                    response = client.post(path, json=webhook_body(body, index))
+                else:
+                    response = client.get(path, headers=CRM_HEADERS)
+
+            status = "ok" if response.status_code < 400 else f"HTTP {response.status_code}"
+            if response.status_code >= 400:
+                failures += 1
+            print(f"{status:8} {name:28} consultas={profile.count:3}/{limit} tiempo_bd={profile.seconds * 1000:.1f} ms")
+            if args.verbose:
+                print(profile.report())
+
+        except sql_profiler.QueryBudgetExceeded as e:
+            failures += 1
+            print(f"{'EXCEDE':8} {name:28} {e}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Piezas compartidas de los benchmarks de carga: servidores falsos de
+WPPConnect y de la API PHP de leads, y el arranque de gunicorn con
+gunicorn.conf.py en un puerto libre.
+"""
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class _StubServer:
+    """ThreadingHTTPServer en un hilo, con conteo de llamadas por ruta."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def handle(self, handler, path, body):
+        raise NotImplementedError
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status, payload = stub.handle(self, self.path, body)
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", free_port()), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class WppStub(_StubServer):
+    """
+    WPPConnect falso: tarda `latency` segundos (con jitter de ±25 %),
+    responde 500 con probabilidad `failure_rate` y 200 con ack=-1 (WhatsApp
+    no entregó) con probabilidad `nack_rate`.
+    """
+
+    def __init__(self, latency=0.05, failure_rate=0.0, nack_rate=0.0, seed=None):
+        super().__init__()
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.nack_rate = nack_rate
+        self.random = random.Random(seed)
+
+    def handle(self, handler, path, body):
+        # /api/<sesión>/<endpoint>
+        endpoint = path.rstrip("/").rsplit("/", 1)[-1]
+
+        with self.lock:
+            roll = self.random.random()
+            jitter = self.random.uniform(0.75, 1.25)
+
+        if self.latency:
+            time.sleep(self.latency * jitter)
+
+        if roll < self.failure_rate:
+            self.count(f"{endpoint}:500")
+            return 500, {"status": "error", "message": "stub failure"}
+
+        if roll < self.failure_rate + self.nack_rate:
+            self.count(f"{endpoint}:nack")
+            return 200, {"status": "success", "response": [{"ack": -1, "isSendFailure": True}]}
+
+        self.count(f"{endpoint}:ok")
+        return 201, {"status": "success", "response": [{"ack": 1, "id": f"stub-{time.monotonic_ns()}"}]}
+
+    def total(self):
+        return sum(self.counts.values())
+
+
+class PhpStub(_StubServer):
+    """API PHP de leads falsa: 200 tras `latency` segundos."""
+
+    def __init__(self, latency=0.02):
+        super().__init__()
+        self.latency = latency
+
+    def handle(self, handler, path, body):
+        if self.latency:
+            time.sleep(self.latency)
+        self.count("leads")
+        return 200, {"status": "ok"}
+
+
+def wait_ready(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{base_url}/health", timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn no respondió a /health")
+
+
+def start_gunicorn(env, port, log_path=os.devnull):
+    """Arranca gunicorn con gunicorn.conf.py y espera /health. Devuelve el Popen."""
+    env = dict(os.environ, GUNICORN_BIND=f"127.0.0.1:{port}", **env)
+    log = open(log_path, "ab")
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "app:app"],
+        cwd=ROOT, env=env, stdout=log, stderr=log,
+    )
+    log.close()
+
+    try:
+        wait_ready(f"http://127.0.0.1:{port}")
+    except RuntimeError:
+        process.terminate()
+        raise
+
+    return process
+
+
+def stop_gunicorn(process):
+    process.terminate()
+    process.wait(timeout=60)
+
+
+def scrape_metrics(base_url):
+    """{(nombre, etiquetas ordenadas): valor} de /metrics."""
+    with urllib.request.urlopen(f"{base_url}/metrics", timeout=10) as response:
+        text = response.read().decode("utf-8")
+
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+
+        name_labels, value = line.rsplit(" ", 1)
+        if "{" in name_labels:
+            name, labels = name_labels.split("{", 1)
+            labels = tuple(sorted(
+                tuple(part.split("=", 1)) for part in labels.rstrip("}").replace('"', "").split(",") if part
+            ))
+        else:
+            name, labels = name_labels, ()
+
+        samples[(name, labels)] = float(value)
+
+    return samples
+
+
+def metric_sum(samples, name, **labels):
+    wanted = set(labels.items())
+    return sum(
+        value for (sample_name, sample_labels), value in samples.items()
+        if sample_name == name and wanted <= set(sample_labels)
+    )
@@ -0,0 +1,287 @@
+"""
+Micro-benchmarks de las funciones puras que corren con cada mensaje.
+
+Cada caso recorre las entradas de micro_fixtures.json (JID @c.us y @lid,
+grupos, ACKs, lotes, multimedia y cuerpos malformados) y mide:
+
+- ns por llamada: mínimo de varias repeticiones de timeit, en ROUNDS rondas
+  que recorren todos los casos (el ruido de otros procesos solo suma
+  tiempo, así que el mínimo es la medida estable).
+- bytes de pico por llamada: memoria temporal máxima (tracemalloc) de una
+  pasada, dividida por el número de entradas.
+
+Los tiempos se guardan relativos a un lazo de calibración en Python puro,
+medido antes de cada caso (la unidad es el mínimo del proceso): la línea base de
+micro_baseline.json sirve en otra máquina mientras el intérprete sea el
+mismo. Entre procesos el tiempo varía más que dentro de uno (disposición
+de memoria, núcleo asignado), así que cada medición corre en PROCESSES
+intérpretes nuevos con PYTHONHASHSEED fijo y, de ambos lados (línea base
+y comprobación), se toma el mejor proceso. Un caso es regresión si su
+tiempo calibrado o sus bytes superan la línea base en más de --threshold
+(25 % por defecto); en ese caso sale con código 1. Los casos de menos de
+SMALL_CASE_NS por llamada varían más que eso entre procesos aun tomando el
+mínimo: su tiempo se compara con SMALL_CASE_THRESHOLD.
+
+Uso:
+    python benchmarks/micro.py                    # compara con la línea base
+    python benchmarks/micro.py --update-baseline  # reescribe la línea base
+    python benchmarks/micro.py -k intent          # solo los casos que contienen "intent"
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+# Los logs de debug de las funciones medidas se descartan por nivel, como en
+# producción, y no se mezclan con el JSON que cada proceso escribe en stdout.
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+import app as chatbot  # noqa: E402
+import conversation_flow  # noqa: E402
+import intents  # noqa: E402
+import util  # noqa: E402
+import whatsappservice  # noqa: E402
+
+FIXTURES_PATH = os.path.join(HERE, "micro_fixtures.json")
+BASELINE_PATH = os.path.join(HERE, "micro_baseline.json")
+
+REPEAT = 5
+ROUNDS = 2
+PROCESSES = 3
+# Los bytes de pico son chicos y se redondean; debajo de esto no se comparan.
+MIN_BYTES_TO_COMPARE = 64
+# Casos de menos de 1 µs por llamada: +35/+44 % entre corridas sin cambios.
+SMALL_CASE_NS = 1000
+SMALL_CASE_THRESHOLD = 0.6
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+        self.text = json.dumps(body) if body is not None else "<html>error</html>"
+
+    def json(self):
+        if self._body is None:
+            raise ValueError("respuesta sin JSON")
+        return self._body
+
+
+def calibration():
+    """Trabajo fijo en Python puro (dicts, strings, lazos): unidad de tiempo."""
+    data = {f"k{i}": i for i in range(64)}
+    total = 0
+    for key, value in data.items():
+        total += len(key.upper()) + value
+    return total
+
+
+def build_cases(fixtures):
+    phones = fixtures["phones"]
+    webhooks = fixtures["webhooks"]
+    responses = [FakeResponse(status, body) for status, body in fixtures["wpp_responses"]]
+
+    matchers = {
+        state: conversation_flow.DEFAULT_FLOW[state]["intents"]
+        for state in fixtures["intent_texts"]
+    }
+    matchers = {state: intents.build_matcher(names) for state, names in matchers.items()}
+    intent_inputs = [
+        (matchers[state], text)
+        for state, texts in fixtures["intent_texts"].items()
+        for text in texts
+    ]
+
+    def wpp_items():
+        for body in webhooks:
+            for data, event_body in chatbot.iter_wppconnect_items(body):
+                yield data, event_body
+
+    items = list(wpp_items())
+
+    return {
+        # nombre: (función de una entrada, entradas)
+        "extract_wppconnect_messages": (chatbot.extract_wppconnect_messages, webhooks),
+        "extract_wppconnect_item": (lambda pair: chatbot.extract_wppconnect_item(*pair), items),
+        "group_by_conversation": (
+            lambda body: chatbot.group_by_conversation(chatbot.extract_wppconnect_messages(body)),
+            webhooks,
+        ),
+        "normalize_delivery_phone": (chatbot.normalize_delivery_phone, phones),
+        "normalize_wpp_number": (chatbot.normalize_wpp_number, phones),
+        "build_wpp_phone_payload": (whatsappservice.build_wpp_phone_payload, phones),
+        "interactive_to_text": (whatsappservice._interactive_to_text, fixtures["interactive_messages"]),
+        "wpp_response_was_delivered": (whatsappservice._wpp_response_was_delivered, responses),
+        "util_get_text_user": (util.GetTextUser, fixtures["meta_messages"]),
+        "intent_fold": (intents.fold, [text for _, text in intent_inputs]),
+        "intent_match": (lambda pair: pair[0].match(pair[1]), intent_inputs),
+    }
+
+
+def measure(function, inputs):
+    def one_pass():
+        for value in inputs:
+            function(value)
+
+    timer = timeit.Timer(one_pass)
+    number, _ = timer.autorange()
+    # autorange apunta a 0.2 s por repetición; con rondas y procesos alcanza menos.
+    number = max(1, number // 8)
+    best = min(timer.repeat(repeat=REPEAT, number=number)) / number
+
+    tracemalloc.start()
+    try:
+        one_pass()
+        tracemalloc.reset_peak()
+        baseline_memory = tracemalloc.get_traced_memory()[0]
+        one_pass()
+        peak = tracemalloc.get_traced_memory()[1] - baseline_memory
+    finally:
+        tracemalloc.stop()
+
+    calls = max(len(inputs), 1)
+    return best / calls * 1e9, max(peak, 0) // calls
+
+
+def run(selected, rounds=ROUNDS):
+    with open(FIXTURES_PATH, encoding="utf-8") as fileobj:
+        fixtures = json.load(fileobj)
+
+    cases = build_cases(fixtures)
+
+    calibrations = []
+    measured = {}
+
+    for _ in range(rounds):
+        for name, (function, inputs) in cases.items():
+            if selected and selected not in name:
+                continue
+            calibration_ns, _ = measure(lambda _: calibration(), [None])
+            calibrations.append(calibration_ns)
+
+            ns, peak_bytes = measure(function, inputs)
+            best = measured.get(name)
+            if best is None or ns < best[0]:
+                measured[name] = (ns, peak_bytes)
+
+    # Mínimo contra mínimo: el cociente de dos mínimos varía menos que el de
+    # cada caso con la calibración medida justo antes.
+    calibration_ns = min(calibrations, default=0.0)
+    results = {
+        name: {
+            "ns_per_call": round(ns, 1),
+            "relative": round(ns / calibration_ns, 5),
+            "peak_bytes_per_call": int(peak_bytes),
+        }
+        for name, (ns, peak_bytes) in measured.items()
+    }
+    return calibration_ns, results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+
+    print(f"{'caso':32} {'ns/llamada':>12} {'relativo':>10} {'base':>10} {'bytes':>8} {'base':>8}")
+    for name, result in results.items():
+        base = baseline.get("cases", {}).get(name)
+        flags = []
+
+        if base:
+            time_threshold = max(threshold, SMALL_CASE_THRESHOLD) if base["ns_per_call"] < SMALL_CASE_NS else threshold
+            if result["relative"] > base["relative"] * (1 + time_threshold):
+                flags.append(f"tiempo +{(result['relative'] / base['relative'] - 1) * 100:.0f}%")
+            base_bytes = base["peak_bytes_per_call"]
+            if max(base_bytes, result["peak_bytes_per_call"]) >= MIN_BYTES_TO_COMPARE and (
+                result["peak_bytes_per_call"] > base_bytes * (1 + threshold)
+            ):
+                flags.append(f"memoria +{result['peak_bytes_per_call'] - base_bytes} B")
+
+        print(
+            f"{name:32} {result['ns_per_call']:12.1f} {result['relative']:10.4f} "
+            f"{base['relative'] if base else '-':>10} {result['peak_bytes_per_call']:8} "
+            f"{base['peak_bytes_per_call'] if base else '-':>8}"
+            + (f"  ⚠️ {', '.join(flags)}" if flags else "")
+        )
+        if flags:
+            regressions.append(name)
+
+    return regressions
+
+
+def measure_in_processes(args):
+    """Por caso, el mejor de PROCESSES intérpretes nuevos."""
+    command = [sys.executable, os.path.abspath(__file__), "--json", "--rounds", str(args.rounds)]
+    if args.selected:
+        command += ["-k", args.selected]
+
+    runs = [
+        json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout)
+        for _ in range(PROCESSES)
+    ]
+    results = {}
+    for name in runs[0]["cases"]:
+        results[name] = min((run["cases"][name] for run in runs), key=lambda item: item["relative"])
+
+    calibration_ns = statistics.median(run["calibration_ns"] for run in runs)
+    return calibration_ns, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks de las funciones por mensaje")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--rounds", type=int, default=ROUNDS)
+    parser.add_argument("-k", dest="selected", default=None, help="Solo casos cuyo nombre contenga este texto")
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if os.environ.get("PYTHONHASHSEED") != "0":
+        # Mismo orden de dicts y sets en cada corrida.
+        os.execve(sys.executable, [sys.executable] + sys.argv, dict(os.environ, PYTHONHASHSEED="0"))
+
+    if args.json:
+        calibration_ns, results = run(args.selected, args.rounds)
+        print(json.dumps({"calibration_ns": calibration_ns, "cases": results}))
+        return
+
+    if args.update_baseline:
+        calibration_ns, results = measure_in_processes(args)
+        baseline = {"python": platform.python_version(), "calibration_ns": round(calibration_ns, 1), "cases": {}}
+        if os.path.exists(BASELINE_PATH) and args.selected:
+            with open(BASELINE_PATH, encoding="utf-8") as fileobj:
+                baseline["cases"] = json.load(fileobj).get("cases", {})
+        baseline["cases"].update(results)
+
+        with open(BASELINE_PATH, "w", encoding="utf-8") as fileobj:
+            json.dump(baseline, fileobj, indent=2, sort_keys=True)
+            fileobj.write("\n")
+        print(f"Línea base actualizada: {len(results)} casos ({BASELINE_PATH})")
+        return
+
+    if not os.path.exists(BASELINE_PATH):
+        print("No hay línea base: correr con --update-baseline")
+        sys.exit(1)
+
+    with open(BASELINE_PATH, encoding="utf-8") as fileobj:
+        baseline = json.load(fileobj)
+
+    calibration_ns, results = measure_in_processes(args)
+
+    print(f"calibración={calibration_ns:.0f} ns (base {baseline['calibration_ns']:.0f} ns, python {baseline['python']})")
+    regressions = compare(results, baseline, args.threshold)
+
+    if regressions:
+        print(f"Regresiones (> {args.threshold:.0%}): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
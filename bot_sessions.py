@@ -0,0 +1,331 @@
+"""
+Registro de sesiones de bot (cada número de WhatsApp en WPPConnect) y sus
+carriles de envío.
+
+Registro: la configuración de cada sesión se lee una vez por proceso.
+WPPCONNECT_SESSIONS lista las conocidas (la por defecto siempre está); una
+sesión que aparece en un webhook sin estar listada se carga con los
+valores por defecto la primera vez. Por sesión, con el nombre en
+mayúsculas y lo no alfanumérico como "_" (alestur_ventas ->
+ALESTUR_VENTAS):
+
+    WPPCONNECT_TOKEN_<SESIÓN>               token (si no, WPPCONNECT_TOKEN)
+    WPPCONNECT_SEND_DELAY_SECONDS_<SESIÓN>  ritmo entre envíos (de la sesión, sumando
+                                            todos los procesos; ver whatsappservice)
+    WPPCONNECT_CONCURRENCY_<SESIÓN>         carriles (hilos) de envío
+    WPPCONNECT_QUEUE_SIZE_<SESIÓN>          trabajos en cola por sesión
+    WPPCONNECT_FLOW_<SESIÓN>                flujo de conversation_flow
+
+Carriles: el webhook confirma la conversación y sus envíos en BD
+(outbound_messages, ver outbound.py) y encola en el carril del contacto
+un trabajo que los drena; cada sesión tiene sus propios hilos, así un
+número lento o desconectado acumula cola solo en sus carriles y no ocupa
+los hilos de gunicorn que atienden a los demás. Cada contacto cae siempre
+en el mismo carril (hash del número) y un contacto que ya espera en el
+carril no se vuelve a encolar: su trabajo pendiente toma también los
+envíos nuevos. Si la cola sigue llena pasados
+SESSION_QUEUE_PUT_TIMEOUT_SECONDS, los envíos esperan en la tabla detrás
+de los anteriores del contacto y los retoma el barrido de outbound.py.
+SESSION_QUEUES_ENABLED=false los drena en la petición; lo que ya no entra
+en su presupuesto (request_deadline) pasa al carril con defer(), sin
+esperar lugar.
+
+Pausa: session_health pausa los carriles de una sesión que el scheduler
+vio desconectada de WhatsApp Web (wpp_session_status); sus envíos quedan
+pendientes (no fallan) y al reconectar salen al ritmo send_delay_seconds
+de la sesión.
+
+Los carriles son por proceso (se crean al primer envío después del fork)
+y gunicorn.conf.py los drena en worker_exit; lo que no alcanza a salir
+sigue en outbound_messages para otro worker. Profundidad, espera y
+duración por sesión salen en /metrics (alestur_session_*).
+"""
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+import logs
+import metrics
+import tracing
+
+
+DEFAULT_SESSION = (
+    os.getenv("WPPCONNECT_SESSION") or os.getenv("WPPCONNECT_DEFAULT_SESSION") or "alestur_ventas"
+).strip() or "alestur_ventas"
+DEFAULT_TOKEN = os.getenv("WPPCONNECT_TOKEN", "")
+DEFAULT_SEND_DELAY_SECONDS = float(os.getenv("WPPCONNECT_SEND_DELAY_SECONDS", "1.2"))
+DEFAULT_CONCURRENCY = int(os.getenv("WPPCONNECT_CONCURRENCY", "2"))
+DEFAULT_QUEUE_SIZE = int(os.getenv("WPPCONNECT_QUEUE_SIZE", "200"))
+
+SESSION_QUEUES_ENABLED = os.getenv("SESSION_QUEUES_ENABLED", "true").lower() == "true"
+SESSION_QUEUE_PUT_TIMEOUT_SECONDS = float(os.getenv("SESSION_QUEUE_PUT_TIMEOUT_SECONDS", "2"))
+
+log = logs.get_logger("sessions")
+
+BotSession = namedtuple(
+    "BotSession",
+    ["name", "token", "send_delay_seconds", "concurrency", "queue_size", "flow"],
+)
+
+
+# ============================================================
+# REGISTRO
+# ============================================================
+def env_suffix(session_name):
+    return "".join(ch if ch.isalnum() else "_" for ch in str(session_name).upper())
+
+
+def _load(name):
+    suffix = env_suffix(name)
+
+    def setting(prefix, default, cast=str):
+        value = os.getenv(f"{prefix}_{suffix}", "").strip()
+        return cast(value) if value else default
+
+    return BotSession(
+        name=name,
+        token=setting("WPPCONNECT_TOKEN", DEFAULT_TOKEN),
+        send_delay_seconds=setting("WPPCONNECT_SEND_DELAY_SECONDS", DEFAULT_SEND_DELAY_SECONDS, float),
+        concurrency=max(1, setting("WPPCONNECT_CONCURRENCY", DEFAULT_CONCURRENCY, int)),
+        queue_size=max(1, setting("WPPCONNECT_QUEUE_SIZE", DEFAULT_QUEUE_SIZE, int)),
+        flow=setting("WPPCONNECT_FLOW", name),
+    )
+
+
+_registry_lock = threading.Lock()
+_registry = {
+    name: _load(name)
+    for name in dict.fromkeys(
+        [DEFAULT_SESSION]
+        + [name.strip() for name in os.getenv("WPPCONNECT_SESSIONS", "").split(",") if name.strip()]
+    )
+}
+
+
+def normalize(session_name):
+    return (session_name or "").strip() or DEFAULT_SESSION
+
+
+def get(session_name=None):
+    name = normalize(session_name)
+    config = _registry.get(name)
+    if config is None:
+        with _registry_lock:
+            config = _registry.get(name)
+            if config is None:
+                config = _registry[name] = _load(name)
+    return config
+
+
+def names():
+    return list(_registry)
+
+
+# ============================================================
+# PAUSA
+# ============================================================
+_gates = {}
+_gates_lock = threading.Lock()
+
+
+def _gate(session_name):
+    """Event por sesión: puesto mientras la sesión puede enviar."""
+    name = normalize(session_name)
+    gate = _gates.get(name)
+    if gate is None:
+        with _gates_lock:
+            gate = _gates.get(name)
+            if gate is None:
+                gate = _gates[name] = threading.Event()
+                gate.set()
+    return gate
+
+
+def pause(session_name):
+    """Los carriles de la sesión retienen sus trabajos hasta resume()."""
+    _gate(session_name).clear()
+
+
+def resume(session_name):
+    _gate(session_name).set()
+
+
+def is_paused(session_name):
+    return not _gate(session_name).is_set()
+
+
+# ============================================================
+# CARRILES
+# ============================================================
+class _SessionLanes:
+    """
+    `concurrency` hilos de una sesión, cada uno con su cola acotada. Una
+    clave espera a lo sumo una vez en su cola: los trabajos son drenados
+    idempotentes del contacto.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        lane_size = max(1, config.queue_size // config.concurrency)
+        self.lanes = [queue.Queue(maxsize=lane_size) for _ in range(config.concurrency)]
+        self.waiting = set()
+        self.running = 0
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._run, args=(lane,), name=f"session-{config.name}-{index}", daemon=True)
+            for index, lane in enumerate(self.lanes)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, job, timeout, traceparent):
+        with self.lock:
+            if key in self.waiting:
+                return True
+            self.waiting.add(key)
+
+        lane = self.lanes[zlib.crc32(str(key).encode("utf-8")) % len(self.lanes)]
+        metrics.SESSION_QUEUE_DEPTH.labels(self.config.name).inc()
+        try:
+            lane.put((time.monotonic(), traceparent, key, job), timeout=timeout)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.waiting.discard(key)
+            metrics.SESSION_QUEUE_DEPTH.labels(self.config.name).dec()
+            return False
+
+    def _run(self, lane):
+        name = self.config.name
+        gate = _gate(name)
+        while True:
+            # Sesión pausada: los trabajos esperan en la cola.
+            while not gate.wait(1.0):
+                if self.stopping:
+                    return
+
+            item = lane.get()
+            if item is None:
+                return
+
+            enqueued_at, traceparent, key, job = item
+            started = time.monotonic()
+            metrics.SESSION_QUEUE_WAIT_SECONDS.labels(name).observe(started - enqueued_at)
+
+            with self.lock:
+                # Lo que llegue desde ahora vuelve a encolar la clave.
+                self.waiting.discard(key)
+                self.running += 1
+            try:
+                with tracing.start_trace("session.outbound", traceparent, tracing.KIND_INTERNAL, **{"wpp.session": name}):
+                    job()
+            except Exception as e:
+                log.error("❌ Error en el carril de envíos", session=name, error=repr(e), exc_info=True)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                metrics.SESSION_QUEUE_DEPTH.labels(name).dec()
+                metrics.SESSION_JOB_SECONDS.labels(name).observe(time.monotonic() - started)
+
+    def depth(self):
+        return sum(lane.qsize() for lane in self.lanes)
+
+    def stop(self, deadline):
+        self.stopping = True
+        for lane in self.lanes:
+            try:
+                lane.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+
+_lanes = {}
+_lanes_pid = None
+_lanes_lock = threading.Lock()
+
+
+def _lanes_for(session_name):
+    global _lanes_pid
+
+    name = normalize(session_name)
+    if _lanes_pid == os.getpid() and name in _lanes:
+        return _lanes[name]
+
+    with _lanes_lock:
+        # Los hilos del proceso padre no existen tras el fork.
+        if _lanes_pid != os.getpid():
+            _lanes.clear()
+            _lanes_pid = os.getpid()
+        lanes = _lanes.get(name)
+        if lanes is None:
+            lanes = _lanes[name] = _SessionLanes(get(name))
+        return lanes
+
+
+def _submit(session_name, key, job, timeout):
+    lanes = _lanes_for(session_name)
+    if lanes.submit(key, job, max(0.0, timeout), tracing.traceparent()):
+        return True
+
+    metrics.SESSION_QUEUE_OVERFLOWS.labels(lanes.config.name).inc()
+    log.warning("⚠️ Cola de la sesión llena: los envíos esperan al barrido", session=lanes.config.name)
+    return False
+
+
+def submit(session_name, key, job, timeout=SESSION_QUEUE_PUT_TIMEOUT_SECONDS):
+    """
+    Encola job (sin argumentos) en el carril de `key` dentro de la sesión,
+    salvo que `key` ya esté esperando en él. Devuelve False si las colas
+    están desactivadas o siguen llenas pasados `timeout` segundos.
+    """
+    if not SESSION_QUEUES_ENABLED:
+        return False
+    return _submit(session_name, key, job, timeout)
+
+
+def defer(session_name, key, job):
+    """
+    Como submit, pero sin esperar lugar en el carril (trabajo que no entra
+    en el presupuesto de la petición, barrido de outbound.py) y aunque
+    SESSION_QUEUES_ENABLED=false. Devuelve False si la cola está llena: los
+    envíos siguen en outbound_messages y los retoma el barrido.
+    """
+    return _submit(session_name, key, job, 0)
+
+
+def stats():
+    """Por sesión: contactos en cola y trabajos en curso de este proceso."""
+    if _lanes_pid != os.getpid():
+        return {}
+    return {
+        name: {"queued": lanes.depth(), "running": lanes.running, "paused": is_paused(name)}
+        for name, lanes in list(_lanes.items())
+    }
+
+
+def shutdown(timeout=25):
+    """
+    Drena las colas de este proceso hasta `timeout`. Lo que no alcanza a
+    salir (p. ej. una sesión pausada) sigue en outbound_messages y lo toma
+    el barrido de otro worker.
+    """
+    if _lanes_pid != os.getpid():
+        return
+
+    deadline = time.monotonic() + timeout
+    for lanes in list(_lanes.values()):
+        lanes.stop(deadline)
+
+    left = {
+        name: {"contacts": lanes.depth(), "paused": is_paused(name)}
+        for name, lanes in _lanes.items()
+        if lanes.depth()
+    }
+    if left:
+        log.warning("⚠️ Contactos sin drenar al salir: sus envíos quedan pendientes en BD", pending=left)
@@ -11,4 +11,21 @@ DB_PORT = os.getenv("DB_PORT", "5432")
 SQLALCHEMY_DATABASE_URI = DATABASE_URL or f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Pool por proceso, según su rol. Los workers de un hilo (scheduler,
+# exports, media, leads) usan este valor chico; gunicorn.conf.py fija el de
+# la web antes de cargar la app (una conexión por hilo más desborde para los
+# carriles de envío de bot_sessions). El total frente a max_connections de
+# Postgres está en docker-compose.yml.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "2"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "2"))
+
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_pre_ping": True,
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800")),
+}
+
+# SQLite en memoria (scripts, benchmarks) usa StaticPool, que no acepta tamaño.
+if not SQLALCHEMY_DATABASE_URI.startswith("sqlite"):
+    SQLALCHEMY_ENGINE_OPTIONS.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+
 SECRET_KEY = os.getenv("SECRET_KEY", "superpassword")
@@ -0,0 +1,289 @@
+"""
+Importación masiva de contactos (leads de otros canales) a `users`.
+
+El CSV se lee en streaming y por lotes de IMPORT_BATCH_SIZE filas: cada lote
+normaliza sus teléfonos de una vez (un solo regex sobre el lote unido, no
+uno por valor) y se carga con COPY a una tabla temporal. Al final, un único
+INSERT ... ON CONFLICT mezcla la tabla temporal con `users`: descarta
+repetidos del archivo y pares (phone_number, bot_session) ya existentes, y
+completa el nombre de contactos que no lo tenían. La memoria no depende del
+tamaño del archivo.
+
+Uso:
+    python contact_import.py leads.csv [--bot-session alestur_ventas]
+"""
+import argparse
+import csv
+import io
+import os
+import re
+import time
+import unicodedata
+
+from sqlalchemy import text
+
+import logs
+from models import db
+
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "20000"))
+
+log = logs.get_logger("import")
+
+PHONE_COLUMNS = ["phone_number", "phone", "telefono", "celular", "movil", "whatsapp", "numero"]
+NAME_COLUMNS = ["name", "nombre", "nombre_completo", "full_name"]
+SESSION_COLUMNS = ["bot_session", "sesion", "session"]
+
+STAGING_TABLE = "contact_import_staging"
+
+_NON_DIGIT = re.compile(r"[^\d\n]+")
+
+
+# ============================================================
+# NORMALIZACIÓN POR LOTES
+# ============================================================
+def normalize_phone_batch(values):
+    """
+    Mismas reglas que app.normalize_delivery_phone, para un lote completo.
+    Devuelve una lista alineada con `values`: JID "<digitos>@c.us" o None.
+    """
+    joined = "\n".join(value or "" for value in values)
+    digits = _NON_DIGIT.sub("", joined).split("\n")
+
+    if len(digits) != len(values):
+        # Algún valor traía saltos de línea: se limpia uno por uno.
+        digits = [_NON_DIGIT.sub("", (value or "").replace("\n", "")) for value in values]
+
+    return [
+        None if not 10 <= len(d) <= 15 else f"{d}@c.us"
+        for d in ("57" + d if len(d) == 10 and d[0] == "3" else d for d in digits)
+    ]
+
+
+def _header_key(value):
+    value = unicodedata.normalize("NFKD", (value or "").strip().lower())
+    value = "".join(char for char in value if not unicodedata.combining(char))
+    return re.sub(r"[\s\-]+", "_", value)
+
+
+def _find_column(header, candidates, explicit=None):
+    keys = [_header_key(name) for name in header]
+
+    if explicit:
+        wanted = _header_key(explicit)
+        if wanted not in keys:
+            raise ValueError(f"La columna '{explicit}' no está en el CSV")
+        return keys.index(wanted)
+
+    for candidate in candidates:
+        if candidate in keys:
+            return keys.index(candidate)
+
+    return None
+
+
+def _cell(row, index):
+    return row[index].strip() if index is not None and index < len(row) else ""
+
+
+def iter_batches(stream, default_bot_session, phone_column=None, name_column=None):
+    """
+    Lee el CSV y entrega lotes de filas (line_no, phone_number, bot_session, name)
+    ya normalizadas, más la cantidad de filas leídas e inválidas del lote.
+    """
+    reader = csv.reader(stream)
+    header = next(reader, None)
+
+    if not header:
+        raise ValueError("El CSV está vacío")
+
+    phone_index = _find_column(header, PHONE_COLUMNS, phone_column)
+    if phone_index is None:
+        raise ValueError(f"No se encontró la columna de teléfono ({', '.join(PHONE_COLUMNS)})")
+
+    name_index = _find_column(header, NAME_COLUMNS, name_column)
+    session_index = _find_column(header, SESSION_COLUMNS)
+
+    line_no = 1
+    batch = []
+
+    def flush(rows):
+        phones = normalize_phone_batch([row[1] for row in rows])
+        staged = [
+            (row[0], phone, row[2], row[3])
+            for row, phone in zip(rows, phones)
+            if phone
+        ]
+        return staged, len(rows), len(rows) - len(staged)
+
+    for row in reader:
+        line_no += 1
+        if not row:
+            continue
+
+        batch.append((
+            line_no,
+            _cell(row, phone_index),
+            _cell(row, session_index)[:80] or default_bot_session,
+            _cell(row, name_index)[:100] or None,
+        ))
+
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            yield flush(batch)
+            batch = []
+
+    if batch:
+        yield flush(batch)
+
+
+# ============================================================
+# CARGA Y MEZCLA
+# ============================================================
+def _create_staging(connection):
+    connection.execute(text(f"DROP TABLE IF EXISTS {STAGING_TABLE}"))
+    connection.execute(text(f"""
+        CREATE TEMPORARY TABLE {STAGING_TABLE} (
+            line_no BIGINT NOT NULL,
+            phone_number VARCHAR(80) NOT NULL,
+            bot_session VARCHAR(80) NOT NULL,
+            name VARCHAR(100)
+        )
+    """))
+
+
+def _copy_batch(connection, rows):
+    """Postgres: COPY FROM STDIN del lote serializado como CSV."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    raw = connection.connection.driver_connection
+    with raw.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {STAGING_TABLE} (line_no, phone_number, bot_session, name) FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+
+
+def _insert_batch(connection, rows):
+    """Otros motores (SQLite en desarrollo): executemany."""
+    connection.execute(
+        text(
+            f"INSERT INTO {STAGING_TABLE} (line_no, phone_number, bot_session, name) "
+            "VALUES (:line_no, :phone_number, :bot_session, :name)"
+        ),
+        [
+            {"line_no": line_no, "phone_number": phone, "bot_session": session, "name": name}
+            for line_no, phone, session, name in rows
+        ],
+    )
+
+
+# Primera aparición de cada par en el archivo; el nombre solo completa vacíos.
+MERGE_POSTGRES = f"""
+    WITH merged AS (
+        INSERT INTO users (phone_number, bot_session, name, created_at)
+        SELECT DISTINCT ON (phone_number, bot_session)
+               phone_number, bot_session, name, NOW()
+        FROM {STAGING_TABLE}
+        ORDER BY phone_number, bot_session, line_no
+        ON CONFLICT (phone_number, bot_session) DO UPDATE
+            SET name = EXCLUDED.name
+            WHERE users.name IS NULL AND EXCLUDED.name IS NOT NULL
+        RETURNING (xmax = 0) AS inserted
+    )
+    SELECT
+        COUNT(*) FILTER (WHERE inserted),
+        COUNT(*) FILTER (WHERE NOT inserted),
+        (SELECT COUNT(*) FROM (SELECT DISTINCT phone_number, bot_session FROM {STAGING_TABLE}) AS d)
+    FROM merged
+"""
+
+MERGE_GENERIC = f"""
+    INSERT INTO users (phone_number, bot_session, name, created_at)
+    SELECT phone_number, bot_session, name, CURRENT_TIMESTAMP
+    FROM {STAGING_TABLE}
+    WHERE line_no IN (
+        SELECT MIN(line_no) FROM {STAGING_TABLE} GROUP BY phone_number, bot_session
+    )
+    ON CONFLICT (phone_number, bot_session) DO UPDATE
+        SET name = excluded.name
+        WHERE users.name IS NULL AND excluded.name IS NOT NULL
+"""
+
+
+def _merge(connection):
+    if connection.dialect.name == "postgresql":
+        inserted, updated, distinct = connection.execute(text(MERGE_POSTGRES)).one()
+        return inserted, updated, distinct
+
+    before = connection.execute(text("SELECT COUNT(*) FROM users")).scalar()
+    distinct = connection.execute(
+        text(f"SELECT COUNT(*) FROM (SELECT DISTINCT phone_number, bot_session FROM {STAGING_TABLE})")
+    ).scalar()
+    result = connection.execute(text(MERGE_GENERIC))
+    inserted = connection.execute(text("SELECT COUNT(*) FROM users")).scalar() - before
+    return inserted, max(result.rowcount - inserted, 0), distinct
+
+
+def import_contacts(stream, default_bot_session, phone_column=None, name_column=None):
+    """
+    Importa un CSV (stream de texto) en una sola transacción. Devuelve el
+    resumen; ValueError si el archivo no tiene el formato esperado.
+    """
+    started = time.monotonic()
+    connection = db.session.connection()
+    load = _copy_batch if connection.dialect.name == "postgresql" else _insert_batch
+
+    rows_read = invalid = staged = 0
+
+    try:
+        _create_staging(connection)
+
+        for rows, read, bad in iter_batches(stream, default_bot_session, phone_column, name_column):
+            rows_read += read
+            invalid += bad
+            if rows:
+                load(connection, rows)
+                staged += len(rows)
+
+        inserted, updated, distinct = _merge(connection) if staged else (0, 0, 0)
+        connection.execute(text(f"DROP TABLE IF EXISTS {STAGING_TABLE}"))
+        db.session.commit()
+
+    except Exception:
+        db.session.rollback()
+        raise
+
+    summary = {
+        "rows_read": rows_read,
+        "invalid_phone": invalid,
+        "duplicates_in_file": staged - distinct,
+        "inserted": inserted,
+        "name_completed": updated,
+        "already_existing": distinct - inserted - updated,
+        "seconds": round(time.monotonic() - started, 2),
+    }
+
+    log.info("Contactos importados", **summary)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Importa contactos desde un CSV")
+    parser.add_argument("path", help="Archivo CSV con encabezado")
+    parser.add_argument("--bot-session", default=None, help="Sesión WPP para filas sin columna bot_session")
+    parser.add_argument("--phone-column", default=None)
+    parser.add_argument("--name-column", default=None)
+    args = parser.parse_args()
+
+    from app import app, normalize_bot_session
+
+    with app.app_context():
+        with open(args.path, encoding="utf-8-sig", newline="") as fileobj:
+            import_contacts(
+                fileobj,
+                normalize_bot_session(args.bot_session),
+                phone_column=args.phone_column,
+                name_column=args.name_column,
+            )
@@ -0,0 +1,276 @@
+"""
+Flujo de conversación declarativo, compilado a una tabla de despacho.
+
+Cada estado declara, en orden de prioridad, las intenciones que reconoce y
+qué hacer con cada una: una lista de acciones y el estado siguiente. "*"
+es la transición por defecto cuando ninguna intención coincide; un estado
+sin transiciones (o ausente del flujo) solo registra el mensaje.
+
+compile_flow() resuelve nombres de estado a ids y acciones a efectos una
+sola vez, y deja un dict (state_id, intent) -> Transition. Los efectos son
+datos; app.stage_transition() y app.execute_outbound() los ejecutan en
+lote: primero todas las escrituras en BD con un solo commit (incluidos el
+lead, que queda en la cola de php_leads_service, y los envíos, que quedan
+en outbound_messages) y después los envíos.
+
+Cada bot_session puede tener su propio flujo con register_flow() (bajo su
+nombre o el de WPPCONNECT_FLOW_<SESIÓN>, ver bot_sessions); las que no
+tengan usan FLOW_DEFINITIONS["default"].
+"""
+from collections import namedtuple
+
+import intents
+
+
+DEFAULT_INTENT = "*"
+INITIAL_STATE = "inicio"
+
+
+# ============================================================
+# EFECTOS
+# ============================================================
+# Escrituras en BD: se aplican en memoria y se confirman juntas.
+SaveConsent = namedtuple("SaveConsent", ["accepted"])
+SetContext = namedtuple("SetContext", ["key", "value"])
+ClearContext = namedtuple("ClearContext", ["keys"])
+CloseSession = namedtuple("CloseSession", ["reason"])
+Log = namedtuple("Log", ["message"])
+PushLead = namedtuple("PushLead", [])
+
+# Salientes: se ejecutan después del commit, en orden.
+SendText = namedtuple("SendText", ["text"])
+SendYesNo = namedtuple("SendYesNo", ["text", "yes_label", "no_label"])
+SendPolicyButtons = namedtuple("SendPolicyButtons", [])
+SendPolicyDocuments = namedtuple("SendPolicyDocuments", [])
+
+OUTBOUND_EFFECTS = (SendText, SendYesNo, SendPolicyButtons, SendPolicyDocuments)
+
+Transition = namedtuple("Transition", ["name", "next_state_id", "effects"])
+
+
+ACTIONS = {
+    "save_consent": lambda accepted: SaveConsent(bool(accepted)),
+    "set_context": lambda key, value: SetContext(key, value),
+    "clear_context": lambda *keys: ClearContext(tuple(keys)),
+    "clear_survey_context": lambda: ClearContext(("timeout_poll_sent", "inactivity_warning_sent")),
+    "close_session": lambda reason=None: CloseSession(reason),
+    "log": lambda message: Log(message),
+    "send_text": lambda text: SendText(text),
+    "send_yes_no": lambda text, yes_label="Sí", no_label="No": SendYesNo(text, yes_label, no_label),
+    "send_policy_buttons": lambda: SendPolicyButtons(),
+    "send_policy_documents": lambda: SendPolicyDocuments(),
+    "push_lead": lambda: PushLead(),
+}
+
+
+# ============================================================
+# FLUJOS
+# ============================================================
+DEFAULT_FLOW = {
+    # La política se pide por ciclo/conversación, no de forma global.
+    # Si por algún bug esta sesión ya tiene aceptación, se repara y pasa a aceptado.
+    "inicio": {
+        "intents": ["policy_already_accepted"],
+        "on": {
+            "policy_already_accepted": {
+                "actions": [
+                    ("log", "✅ Sesión actual ya tenía política aceptada. No se vuelve a solicitar."),
+                ],
+                "next": "aceptado",
+            },
+            "*": {
+                "actions": ["send_policy_buttons", "send_policy_documents"],
+                "next": "esperando_aceptacion",
+            },
+        },
+    },
+    "esperando_aceptacion": {
+        "intents": ["accept", "reject"],
+        "on": {
+            "accept": {
+                "actions": [
+                    ("save_consent", True),
+                    ("send_text", "Perfecto. Uno de nuestros Asesores se comunicará con usted"),
+                    "push_lead",
+                ],
+                "next": "aceptado",
+            },
+            "reject": {
+                "actions": [
+                    ("save_consent", False),
+                    ("send_text", "Sin aceptar la política no podemos continuar. La sesión será cerrada."),
+                    ("close_session", "no_acepta_politica"),
+                ],
+                "next": "rechazado",
+            },
+            "*": {"actions": ["send_policy_buttons"]},
+        },
+    },
+    # Regla dura:
+    # Si el cliente escribe algo distinto de sí/no, quiere retomar la conversación.
+    # Se cancela la encuesta, la sesión sigue abierta y NO se vuelve a pedir política.
+    "esperando_calificacion": {
+        "intents": ["yes", "no"],
+        "on": {
+            "yes": {
+                "actions": [("send_yes_no", "¿Quedaste satisfecho con la atención?", "Sí", "No")],
+                "next": "encuesta_satisfaccion",
+            },
+            "no": {
+                "actions": [
+                    ("send_text", "Gracias por tu tiempo."),
+                    ("close_session", "no_quiso_calificar"),
+                ],
+            },
+            "*": {
+                "actions": ["clear_survey_context", ("log", "🔁 Encuesta cancelada por mensaje normal.")],
+                "next": "aceptado",
+            },
+        },
+    },
+    "encuesta_satisfaccion": {
+        "intents": ["yes", "no"],
+        "on": {
+            "yes": {
+                "actions": [
+                    ("set_context", "satisfaccion", "satisfecho"),
+                    ("send_text", "Gracias por permitirnos estar conectados con usted a través de este canal. Hasta luego."),
+                    ("close_session", "encuesta_satisfecho"),
+                ],
+            },
+            "no": {
+                "actions": [
+                    ("set_context", "satisfaccion", "no_satisfecho"),
+                    ("send_text", "Gracias por tu sinceridad. Hasta luego."),
+                    ("close_session", "encuesta_no_satisfecho"),
+                ],
+            },
+            "*": {
+                "actions": [
+                    "clear_survey_context",
+                    ("log", "🔁 Encuesta de satisfacción cancelada por mensaje normal."),
+                ],
+                "next": "aceptado",
+            },
+        },
+    },
+    # Estado aceptado: el bot no responde; solo registra mensajes (asesor humano).
+    "aceptado": {"intents": [], "on": {}},
+}
+
+FLOW_DEFINITIONS = {"default": DEFAULT_FLOW}
+
+_compiled_flows = {}
+
+
+def register_flow(bot_session, definition):
+    """Asigna un flujo propio a una sesión de WPPConnect (se compila al primer uso)."""
+    FLOW_DEFINITIONS[bot_session] = definition
+    _compiled_flows.pop(bot_session, None)
+
+
+# ============================================================
+# COMPILACIÓN
+# ============================================================
+def _build_effect(spec):
+    if isinstance(spec, str):
+        name, args = spec, ()
+    else:
+        name, args = spec[0], tuple(spec[1:])
+
+    builder = ACTIONS.get(name)
+    if builder is None:
+        raise ValueError(f"Acción desconocida en el flujo: {name}")
+
+    return builder(*args)
+
+
+NO_MATCH = intents.IntentMatch(DEFAULT_INTENT, 0.0)
+
+
+class CompiledFlow:
+    def __init__(self, table, classifiers, initial_state_id):
+        self.table = table
+        self.classifiers = classifiers
+        self.initial_state_id = initial_state_id
+
+    def classify(self, state_id, text, session):
+        """
+        Primero las condiciones sobre la sesión, en orden; después el
+        vocabulario del estado. IntentMatch("*", 0.0) si nada coincide.
+        """
+        guards, matcher = self.classifiers.get(state_id, ((), None))
+
+        for intent, guard in guards:
+            if guard(session):
+                return intents.IntentMatch(intent, 1.0)
+
+        if matcher is not None:
+            match = matcher.match(text)
+            if match is not None and match.confidence >= intents.INTENT_MIN_CONFIDENCE:
+                return match
+
+        return NO_MATCH
+
+    def dispatch(self, state_id, text, session):
+        """(Transition, IntentMatch); Transition es None si el estado no responde."""
+        if state_id is None:
+            state_id = self.initial_state_id
+
+        if state_id not in self.classifiers:
+            return None, NO_MATCH
+
+        match = self.classify(state_id, text, session)
+        return self.table.get((state_id, match.intent)), match
+
+
+def compile_flow(definition, resolve_state_id, guards, vocabulary=None):
+    """
+    resolve_state_id(name) -> id y guards {intent: fn(sesión)} los aporta
+    app.py; las demás intenciones se buscan en el vocabulario de intents.py.
+    Errores de definición (acción o intención desconocida) fallan aquí, al
+    compilar, y no con el primer mensaje que los toque.
+    """
+    vocabulary = vocabulary or intents.VOCABULARY
+    table = {}
+    classifiers = {}
+
+    for state_name, spec in definition.items():
+        state_id = resolve_state_id(state_name)
+        transitions = spec.get("on", {})
+
+        state_guards = []
+        text_intents = []
+        for intent in spec.get("intents", []):
+            if intent not in transitions:
+                raise ValueError(f"El estado {state_name} reconoce {intent} pero no tiene transición")
+            if intent in guards:
+                state_guards.append((intent, guards[intent]))
+            elif intent in vocabulary:
+                text_intents.append(intent)
+            else:
+                raise ValueError(f"Intención desconocida en el estado {state_name}: {intent}")
+
+        matcher = intents.build_matcher(text_intents, vocabulary) if text_intents else None
+        classifiers[state_id] = (tuple(state_guards), matcher)
+
+        for intent, transition in transitions.items():
+            next_state = transition.get("next")
+            table[(state_id, intent)] = Transition(
+                name=f"{state_name}:{intent}",
+                next_state_id=resolve_state_id(next_state) if next_state else None,
+                effects=tuple(_build_effect(action) for action in transition.get("actions", [])),
+            )
+
+    return CompiledFlow(table, classifiers, resolve_state_id(INITIAL_STATE))
+
+
+def get_flow(bot_session, resolve_state_id, guards):
+    key = bot_session if bot_session in FLOW_DEFINITIONS else "default"
+
+    flow = _compiled_flows.get(key)
+    if flow is None:
+        flow = compile_flow(FLOW_DEFINITIONS[key], resolve_state_id, guards)
+        _compiled_flows[key] = flow
+
+    return flow
@@ -1,27 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+import argparse
+import json
 import os
-
-from models import db, Session, SessionContext
-from app import app, send_yes_no_buttons, get_or_create_state, close_session, mark_session_abandoned
-
-
-INACTIVITY_DAYS = int(os.getenv("INACTIVITY_DAYS", "15"))
-SURVEY_TTL_DAYS = int(os.getenv("SURVEY_TTL_DAYS", "7"))
-
-INACTIVITY_DELTA = timedelta(days=INACTIVITY_DAYS)
-SURVEY_TTL_DELTA = timedelta(days=SURVEY_TTL_DAYS)
-
-FINAL_STATES = {"finalizado", "rechazado"}
-SURVEY_STATES = {"esperando_calificacion", "encuesta_satisfaccion"}
-PRE_CONSENT_STATES = {"inicio", "esperando_aceptacion"}
-
-
-def ensure_aware(dt):
-    if not dt:
-        return None
-    if dt.tzinfo is None:
-        return dt.replace(tzinfo=timezone.utc)
-    return dt
+import sys
+import time
+
+from sqlalchemy.orm import joinedload
+
+import bot_sessions
+import logs
+import session_health
+import util
+import whatsappservice
+from models import db, User, Session, SessionContext, State, Message
+from app import app, get_or_create_state, resolve_delivery_target, seed_default_states
+from session_deadlines import (
+    INACTIVITY_DELTA,
+    SURVEY_TTL_DELTA,
+    FINAL_STATES,
+    SURVEY_STATES,
+    PRE_CONSENT_STATES,
+    POLL_KEY,
+    compute_next_deadline,
+    naive_utc,
+    state_name_for,
+)
+
+# Tamaño de lote para los IN (...) de cierres masivos.
+BULK_CHUNK_SIZE = 1000
+
+# Envíos de encuesta en vuelo a la vez. El ritmo por sesión WPPConnect lo
+# sigue imponiendo whatsappservice (send_delay_seconds de bot_sessions).
+SURVEY_DISPATCH_CONCURRENCY = int(os.getenv("SURVEY_DISPATCH_CONCURRENCY", "8"))
+# Encuestas por tanda: antes de cada una se vuelve a verificar el lock del
+# scheduler (guard de run_sweep).
+SURVEY_SEND_BATCH_SIZE = int(os.getenv("SURVEY_SEND_BATCH_SIZE", "50"))
+# Encuestas de una sesión WPPConnect desconectada (pausada por
+# session_health): no se toman y se vuelven a intentar pasado este plazo.
+SURVEY_PAUSED_RETRY_SECONDS = int(os.getenv("SURVEY_PAUSED_RETRY_SECONDS", "300"))
+
+log = logs.get_logger("cron")
+
+SURVEY_TEXT = "Ha pasado un tiempo desde nuestra última conversación. ¿Deseas calificar tu experiencia con nosotros?"
 
 
 def human_delta(delta):
@@ -37,143 +59,638 @@ def human_delta(delta):
     return f"{minutes} minuto" + ("s" if minutes != 1 else "")
 
 
-def get_context(session, key):
-    return SessionContext.query.filter_by(
-        session_id=session.id,
-        context_key=key
-    ).first()
+# ============================================================
+# BARRIDO POR CONJUNTOS
+# ============================================================
+# Cada regla es una sentencia SQL que selecciona SOLO las sesiones vencidas
+# (next_deadline <= ahora, por índice). Python por fila queda únicamente para
+# las sesiones que deben recibir encuesta.
 
+def last_activity_column():
+    return db.func.coalesce(Session.last_message_time, Session.start_time)
 
-def set_context(session, key, value):
-    now = datetime.now(timezone.utc)
-    ctx = get_context(session, key)
 
-    if not ctx:
-        ctx = SessionContext(session_id=session.id, context_key=key)
-        db.session.add(ctx)
+def state_ids_for(state_ids, names):
+    return [state_ids[name] for name in names if name in state_ids]
 
-    ctx.context_value = value
-    ctx.updated_at = now
-    db.session.commit()
-    return ctx
 
+def context_exists(key, *conditions):
+    return (
+        db.select(SessionContext.id)
+        .where(
+            SessionContext.session_id == Session.id,
+            SessionContext.context_key == key,
+            *conditions,
+        )
+        .exists()
+    )
 
-def delete_context(session, key):
-    ctx = get_context(session, key)
-    if ctx:
-        db.session.delete(ctx)
-        db.session.commit()
 
+def bulk_close_sessions(where, reason, now, finalizado_id):
+    """
+    Cierra en bloque las sesiones activas que cumplen `where` y registra
+    close_reason. Devuelve los ids cerrados.
+    """
+    closed_ids = [
+        row[0]
+        for row in db.session.execute(
+            db.update(Session)
+            .where(Session.is_active.is_(True), *where)
+            .values(is_active=False, end_time=now, current_state_id=finalizado_id, next_deadline=None)
+            .returning(Session.id)
+            .execution_options(synchronize_session=False)
+        )
+    ]
 
-with app.app_context():
-    now = datetime.now(timezone.utc)
+    for start in range(0, len(closed_ids), BULK_CHUNK_SIZE):
+        chunk = closed_ids[start:start + BULK_CHUNK_SIZE]
 
-    get_or_create_state("inicio", "Inicio de la conversación")
-    get_or_create_state("esperando_aceptacion", "Esperando aceptación de política de datos")
-    get_or_create_state("aceptado", "Política aceptada; puede continuar el asesor humano")
-    get_or_create_state("rechazado", "Política rechazada")
-    get_or_create_state("esperando_calificacion", "Esperando si el usuario desea calificar")
-    get_or_create_state("encuesta_satisfaccion", "Encuesta de satisfacción")
-    get_or_create_state("finalizado", "Sesión finalizada")
+        db.session.execute(
+            db.delete(SessionContext)
+            .where(
+                SessionContext.session_id.in_(chunk),
+                SessionContext.context_key == "close_reason",
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            db.insert(SessionContext),
+            [
+                {
+                    "session_id": session_id,
+                    "context_key": "close_reason",
+                    "context_value": reason,
+                    "updated_at": now,
+                }
+                for session_id in chunk
+            ],
+        )
 
-    active_sessions = Session.query.filter_by(is_active=True).all()
+    db.session.commit()
+    return closed_ids
 
-    print(
-        f"[CRON] Ejecutando ciclo de inactividad. Activas={len(active_sessions)} "
-        f"INACTIVITY={human_delta(INACTIVITY_DELTA)} SURVEY_TTL={human_delta(SURVEY_TTL_DELTA)}",
-        flush=True
-    )
 
-    for session in active_sessions:
-        state_name = session.state.state_name.lower() if session.state else "inicio"
+def survey_candidate_conditions(state_ids, inactivity_cutoff):
+    """Sesiones aceptadas/atendidas inactivas que todavía no recibieron encuesta."""
+    excluded_ids = state_ids_for(state_ids, FINAL_STATES | SURVEY_STATES | PRE_CONSENT_STATES)
 
-        print(
-            f"[CRON] Sesión={session.id} Bot={session.user.bot_session} "
-            f"Cliente={session.user.phone_number} Estado={state_name}",
-            flush=True
-        )
+    return [
+        Session.current_state_id.isnot(None),
+        Session.current_state_id.notin_(excluded_ids),
+        last_activity_column() < inactivity_cutoff,
+        ~context_exists("timeout_poll_sent"),
+    ]
 
-        if state_name in FINAL_STATES:
-            print(f"[CRON] Corrigiendo sesión activa en estado final. Sesión={session.id}", flush=True)
-            close_session(session, "estado_final_activo_corregido")
-            continue
 
-        last_msg = ensure_aware(session.last_message_time or session.start_time)
-        if not last_msg:
-            continue
+def find_survey_candidates(conditions):
+    return (
+        Session.query
+        .options(joinedload(Session.user))
+        .filter(Session.is_active.is_(True), *conditions)
+        .order_by(Session.id.asc())
+        .all()
+    )
 
-        delta = now - last_msg
 
-        print(
-            f"[CRON] Sesión={session.id} Inactiva={human_delta(delta)}",
-            flush=True
+# ============================================================
+# ENCUESTAS POR INACTIVIDAD
+# ============================================================
+# 1) Se preparan los envíos en el hilo principal (destino, payload).
+# 2) Antes de cada tanda se consulta cada sesión WPPConnect con
+#    session_health.check(): las encuestas de una sesión pausada no se toman
+#    y su next_deadline pasa a SURVEY_PAUSED_RETRY_SECONDS.
+# 3) Por tandas de SURVEY_SEND_BATCH_SIZE, se toman las sesiones antes de enviar: estado esperando_calificacion y
+#    marca timeout_poll_sent confirmados en bloque. Si el barrido se cae o
+#    falla la BD después, el próximo ya no las ve como candidatas: a lo sumo
+#    una encuesta por sesión.
+# 4) Un pool acotado hace solo las llamadas HTTP a WPPConnect.
+# 5) Se registran los mensajes salientes de los envíos que salieron.
+
+def prepare_survey_jobs(candidates):
+    delivery_phones = {}
+    session_ids = [session.id for session in candidates]
+
+    for start in range(0, len(session_ids), BULK_CHUNK_SIZE):
+        chunk = session_ids[start:start + BULK_CHUNK_SIZE]
+        delivery_phones.update(
+            db.session.query(SessionContext.session_id, SessionContext.context_value)
+            .filter(
+                SessionContext.session_id.in_(chunk),
+                SessionContext.context_key == "delivery_phone",
+            )
+            .all()
         )
 
-        # Limpiar warning viejo del flujo anterior. El nuevo flujo ya no usa warning.
-        delete_context(session, "inactivity_warning_sent")
+    jobs = []
+    for session in candidates:
+        number = session.user.phone_number
+        target = resolve_delivery_target(delivery_phones.get(session.id), number)
+        jobs.append({
+            "session_id": session.id,
+            "bot_session": session.user.bot_session,
+            "number": number,
+            "data": util.YesNoButtonMessage(number=target, text=SURVEY_TEXT, yes_label="Sí", no_label="No"),
+            "fallback": util.TextMessage(
+                f"{SURVEY_TEXT}\n\nResponde con una opción:\n- Sí\n- No",
+                number=target,
+            ),
+        })
+
+    return jobs
+
+
+def deliver_survey(job):
+    """
+    Corre en el pool: solo HTTP, sin tocar la base de datos. Devuelve
+    (job, tipo, texto) del envío que salió, o (job, None, None) si fallaron
+    los botones y también el texto.
+    """
+    if whatsappservice.SendMessageWhatsapp(job["data"], session_name=job["bot_session"]):
+        return job, "interactive", SURVEY_TEXT
+
+    fallback_text = job["fallback"]["text"]["body"]
+    if whatsappservice.SendMessageWhatsapp(job["fallback"], session_name=job["bot_session"]):
+        return job, "text", fallback_text
+
+    return job, None, None
+
+
+def claim_survey_sessions(jobs, now, inactivity_cutoff, state_ids):
+    """
+    Pasa a esperando_calificacion (con sus marcas) las sesiones de `jobs` y
+    devuelve los jobs tomados. El UPDATE vuelve a exigir que la sesión siga
+    activa, aceptada e inactiva: si el cliente escribió entre la búsqueda y
+    la toma, su mensaje manda y la sesión no recibe encuesta.
+    """
+    now_db = naive_utc(now)
+    esperando_id = get_or_create_state(
+        "esperando_calificacion",
+        "Esperando que el usuario decida si quiere calificar por inactividad"
+    ).id
+    excluded_ids = state_ids_for(state_ids, FINAL_STATES | SURVEY_STATES | PRE_CONSENT_STATES)
+    claimed = []
+
+    for start in range(0, len(jobs), BULK_CHUNK_SIZE):
+        chunk = jobs[start:start + BULK_CHUNK_SIZE]
+        chunk_ids = [job["session_id"] for job in chunk]
+
+        moved_ids = [
+            row[0]
+            for row in db.session.execute(
+                db.update(Session)
+                .where(
+                    Session.id.in_(chunk_ids),
+                    Session.is_active.is_(True),
+                    Session.current_state_id.notin_(excluded_ids),
+                    last_activity_column() < inactivity_cutoff,
+                )
+                .values(
+                    current_state_id=esperando_id,
+                    next_deadline=now_db + SURVEY_TTL_DELTA,
+                )
+                .returning(Session.id)
+                .execution_options(synchronize_session=False)
+            )
+        ]
+
+        if moved_ids:
+            db.session.execute(
+                db.delete(SessionContext)
+                .where(
+                    SessionContext.session_id.in_(moved_ids),
+                    SessionContext.context_key.in_(["abandoned", POLL_KEY]),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            db.session.execute(
+                db.insert(SessionContext),
+                [
+                    {
+                        "session_id": session_id,
+                        "context_key": key,
+                        "context_value": value,
+                        "updated_at": now_db,
+                    }
+                    for session_id in moved_ids
+                    for key, value in (("abandoned", "true"), (POLL_KEY, now.isoformat()))
+                ],
+            )
 
-        # ============================================================
-        # 1) Sesiones que están esperando encuesta
-        # ============================================================
-        if state_name in SURVEY_STATES:
-            poll_ctx = get_context(session, "timeout_poll_sent")
+        db.session.commit()
+        moved = set(moved_ids)
+        claimed.extend(job for job in chunk if job["session_id"] in moved)
+
+    return claimed
+
+
+def record_survey_messages(results, now):
+    """Mensajes salientes en bloque, solo de los envíos que salieron."""
+    now_db = naive_utc(now)
+    delivered = [(job, message_type, text) for job, message_type, text in results if message_type]
+
+    for start in range(0, len(delivered), BULK_CHUNK_SIZE):
+        db.session.execute(
+            db.insert(Message),
+            [
+                {
+                    "session_id": job["session_id"],
+                    "direction": "out",
+                    "message_text": text,
+                    "message_type": message_type,
+                    "timestamp": now_db,
+                }
+                for job, message_type, text in delivered[start:start + BULK_CHUNK_SIZE]
+            ],
+        )
+        db.session.commit()
 
-            if not poll_ctx:
-                set_context(session, "timeout_poll_sent", now.isoformat())
-                print(f"[CRON] timeout_poll_sent creado para sesión={session.id}", flush=True)
-                continue
+    return len(delivered)
+
+
+def record_survey_results(results, now):
+    """Registra una tanda de envíos; devuelve (enviadas, no entregadas)."""
+    fallbacks = sum(1 for _, message_type, _ in results if message_type == "text")
+    if fallbacks:
+        log.warning("Encuestas enviadas como texto (fallback)", surveys=fallbacks)
+
+    failed = sum(1 for _, message_type, _ in results if message_type is None)
+    if failed:
+        # Ya quedaron en esperando_calificacion: no se reintentan y la
+        # encuesta vence a los SURVEY_TTL como cualquier otra.
+        log.warning("⚠️ Encuestas no entregadas", surveys=failed)
+
+    return record_survey_messages(results, now), failed
+
+
+def hold_paused_surveys(jobs, now):
+    """
+    Separa los jobs de sesiones WPPConnect pausadas y posterga su
+    next_deadline para que el scheduler no los vuelva a despertar enseguida.
+    Devuelve (jobs a enviar, jobs retenidos).
+    """
+    paused = set()
+    for bot_session in {job["bot_session"] for job in jobs}:
+        # check() guarda el estado para los workers; UNKNOWN (WPPConnect sin
+        # respuesta) conserva la pausa anterior y la falla la ven los envíos.
+        if session_health.check(bot_session).paused:
+            paused.add(bot_session)
+    if not paused:
+        return jobs, []
+
+    held = [job for job in jobs if job["bot_session"] in paused]
+    db.session.execute(
+        db.update(Session)
+        .where(Session.id.in_([job["session_id"] for job in held]))
+        .values(next_deadline=naive_utc(now) + timedelta(seconds=SURVEY_PAUSED_RETRY_SECONDS))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
 
-            try:
-                poll_time = datetime.fromisoformat(poll_ctx.context_value)
-            except Exception:
-                poll_time = now
+    log.warning("⚠️ Encuestas retenidas: sesión WPPConnect en pausa", surveys=len(held), sessions=sorted(paused))
+    return [job for job in jobs if job["bot_session"] not in paused], held
 
-            poll_time = ensure_aware(poll_time)
 
-            if now - poll_time > SURVEY_TTL_DELTA:
-                print(f"[CRON] Cerrando encuesta expirada. Sesión={session.id}", flush=True)
-                close_session(session, "encuesta_expirada")
+def dispatch_inactivity_surveys(candidates, now, inactivity_cutoff, state_ids, guard=None):
+    """
+    Devuelve (encuestas enviadas, sesiones tomadas cuyo envío falló,
+    encuestas retenidas por sesión pausada). `guard` se llama antes de cada
+    tanda y corta el envío si lanza.
+    """
+    if not candidates:
+        return 0, 0, 0
 
-            continue
+    jobs = prepare_survey_jobs(candidates)
+    # Liberar la conexión mientras se espera a WPPConnect.
+    db.session.commit()
 
-        # ============================================================
-        # 2) Sesiones donde nunca aceptaron política
-        # ============================================================
+    log.info("Enviando encuestas por inactividad", surveys=len(jobs), concurrency=SURVEY_DISPATCH_CONCURRENCY)
+
+    sent = failed = held = 0
+    batch_size = max(1, SURVEY_SEND_BATCH_SIZE)
+    with ThreadPoolExecutor(max_workers=max(1, SURVEY_DISPATCH_CONCURRENCY)) as executor:
+        for start in range(0, len(jobs), batch_size):
+            if guard is not None:
+                guard()
+
+            batch, batch_held = hold_paused_surveys(jobs[start:start + batch_size], now)
+            held += len(batch_held)
+
+            claimed = claim_survey_sessions(batch, now, inactivity_cutoff, state_ids)
+            results = list(executor.map(deliver_survey, claimed))
+            batch_sent, batch_failed = record_survey_results(results, now)
+            sent += batch_sent
+            failed += batch_failed
+
+    return sent, failed, held
+
+
+def reschedule_sessions(where, now_db):
+    """
+    Recalcula next_deadline de las sesiones activas que cumplen `where`,
+    por lotes y con un UPDATE por clave primaria.
+    """
+    last_id = 0
+    total = 0
+
+    while True:
+        rows = (
+            db.session.query(
+                Session.id,
+                Session.current_state_id,
+                Session.last_message_time,
+                Session.start_time,
+            )
+            .filter(Session.is_active.is_(True), Session.id > last_id, *where)
+            .order_by(Session.id.asc())
+            .limit(BULK_CHUNK_SIZE)
+            .all()
+        )
+        if not rows:
+            return total
+
+        last_id = rows[-1].id
+        polls = dict(
+            db.session.query(SessionContext.session_id, SessionContext.updated_at)
+            .filter(
+                SessionContext.session_id.in_([row.id for row in rows]),
+                SessionContext.context_key == POLL_KEY,
+            )
+            .all()
+        )
+
+        db.session.execute(
+            db.update(Session),
+            [
+                {
+                    "id": row.id,
+                    "next_deadline": compute_next_deadline(
+                        state_name_for(db.session, row.current_state_id),
+                        True,
+                        naive_utc(row.last_message_time or row.start_time),
+                        naive_utc(polls.get(row.id)),
+                        now_db,
+                    ),
+                }
+                for row in rows
+            ],
+        )
+        db.session.commit()
+        total += len(rows)
+
+
+def recompute_all_deadlines():
+    """Rellena next_deadline de todas las sesiones activas (tras la migración)."""
+    return reschedule_sessions([], naive_utc(datetime.now(timezone.utc)))
+
+
+# ============================================================
+# CICLO COMPLETO (real o dry-run)
+# ============================================================
+
+class SweepReport:
+    """Conteos por acción, por bot_session (dry-run) y tiempos por fase."""
+
+    PHASES = ("load", "classify", "writes", "sends")
+
+    def __init__(self, now, dry_run=False):
+        self.now = now
+        self.dry_run = dry_run
+        self.counts = {}
+        self.by_bot_session = {}
+        self.timings = {phase: 0.0 for phase in self.PHASES}
+        self.estimated_send_seconds = None
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - started
+
+    def add(self, action, count, by_bot_session=None):
+        self.counts[action] = count
+        if by_bot_session is not None:
+            self.by_bot_session[action] = by_bot_session
+
+    def to_dict(self):
+        return {
+            "dry_run": self.dry_run,
+            "now": self.now.isoformat(),
+            "inactivity": human_delta(INACTIVITY_DELTA),
+            "survey_ttl": human_delta(SURVEY_TTL_DELTA),
+            "counts": self.counts,
+            "by_bot_session": self.by_bot_session,
+            "timings_seconds": {key: round(value, 4) for key, value in self.timings.items()},
+            "estimated_send_seconds": self.estimated_send_seconds,
+        }
+
+    def render(self):
+        title = "DRY-RUN (sin escrituras ni envíos)" if self.dry_run else "Ciclo ejecutado"
+        lines = [
+            f"[CRON] {title} now={self.now.isoformat()} "
+            f"INACTIVITY={human_delta(INACTIVITY_DELTA)} SURVEY_TTL={human_delta(SURVEY_TTL_DELTA)}",
+            f"{'acción':<32}{'total':>8}  por bot_session",
+        ]
+
+        for action, count in self.counts.items():
+            per_bot = self.by_bot_session.get(action) or {}
+            detail = ", ".join(f"{name}={value}" for name, value in sorted(per_bot.items()))
+            lines.append(f"{action:<32}{count:>8}  {detail}")
+
+        lines.append("tiempos: " + " ".join(f"{key}={value * 1000:.1f}ms" for key, value in self.timings.items()))
+
+        if self.estimated_send_seconds is not None:
+            lines.append(f"envíos estimados: {self.estimated_send_seconds:.1f}s (ritmo por sesión WPPConnect)")
+
+        return "\n".join(lines)
+
+
+def count_by_bot_session(conditions):
+    rows = (
+        db.session.query(User.bot_session, db.func.count(Session.id))
+        .select_from(Session)
+        .join(User, User.id == Session.user_id)
+        .filter(Session.is_active.is_(True), *conditions)
+        .group_by(User.bot_session)
+        .all()
+    )
+    return dict(rows)
+
+
+def run_sweep(now=None, dry_run=False, report=None, guard=None):
+    """
+    Ejecuta las reglas de inactividad. Con dry_run=True solo cuenta, agrupado
+    por bot_session, lo que cada regla haría: sin escrituras ni envíos, y sin
+    filtrar por next_deadline (que refleja la configuración vigente), así que
+    sirve para evaluar otros INACTIVITY_DAYS/SURVEY_TTL_DAYS o un `now` futuro.
+
+    `guard` (p. ej. ControlConnection.verify del scheduler) se llama antes de
+    escribir y antes de cada tanda de encuestas; si lanza, el barrido se corta.
+    """
+    now = now or datetime.now(timezone.utc)
+    report = report or SweepReport(now, dry_run=dry_run)
+
+    with report.phase("load"):
+        now_db = naive_utc(now)
+        inactivity_cutoff = naive_utc(now - INACTIVITY_DELTA)
+        survey_cutoff = naive_utc(now - SURVEY_TTL_DELTA)
+
+        # Solo lectura: en una BD sin sembrar un estado que falta no coincide
+        # con ninguna sesión (state_ids_for lo omite).
+        state_ids = dict(db.session.query(State.state_name, State.id).all())
+        final_ids = state_ids_for(state_ids, FINAL_STATES)
+        survey_ids = state_ids_for(state_ids, SURVEY_STATES)
+        pre_consent_ids = state_ids_for(state_ids, PRE_CONSENT_STATES)
+
+    due = [] if dry_run else [Session.next_deadline <= now_db]
+
+    close_rules = [
+        # 1) Sesiones activas en estado final: se corrigen en bloque.
+        ("estado_final_activo_corregido", [Session.current_state_id.in_(final_ids)]),
+        # 3) Encuestas expiradas: timeout_poll_sent más viejo que SURVEY_TTL.
+        ("encuesta_expirada", [
+            Session.current_state_id.in_(survey_ids),
+            context_exists(POLL_KEY, SessionContext.updated_at < survey_cutoff),
+        ]),
+        # 5) Sesiones donde nunca aceptaron política.
         # No se manda encuesta si nunca aceptó política. Se cierra por abandono
         # para que, cuando vuelva a escribir, empiece un ciclo nuevo y se pida política.
-        if state_name in PRE_CONSENT_STATES:
-            if delta > INACTIVITY_DELTA:
-                print(f"[CRON] Cerrando sesión sin aceptación por abandono. Sesión={session.id}", flush=True)
-                close_session(session, "politica_no_respondida")
-            continue
-
-        # ============================================================
-        # 3) Sesiones aceptadas/atendidas
-        # ============================================================
-        # A los 15 días NO se cierra todavía: se envía encuesta y la sesión queda activa.
-        if delta > INACTIVITY_DELTA:
-            timeout_poll_ctx = get_context(session, "timeout_poll_sent")
-            if timeout_poll_ctx:
-                continue
-
-            print(f"[CRON] Enviando encuesta por inactividad. Sesión={session.id}", flush=True)
-
-            mark_session_abandoned(session)
-
-            session.current_state_id = get_or_create_state(
-                "esperando_calificacion",
-                "Esperando que el usuario decida si quiere calificar por inactividad"
-            ).id
-            db.session.commit()
-
-            send_yes_no_buttons(
-                session,
-                session.user.phone_number,
-                "Ha pasado un tiempo desde nuestra última conversación. ¿Deseas calificar tu experiencia con nosotros?",
-                yes_label="Sí",
-                no_label="No",
-                update_last_message=False
+        ("politica_no_respondida", [
+            db.or_(
+                Session.current_state_id.in_(pre_consent_ids),
+                Session.current_state_id.is_(None),
+            ),
+            last_activity_column() < inactivity_cutoff,
+        ]),
+    ]
+    # 2) Warning viejo del flujo anterior. El nuevo flujo ya no usa warning.
+    warning_conditions = [context_exists("inactivity_warning_sent")]
+    # 4) Sesiones en encuesta sin marca timeout_poll_sent.
+    poll_conditions = [Session.current_state_id.in_(survey_ids), ~context_exists(POLL_KEY)]
+    # 6) Sesiones aceptadas/atendidas: a los 15 días NO se cierra todavía,
+    # se envía encuesta y la sesión queda activa.
+    survey_conditions = survey_candidate_conditions(state_ids, inactivity_cutoff)
+
+    if dry_run:
+        with report.phase("classify"):
+            for action, conditions in close_rules:
+                per_bot = count_by_bot_session(conditions)
+                report.add(action, sum(per_bot.values()), per_bot)
+
+            for action, conditions in [
+                ("warnings_eliminados", warning_conditions),
+                ("timeout_poll_sent_creado", poll_conditions),
+                ("encuesta_enviada", survey_conditions),
+            ]:
+                per_bot = count_by_bot_session(conditions)
+                report.add(action, sum(per_bot.values()), per_bot)
+
+        # Cada sesión WPPConnect envía a su ritmo y en paralelo con las demás:
+        # la más lenta marca la duración.
+        surveys_per_bot = report.by_bot_session.get("encuesta_enviada") or {}
+        report.estimated_send_seconds = max(
+            (count * bot_sessions.get(bot_session).send_delay_seconds for bot_session, count in surveys_per_bot.items()),
+            default=0,
+        )
+        return report.counts
+
+    if guard is not None:
+        guard()
+
+    finalizado_id = state_ids.get("finalizado") or get_or_create_state("finalizado").id
+
+    def close(rule):
+        action, conditions = rule
+        report.add(action, len(bulk_close_sessions(due + conditions, action, now_db, finalizado_id)))
+
+    with report.phase("writes"):
+        final_rule, expired_rule, pre_consent_rule = close_rules
+
+        close(final_rule)
+
+        active_ids = db.select(Session.id).where(Session.is_active.is_(True))
+        report.add("warnings_eliminados", db.session.execute(
+            db.delete(SessionContext)
+            .where(
+                SessionContext.context_key == "inactivity_warning_sent",
+                SessionContext.session_id.in_(active_ids),
+            )
+            .execution_options(synchronize_session=False)
+        ).rowcount)
+        db.session.commit()
+
+        close(expired_rule)
+
+        report.add("timeout_poll_sent_creado", db.session.execute(
+            db.insert(SessionContext).from_select(
+                ["session_id", "context_key", "context_value", "updated_at"],
+                db.select(
+                    Session.id,
+                    db.literal(POLL_KEY),
+                    db.literal(now.isoformat()),
+                    db.literal(now_db),
+                )
+                .where(Session.is_active.is_(True), *due, *poll_conditions),
             )
+        ).rowcount)
+        db.session.commit()
+
+        close(pre_consent_rule)
+
+    with report.phase("classify"):
+        candidates = find_survey_candidates(due + survey_conditions)
+
+    with report.phase("sends"):
+        sent, failed, held = dispatch_inactivity_surveys(candidates, now, inactivity_cutoff, state_ids, guard)
+        report.add("encuesta_enviada", sent)
+        report.add("encuesta_no_entregada", failed)
+        report.add("encuesta_retenida_pausa", held)
+
+    with report.phase("writes"):
+        # 7) Lo que siga vencido (p. ej. marcas de encuesta recién creadas) se
+        # reprograma para que no vuelva a aparecer en el próximo ciclo.
+        report.add("reprogramadas", reschedule_sessions(due, now_db))
+
+    return report.counts
+
+
+def parse_now(value):
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Barrido de inactividad de sesiones")
+    parser.add_argument("--dry-run", action="store_true", help="Evalúa las reglas sin escribir ni enviar")
+    parser.add_argument("--now", type=parse_now, help="Fecha/hora ISO a usar como 'ahora' (UTC si no trae zona)")
+    parser.add_argument("--json", action="store_true", help="Imprime el reporte como JSON")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if not args.dry_run:
+            seed_default_states()
+
+        report = SweepReport(args.now or datetime.now(timezone.utc), dry_run=args.dry_run)
+
+        if args.dry_run:
+            run_sweep(report.now, dry_run=True, report=report)
+            db.session.rollback()
+        else:
+            # Mismo lock que scheduler.py: nunca dos barridos a la vez.
+            from scheduler import exclusive_leadership
+
+            with exclusive_leadership() as guard:
+                if guard is None:
+                    logs.flush()
+                    sys.exit(1)
+                run_sweep(report.now, report=report, guard=guard)
 
-            set_context(session, "timeout_poll_sent", now.isoformat())
-            continue
+        # El reporte es la salida del comando: va después de los logs pendientes.
+        logs.flush()
+        if args.json:
+            print(json.dumps(report.to_dict(), ensure_ascii=False, indent=2), flush=True)
+        else:
+            print(report.render(), flush=True)
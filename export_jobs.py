@@ -0,0 +1,477 @@
+"""
+Exportaciones del CRM en segundo plano.
+
+La API solo crea el registro en export_jobs; este módulo (ejecutado como
+`python export_jobs.py` en el servicio `exports` de docker-compose) toma los
+trabajos pendientes, escribe el archivo comprimido en EXPORTS_DIR por lotes y
+va reportando el progreso en la misma tabla.
+
+Cada lote escrito renueva heartbeat_at. Un trabajo "running" sin latido en
+EXPORT_STALE_MINUTES (su worker murió) vuelve a pending; la nueva toma
+incrementa attempts y escribe en su propio archivo temporal. Si el worker
+anterior seguía vivo, su siguiente actualización no encuentra su toma y
+abandona el trabajo sin tocar el archivo final ni el estado.
+"""
+import argparse
+import csv
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import logs
+from models import db, ExportJob, User, Session, Message
+from serializers import format_datetime
+from session_deadlines import naive_utc
+
+
+EXPORTS_DIR = os.getenv(
+    "EXPORTS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "exports"),
+)
+EXPORT_POLL_SECONDS = float(os.getenv("EXPORT_POLL_SECONDS", "2"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# Sin latido en este tiempo, el trabajo se considera de un worker muerto.
+EXPORT_STALE_MINUTES = int(os.getenv("EXPORT_STALE_MINUTES", "10"))
+EXPORT_RETENTION_HOURS = int(os.getenv("EXPORT_RETENTION_HOURS", "24"))
+
+log = logs.get_logger("export")
+
+EXPORT_KINDS = ["contacts", "messages", "conversation"]
+EXPORT_FORMATS = ["csv", "jsonl"]
+
+# (encabezado CSV, clave JSONL)
+CONTACT_COLUMNS = [
+    ("ID", "id"),
+    ("Telefono", "phone_number"),
+    ("Nombre", "name"),
+    ("Sesion chatbot", "bot_session"),
+    ("Estado politica", "policy_status"),
+    ("Acepto politica", "policy_accepted"),
+    ("Fecha consentimiento", "policy_date"),
+    ("Estado actual", "current_state"),
+    ("Sesion activa", "is_active"),
+    ("Ultimo mensaje", "last_message_time"),
+    ("Total mensajes", "total_messages"),
+    ("Creado", "created_at"),
+]
+
+MESSAGE_COLUMNS = [
+    ("Contacto ID", "user_id"),
+    ("Telefono", "phone_number"),
+    ("Sesion chatbot", "bot_session"),
+    ("Mensaje ID", "id"),
+    ("Direccion", "direction"),
+    ("Tipo", "message_type"),
+    ("Mensaje", "message_text"),
+    ("Fecha", "timestamp"),
+]
+
+
+def utcnow():
+    # Las columnas son timestamp sin zona en UTC (ver session_deadlines.naive_utc).
+    return naive_utc(datetime.now(timezone.utc))
+
+
+def parse_datetime_param(value, field):
+    if not value:
+        return None
+
+    try:
+        parsed = datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        raise ValueError(f"{field} debe tener formato ISO (YYYY-MM-DD o YYYY-MM-DDTHH:MM:SS)")
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def validate_export_request(body):
+    """
+    Valida el cuerpo de POST /api/crm/exports.
+    Devuelve (kind, export_format, params) o lanza ValueError con el motivo.
+    """
+    body = body or {}
+    kind = str(body.get("kind") or "").strip().lower()
+    export_format = str(body.get("format") or "csv").strip().lower()
+
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"kind debe ser uno de: {', '.join(EXPORT_KINDS)}")
+
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"format debe ser uno de: {', '.join(EXPORT_FORMATS)}")
+
+    params = {}
+
+    bot_session = str(body.get("bot_session") or body.get("session") or "").strip()
+    if bot_session:
+        params["bot_session"] = bot_session
+
+    if kind == "messages":
+        date_from = parse_datetime_param(body.get("from"), "from")
+        date_to = parse_datetime_param(body.get("to"), "to")
+
+        if not date_from or not date_to:
+            raise ValueError("Para exportar mensajes se requiere el rango from/to")
+        if date_from >= date_to:
+            raise ValueError("from debe ser anterior a to")
+
+        params["from"] = date_from.isoformat()
+        params["to"] = date_to.isoformat()
+
+    if kind == "conversation":
+        try:
+            params["user_id"] = int(body.get("user_id"))
+        except (TypeError, ValueError):
+            raise ValueError("Para exportar una conversación se requiere user_id")
+
+    return kind, export_format, params
+
+
+def create_export_job(kind, export_format, params):
+    job = ExportJob(
+        kind=kind,
+        export_format=export_format,
+        params=json.dumps(params),
+        status="pending",
+        rows_written=0,
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def job_params(job):
+    try:
+        return json.loads(job.params or "{}")
+    except ValueError:
+        return {}
+
+
+def job_to_dict(job, download_url=None):
+    progress = None
+    if job.total_rows:
+        progress = round(min(100.0, 100.0 * (job.rows_written or 0) / job.total_rows), 1)
+    elif job.status == "done":
+        progress = 100.0
+
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "format": job.export_format,
+        "params": job_params(job),
+        "status": job.status,
+        "rows_written": job.rows_written or 0,
+        "total_rows": job.total_rows,
+        "progress": progress,
+        "file_size": job.file_size,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "download_url": download_url if job.status == "done" else None,
+    }
+
+
+def artifact_filename(job):
+    return f"{job.kind}_{job.id}.{job.export_format}.gz"
+
+
+# ============================================================
+# GENERADORES DE FILAS (por lotes, paginando por id)
+# ============================================================
+
+def _format_value(value):
+    if isinstance(value, datetime):
+        return format_datetime(value)
+    return value
+
+
+def _contact_batches(params):
+    from app import build_contact_payloads
+
+    last_id = 0
+    while True:
+        query = User.query.filter(User.id > last_id)
+        if params.get("bot_session"):
+            query = query.filter(User.bot_session == params["bot_session"])
+
+        users = query.order_by(User.id.asc()).limit(EXPORT_BATCH_SIZE).all()
+        if not users:
+            return
+
+        last_id = users[-1].id
+        yield build_contact_payloads(users)
+        db.session.expunge_all()
+
+
+def _count_contacts(params):
+    query = User.query
+    if params.get("bot_session"):
+        query = query.filter(User.bot_session == params["bot_session"])
+    return query.count()
+
+
+def _messages_query(kind, params):
+    query = (
+        db.session.query(
+            User.id.label("user_id"),
+            User.phone_number,
+            User.bot_session,
+            Message.id,
+            Message.direction,
+            Message.message_type,
+            Message.message_text,
+            Message.timestamp,
+        )
+        .select_from(Message)
+        .join(Session, Session.id == Message.session_id)
+        .join(User, User.id == Session.user_id)
+    )
+
+    if params.get("bot_session"):
+        query = query.filter(User.bot_session == params["bot_session"])
+
+    if kind == "messages":
+        query = query.filter(
+            Message.timestamp >= naive_utc(datetime.fromisoformat(params["from"])),
+            Message.timestamp < naive_utc(datetime.fromisoformat(params["to"])),
+        )
+
+    if kind == "conversation":
+        query = query.filter(User.id == params["user_id"])
+
+    return query
+
+
+def _message_batches(kind, params):
+    last_id = 0
+    while True:
+        rows = (
+            _messages_query(kind, params)
+            .filter(Message.id > last_id)
+            .order_by(Message.id.asc())
+            .limit(EXPORT_BATCH_SIZE)
+            .all()
+        )
+        if not rows:
+            return
+
+        last_id = rows[-1].id
+        yield [row._asdict() for row in rows]
+
+
+def _count_messages(kind, params):
+    return _messages_query(kind, params).order_by(None).count()
+
+
+# ============================================================
+# EJECUCIÓN DE UN TRABAJO
+# ============================================================
+
+class _ArtifactWriter:
+    def __init__(self, fileobj, export_format, columns):
+        self.fileobj = fileobj
+        self.export_format = export_format
+        self.columns = columns
+
+        if export_format == "csv":
+            self.csv_writer = csv.writer(fileobj)
+            self.csv_writer.writerow([header for header, _ in columns])
+
+    def write(self, record):
+        if self.export_format == "csv":
+            self.csv_writer.writerow([
+                "" if record.get(key) is None else _format_value(record.get(key))
+                for _, key in self.columns
+            ])
+        else:
+            line = {key: _format_value(record.get(key)) for _, key in self.columns}
+            self.fileobj.write(json.dumps(line, ensure_ascii=False, default=str))
+            self.fileobj.write("\n")
+
+
+class _ClaimLost(Exception):
+    """Otro worker retomó el trabajo (este dejó de latir a tiempo)."""
+
+
+def _update_claimed(job_id, attempt, values):
+    """Actualiza el trabajo solo si sigue siendo de esta toma."""
+    count = (
+        ExportJob.query
+        .filter_by(id=job_id, attempts=attempt, status="running")
+        .update(values, synchronize_session=False)
+    )
+    db.session.commit()
+    if not count:
+        raise _ClaimLost()
+
+
+def run_export_job(job):
+    params = job_params(job)
+
+    if job.kind == "contacts":
+        columns = CONTACT_COLUMNS
+        total = _count_contacts(params)
+        batches = _contact_batches(params)
+    else:
+        columns = MESSAGE_COLUMNS
+        total = _count_messages(job.kind, params)
+        batches = _message_batches(job.kind, params)
+
+    job_id = job.id
+    attempt = job.attempts
+    export_format = job.export_format
+    final_path = os.path.join(EXPORTS_DIR, artifact_filename(job))
+    tmp_path = f"{final_path}.{attempt}.part"
+
+    log.info("Iniciando job", job_id=job_id, kind=job.kind, format=export_format, rows=total, attempt=attempt)
+
+    started = time.monotonic()
+    written = 0
+
+    try:
+        _update_claimed(job_id, attempt, {"total_rows": total, "heartbeat_at": utcnow()})
+        os.makedirs(EXPORTS_DIR, exist_ok=True)
+
+        with gzip.open(tmp_path, "wt", encoding="utf-8", newline="") as fileobj:
+            writer = _ArtifactWriter(fileobj, export_format, columns)
+
+            for batch in batches:
+                for record in batch:
+                    writer.write(record)
+                written += len(batch)
+
+                # Progreso y latido por lote: una actualización corta, sin cargar el job.
+                _update_claimed(job_id, attempt, {"rows_written": written, "heartbeat_at": utcnow()})
+
+        # Confirma la toma antes de reemplazar el archivo final.
+        _update_claimed(job_id, attempt, {"heartbeat_at": utcnow()})
+        os.replace(tmp_path, final_path)
+
+        _update_claimed(job_id, attempt, {
+            "status": "done",
+            "rows_written": written,
+            "file_path": final_path,
+            "file_size": os.path.getsize(final_path),
+            "finished_at": utcnow(),
+        })
+
+        log.info("Job terminado", job_id=job_id, rows=written, seconds=round(time.monotonic() - started, 1))
+
+    except _ClaimLost:
+        db.session.rollback()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        log.warning("⚠️ Job retomado por otro worker; se abandona", job_id=job_id, attempt=attempt)
+
+    except Exception as e:
+        db.session.rollback()
+
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        ExportJob.query.filter_by(id=job_id, attempts=attempt).update({
+            "status": "error",
+            "error": repr(e)[:2000],
+            "finished_at": utcnow(),
+        })
+        db.session.commit()
+
+        log.error("❌ Job falló", job_id=job_id, error=repr(e), exc_info=True)
+
+
+def claim_next_job():
+    """
+    Toma el siguiente trabajo pendiente. SKIP LOCKED permite correr varios
+    workers sin que dos tomen el mismo trabajo.
+    """
+    job = (
+        ExportJob.query
+        .filter_by(status="pending")
+        .order_by(ExportJob.id.asc())
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+
+    if not job:
+        db.session.rollback()
+        return None
+
+    job.status = "running"
+    job.started_at = job.heartbeat_at = utcnow()
+    job.attempts = (job.attempts or 0) + 1
+    job.rows_written = 0
+    db.session.commit()
+    return job
+
+
+def requeue_stale_jobs():
+    """Devuelve a pending los trabajos cuyo worker dejó de latir (murió a mitad de camino)."""
+    cutoff = utcnow() - timedelta(minutes=EXPORT_STALE_MINUTES)
+    count = (
+        ExportJob.query
+        .filter(
+            ExportJob.status == "running",
+            db.func.coalesce(ExportJob.heartbeat_at, ExportJob.started_at) < cutoff,
+        )
+        .update({"status": "pending"}, synchronize_session=False)
+    )
+    db.session.commit()
+
+    if count:
+        log.warning("Reencolados trabajos sin terminar", jobs=count)
+
+
+def purge_expired_artifacts():
+    cutoff = utcnow() - timedelta(hours=EXPORT_RETENTION_HOURS)
+    jobs = (
+        ExportJob.query
+        .filter(ExportJob.status == "done", ExportJob.finished_at < cutoff)
+        .all()
+    )
+
+    for job in jobs:
+        if job.file_path and os.path.exists(job.file_path):
+            os.remove(job.file_path)
+        job.status = "expired"
+        job.file_path = None
+
+    db.session.commit()
+
+
+def run_worker(once=False):
+    from app import app
+
+    with app.app_context():
+        os.makedirs(EXPORTS_DIR, exist_ok=True)
+        log.info("Worker iniciado", directory=EXPORTS_DIR)
+
+        last_maintenance = 0.0
+
+        while True:
+            if time.monotonic() - last_maintenance > 60:
+                requeue_stale_jobs()
+                purge_expired_artifacts()
+                last_maintenance = time.monotonic()
+
+            job = claim_next_job()
+
+            if job:
+                run_export_job(job)
+                continue
+
+            if once:
+                return
+
+            time.sleep(EXPORT_POLL_SECONDS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker de exportaciones del CRM")
+    parser.add_argument("--once", action="store_true", help="Procesa los trabajos pendientes y termina")
+    args = parser.parse_args()
+
+    run_worker(once=args.once)
@@ -0,0 +1,159 @@
+"""
+Configuración de gunicorn para producción (DockerFile: `gunicorn -c gunicorn.conf.py app:app`).
+
+Modos (GUNICORN_MODE):
+- gthread (por defecto): procesos x hilos. Un envío a WPPConnect que espera
+  el ritmo por sesión o la red ocupa un hilo, no el proceso entero, así
+  /health y el CRM siguen respondiendo.
+- gevent: greenlets; requests/psycopg2 se vuelven cooperativos con
+  monkey-patching (gevent y psycogreen en requirements.txt).
+
+Conexiones a Postgres: cada worker abre hasta DB_POOL_SIZE + DB_MAX_OVERFLOW
+(por defecto un slot por hilo más 4). Si workers por eso supera
+DB_WEB_MAX_CONNECTIONS, se arrancan menos workers (ver docker-compose.yml).
+
+La app se carga una vez en el master (preload_app) y cada worker, después
+del fork, descarta las conexiones heredadas y se precalienta (app.warm_up).
+Las métricas de /metrics se agregan entre workers a través de
+PROMETHEUS_MULTIPROC_DIR (se vacía al arrancar el master). Los workers se
+reciclan cada GUNICORN_MAX_REQUESTS peticiones con jitter para que no
+reinicien todos a la vez, y SIGTERM drena las peticiones en curso durante
+graceful_timeout.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+
+# Antes de cargar la app: prometheus_client elige el modo multiproceso al importarse.
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR",
+    os.path.join(tempfile.gettempdir(), "alestur_prometheus"),
+)
+
+GUNICORN_MODE = os.getenv("GUNICORN_MODE", "gthread").strip().lower()
+
+if GUNICORN_MODE == "gevent":
+    # Antes de importar la app en el master (preload_app), para que ssl,
+    # socket y requests queden parcheados desde el inicio.
+    from gevent import monkey
+
+    monkey.patch_all()
+
+    try:
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+    except ImportError:
+        print("[GUNICORN] ⚠️ psycogreen no instalado: las consultas bloquean el worker gevent", flush=True)
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+CPU_COUNT = multiprocessing.cpu_count()
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+
+if GUNICORN_MODE == "gevent":
+    worker_class = "gevent"
+    # Un proceso por CPU alcanza: la concurrencia la dan los greenlets.
+    workers = _env_int("GUNICORN_WORKERS", _env_int("WEB_CONCURRENCY", CPU_COUNT))
+    worker_connections = _env_int("GUNICORN_WORKER_CONNECTIONS", 200)
+else:
+    worker_class = "gthread"
+    workers = _env_int(
+        "GUNICORN_WORKERS",
+        _env_int("WEB_CONCURRENCY", min(2 * CPU_COUNT + 1, _env_int("GUNICORN_MAX_WORKERS", 8))),
+    )
+    threads = _env_int("GUNICORN_THREADS", 8)
+
+# config.py lee el pool al cargar la app (preload_app): se fija antes.
+os.environ.setdefault("DB_POOL_SIZE", str(globals().get("threads", 10)))
+os.environ.setdefault("DB_MAX_OVERFLOW", "4")
+
+DB_WEB_MAX_CONNECTIONS = _env_int("DB_WEB_MAX_CONNECTIONS", 150)
+db_connections_per_worker = int(os.environ["DB_POOL_SIZE"]) + int(os.environ["DB_MAX_OVERFLOW"])
+_db_max_workers = max(1, DB_WEB_MAX_CONNECTIONS // max(1, db_connections_per_worker))
+if workers > _db_max_workers:
+    print(
+        f"[GUNICORN] ⚠️ workers={workers} x {db_connections_per_worker} conexiones supera "
+        f"DB_WEB_MAX_CONNECTIONS={DB_WEB_MAX_CONNECTIONS}: se usan {_db_max_workers} workers",
+        flush=True,
+    )
+    workers = _db_max_workers
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+max_requests = _env_int("GUNICORN_MAX_REQUESTS", 2000)
+max_requests_jitter = _env_int("GUNICORN_MAX_REQUESTS_JITTER", max(1, max_requests // 10))
+
+timeout = _env_int("GUNICORN_TIMEOUT", 60)
+graceful_timeout = _env_int("GUNICORN_GRACEFUL_TIMEOUT", 30)
+keepalive = _env_int("GUNICORN_KEEPALIVE", 5)
+
+accesslog = os.getenv("GUNICORN_ACCESSLOG") or None
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOGLEVEL", "info")
+
+
+def on_starting(server):
+    # Archivos de una ejecución anterior sumarían contadores viejos.
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def when_ready(server):
+    server.log.info(
+        f"[GUNICORN] modo={worker_class} workers={workers} "
+        f"threads={globals().get('threads', 1)} preload={preload_app} "
+        f"max_requests={max_requests}±{max_requests_jitter} "
+        f"db_conexiones={workers * db_connections_per_worker}/{DB_WEB_MAX_CONNECTIONS}"
+    )
+
+
+def post_fork(server, worker):
+    from app import app, db, wake_outbound, warm_up
+    import outbound
+    import session_health
+
+    # Conexiones abiertas en el master no se comparten entre procesos.
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+    # Estado de las sesiones WPP (lo consulta el scheduler): pausa y reanuda
+    # los carriles de envío de este worker.
+    session_health.start(app)
+    # Envíos que quedaron en outbound_messages sin carril (workers muertos,
+    # cola llena, sesión pausada).
+    outbound.start_sweeper(app, wake_outbound)
+
+    try:
+        warm_up()
+        server.log.info(f"[GUNICORN] Worker {worker.pid} precalentado")
+    except Exception as e:
+        # Sin BD al arrancar el worker igual atiende; se calienta con el primer uso.
+        server.log.warning(f"[GUNICORN] Worker {worker.pid} sin precalentar: {e!r}")
+
+
+def worker_int(worker):
+    worker.log.info(f"[GUNICORN] Worker {worker.pid} interrumpido; drenando peticiones en curso")
+
+
+def worker_exit(server, worker):
+    import bot_sessions
+
+    # Envíos que quedaron en los carriles de las sesiones WPP: salen antes de
+    # que el master mate el proceso (graceful_timeout cuenta desde el SIGTERM).
+    bot_sessions.shutdown(timeout=max(1, graceful_timeout // 2))
+    server.log.info(f"[GUNICORN] Worker {worker.pid} terminó")
+
+
+def child_exit(server, worker):
+    import metrics
+
+    metrics.mark_process_dead(worker.pid)
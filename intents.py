@@ -0,0 +1,279 @@
+"""
+Reconocimiento de intenciones en respuestas cortas del cliente.
+
+fold() deja el texto en minúsculas, sin tildes (descomposición NFKD), sin
+puntuación, emojis ni letras fuera del latín y con espacios simples.
+IntentMatcher compara contra el vocabulario de las intenciones que un
+estado reconoce, en cuatro pasos de costo creciente:
+
+1. Frase exacta (dict precompilado): confianza 1.0.
+2. Frase exacta tras quitar muletillas y repeticiones ("sí claro", "no,
+   gracias", "si si"): confianza 0.9.
+3. Letras estiradas o respuesta cortada (dict precompilado sobre las frases
+   sin letras repetidas): "noo", "siii", "aceptooo" 0.9; un prefijo de al
+   menos PREFIX_MIN_LENGTH letras y media frase ("acept", "recha") 0.8.
+4. Distancia de edición acotada (1, o 2 en frases largas) contra las frases
+   del estado con la misma inicial y largo compatible, sin cruzar
+   negaciones ("acepyo", "no aceto"): 0.8 / 0.6. Solo desde
+   FUZZY_MIN_LENGTH letras: en palabras cortas una edición cambia el
+   sentido ("calro" no es "claro" con seguridad). Si dos intenciones
+   empatan no se decide.
+
+Una pregunta ("¿aceptas?", "sii?") solo coincide por los pasos 1 y 2: no
+es una respuesta y no se corrige.
+
+El vocabulario es por estado: "no" es rechazo en esperando_aceptacion y
+respuesta negativa en la encuesta, sin conflicto.
+"""
+import os
+import re
+import unicodedata
+from collections import namedtuple
+
+
+INTENT_MIN_CONFIDENCE = float(os.getenv("INTENT_MIN_CONFIDENCE", "0.6"))
+
+# Frases más cortas no se corrigen: "si" a distancia 1 de "no" no es un typo.
+FUZZY_MIN_LENGTH = 6
+FUZZY_LONG_LENGTH = 9
+PREFIX_MIN_LENGTH = 4
+
+IntentMatch = namedtuple("IntentMatch", ["intent", "confidence"])
+
+VOCABULARY = {
+    "yes": (
+        "si", "s", "sip", "yes", "claro", "claro que si", "por supuesto",
+        "acepto calificar", "calificar", "quiero calificar",
+    ),
+    "no": (
+        "no", "n", "nop", "no calificar", "no quiero", "no quiero calificar",
+        "para nada",
+    ),
+    "accept": (
+        "acepto", "aceptar", "aceptado", "si acepto", "si", "sip", "de acuerdo",
+        "estoy de acuerdo", "acepto la politica", "autorizo", "si autorizo",
+    ),
+    "reject": (
+        "no acepto", "no aceptar", "no", "nop", "rechazo", "rechazar",
+        "no autorizo", "no estoy de acuerdo",
+    ),
+}
+
+# Palabras que acompañan una respuesta sin cambiar su sentido.
+FILLER_WORDS = frozenset({
+    "ok", "okay", "vale", "bueno", "listo", "perfecto", "dale", "claro",
+    "gracias", "muchas", "por", "favor", "porfa", "pues", "ya", "senor",
+    "senora", "senorita", "hola", "buenas", "buenos", "dias", "tardes",
+    "noches", "entonces", "muy", "bien", "obvio",
+})
+
+NEGATIONS = frozenset({"no", "n", "nop"})
+
+# Byte ASCII -> sí mismo si es letra o dígito, espacio si no.
+_WORD_BYTES = bytes(code if chr(code).isascii() and chr(code).isalnum() else 32 for code in range(256))
+_REPEATED = re.compile(r"(.)\1+")
+
+
+def fold(text):
+    text = (text or "").casefold()
+
+    if text.isascii():
+        raw = text.encode("ascii")
+    else:
+        # NFKD separa letra y tilde; la codificación ASCII descarta las
+        # tildes y lo que no es latín (emojis) sin recorrer carácter a carácter.
+        raw = unicodedata.normalize("NFKD", text).encode("ascii", "ignore")
+
+    return " ".join(raw.translate(_WORD_BYTES).decode("ascii").split())
+
+
+def squeeze(folded):
+    """Letras repetidas seguidas como una sola ("siii" -> "si")."""
+    if _REPEATED.search(folded) is None:
+        return folded
+    return _REPEATED.sub(lambda match: match.group(1), folded)
+
+
+def _core(folded):
+    """Quita muletillas de los extremos y palabras repetidas seguidas."""
+    tokens = folded.split(" ")
+
+    start, end = 0, len(tokens)
+    while start < end and tokens[start] in FILLER_WORDS:
+        start += 1
+    while end > start and tokens[end - 1] in FILLER_WORDS:
+        end -= 1
+
+    if start == end:
+        return folded
+
+    core = []
+    for token in tokens[start:end]:
+        if not core or core[-1] != token:
+            core.append(token)
+
+    return " ".join(core)
+
+
+def within_one_edit(a, b):
+    """
+    True si a y b difieren en a lo sumo una inserción, borrado, sustitución
+    o transposición de letras vecinas. Lineal y sin tabla: es el caso común.
+    """
+    len_a, len_b = len(a), len(b)
+    if len_a < len_b:
+        a, b, len_a, len_b = b, a, len_b, len_a
+    if len_a - len_b > 1:
+        return False
+
+    i = 0
+    while i < len_b and a[i] == b[i]:
+        i += 1
+    if i == len_b:
+        return True
+
+    if len_a > len_b:
+        return a[i + 1:] == b[i:]
+
+    if a[i + 1:] == b[i + 1:]:
+        return True
+
+    return a[i] == b[i + 1] and a[i + 1] == b[i] and a[i + 2:] == b[i + 2:]
+
+
+def bounded_distance(a, b, limit):
+    """Levenshtein entre a y b, o limit + 1 si supera limit (corta temprano)."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    if limit == 1:
+        return (0 if a == b else 1) if within_one_edit(a, b) else 2
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        row_min = i
+        for j, char_b in enumerate(b, 1):
+            value = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b),
+            )
+            current.append(value)
+            if value < row_min:
+                row_min = value
+        if row_min > limit:
+            return limit + 1
+        previous = current
+
+    return previous[-1]
+
+
+def _is_negated(phrase):
+    return phrase.split(" ", 1)[0] in NEGATIONS
+
+
+def _add_loose(loose, key, match):
+    """Una clave que dos intenciones reclaman queda en None (no se decide)."""
+    current = loose.get(key, match)
+    if current is None or current.intent != match.intent:
+        loose[key] = None
+    elif match.confidence >= current.confidence:
+        loose[key] = match
+
+
+class IntentMatcher:
+    def __init__(self, vocabulary):
+        self.intents = tuple(vocabulary)
+        self.exact = {}
+
+        for intent, phrases in vocabulary.items():
+            for phrase in phrases:
+                phrase = fold(phrase)
+                owner = self.exact.setdefault(phrase, intent)
+                if owner != intent:
+                    raise ValueError(f"La frase '{phrase}' está en {owner} y en {intent}")
+
+        # Paso 3: frase sin letras repetidas y sus prefijos, ya resueltos.
+        self.loose = {}
+        for phrase, intent in self.exact.items():
+            squeezed = squeeze(phrase)
+            for length in range(max(PREFIX_MIN_LENGTH, (len(squeezed) + 1) // 2), len(squeezed)):
+                if squeezed[length - 1] != " ":
+                    _add_loose(self.loose, squeezed[:length], IntentMatch(intent, 0.8))
+        for phrase, intent in self.exact.items():
+            # Una frase completa manda sobre el prefijo de otra más larga.
+            self.loose.pop(squeeze(phrase), None)
+        for phrase, intent in self.exact.items():
+            _add_loose(self.loose, squeeze(phrase), IntentMatch(intent, 0.9))
+
+        # Paso 4: por (inicial, largo), así solo se miden las compatibles.
+        self.fuzzy_buckets = {}
+        for phrase, intent in self.exact.items():
+            if len(phrase) >= FUZZY_MIN_LENGTH:
+                self.fuzzy_buckets.setdefault((phrase[0], len(phrase)), []).append(
+                    (phrase, intent, _is_negated(phrase))
+                )
+        # Más largo que esto (aun con letras estiradas) es texto libre.
+        self.max_length = 2 * max((len(phrase) for phrase in self.exact), default=0) + 2
+
+    def match(self, text):
+        """IntentMatch(intent, confidence) o None si nada coincide."""
+        folded = fold(text)
+        if not folded:
+            return None
+
+        intent = self.exact.get(folded)
+        if intent is not None:
+            return IntentMatch(intent, 1.0)
+
+        core = _core(folded)
+        if core != folded:
+            intent = self.exact.get(core)
+            if intent is not None:
+                return IntentMatch(intent, 0.9)
+
+        if "?" in text or "¿" in text:
+            return None
+
+        # Lo que no entra en ninguna frase (texto libre) se descarta sin más.
+        if len(core) > self.max_length:
+            return None
+
+        match = self.loose.get(squeeze(core))
+        if match is not None:
+            return match
+
+        return self._fuzzy(core)
+
+    def _fuzzy(self, core):
+        length = len(core)
+        if length < FUZZY_MIN_LENGTH:
+            return None
+
+        limit = 2 if length >= FUZZY_LONG_LENGTH else 1
+        negated = _is_negated(core)
+        best = {}
+
+        for phrase_length in range(length - limit, length + limit + 1):
+            for phrase, intent, phrase_negated in self.fuzzy_buckets.get((core[0], phrase_length), ()):
+                if phrase_negated != negated:
+                    continue
+                distance = bounded_distance(core, phrase, limit)
+                if distance <= limit and distance < best.get(intent, limit + 1):
+                    best[intent] = distance
+
+        if not best:
+            return None
+
+        distance = min(best.values())
+        winners = [intent for intent, value in best.items() if value == distance]
+        if len(winners) > 1:
+            return None
+
+        return IntentMatch(winners[0], 0.8 if distance == 1 else 0.6)
+
+
+def build_matcher(intents, vocabulary=None):
+    vocabulary = vocabulary or VOCABULARY
+    return IntentMatcher({intent: vocabulary[intent] for intent in intents})
@@ -0,0 +1,271 @@
+"""
+Logs estructurados (una línea JSON por registro) con niveles, muestreo por
+categoría, truncado/redacción de payloads y escritura fuera del hilo de la
+petición.
+
+Uso:
+    log = logs.get_logger("wpp")
+    log.info("📤 WPPConnect enviado", path=path, status=200, ms=35.2)
+    log.debug("📤 WPPConnect payload", payload=payload)
+
+- Nivel: LOG_LEVEL (INFO). Los payloads completos (cuerpo del webhook,
+  payload y respuesta de WPPConnect) van en DEBUG.
+- Formato: LOG_FORMAT=json (por defecto) o text para desarrollo local.
+- Muestreo: LOG_SAMPLING="webhook=0.1,wpp=0.5" deja pasar esa fracción de
+  los registros DEBUG/INFO de cada categoría (y sus subcategorías, p. ej.
+  "wpp.media"). WARNING y superiores nunca se muestrean.
+- Campos: textos de más de LOG_MAX_FIELD_CHARS se truncan, las listas y
+  dicts se recortan a LOG_MAX_ITEMS elementos, y las claves con token,
+  authorization, password, secret o base64 (más LOG_REDACT_KEYS) se
+  reemplazan. Se hace en el hilo que loguea, antes de encolar, así el
+  registro no retiene payloads grandes.
+- Cada registro lleva trace_id (tracing.current_trace_id()) y pid.
+- Un hilo por proceso serializa y escribe en stdout desde una cola acotada;
+  si se llena, los registros se descartan y se avisa cuántos en el
+  siguiente.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+import tracing
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").strip().lower()
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "500"))
+LOG_MAX_ITEMS = int(os.getenv("LOG_MAX_ITEMS", "20"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_REDACT_KEYS = os.getenv("LOG_REDACT_KEYS", "")
+
+ROOT_LOGGER = "alestur"
+
+_REDACT_FRAGMENTS = tuple(
+    fragment.strip().lower()
+    for fragment in ("token,authorization,password,secret,api_key,base64," + LOG_REDACT_KEYS).split(",")
+    if fragment.strip()
+)
+_MAX_DEPTH = 6
+# Argumentos propios de logging.Logger; el resto de kwargs son campos.
+_LOGGING_KWARGS = {"exc_info", "stack_info", "stacklevel", "extra"}
+
+
+def _parse_sampling(value):
+    rates = {}
+    for part in value.split(","):
+        if "=" not in part:
+            continue
+        category, rate = part.split("=", 1)
+        try:
+            rates[category.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+SAMPLING = _parse_sampling(LOG_SAMPLING)
+
+
+def sample_rate_for(category):
+    """Tasa de la categoría configurada más específica (1 si ninguna aplica)."""
+    while category:
+        if category in SAMPLING:
+            return SAMPLING[category]
+        category = category.rpartition(".")[0]
+    return 1.0
+
+
+# ============================================================
+# TRUNCADO Y REDACCIÓN
+# ============================================================
+def _redacted(key):
+    key = str(key).lower()
+    return any(fragment in key for fragment in _REDACT_FRAGMENTS)
+
+
+def sanitize(value, depth=0):
+    """Copia acotada de value apta para JSON: trunca, recorta y redacta."""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+
+    if isinstance(value, bytes):
+        return f"<{len(value)} bytes>"
+
+    if isinstance(value, str):
+        if len(value) > LOG_MAX_FIELD_CHARS:
+            return f"{value[:LOG_MAX_FIELD_CHARS]}…(+{len(value) - LOG_MAX_FIELD_CHARS})"
+        return value
+
+    if depth >= _MAX_DEPTH:
+        return f"<{type(value).__name__}>"
+
+    if isinstance(value, dict):
+        result = {}
+        for index, (key, item) in enumerate(value.items()):
+            if index >= LOG_MAX_ITEMS:
+                result["…"] = f"+{len(value) - LOG_MAX_ITEMS} claves"
+                break
+            if _redacted(key):
+                result[str(key)] = f"<redactado {len(item)} chars>" if isinstance(item, (str, bytes)) else "<redactado>"
+            else:
+                result[str(key)] = sanitize(item, depth + 1)
+        return result
+
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        result = [sanitize(item, depth + 1) for item in items[:LOG_MAX_ITEMS]]
+        if len(items) > LOG_MAX_ITEMS:
+            result.append(f"…+{len(items) - LOG_MAX_ITEMS}")
+        return result
+
+    return sanitize(str(value), depth)
+
+
+# ============================================================
+# API
+# ============================================================
+class CategoryLogger(logging.LoggerAdapter):
+    """Logger de una categoría: los kwargs que no son de logging pasan a ser campos."""
+
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in _LOGGING_KWARGS}
+        extra = dict(kwargs.get("extra") or {})
+        extra["fields"] = fields
+        kwargs["extra"] = extra
+        return msg, kwargs
+
+
+_loggers = {}
+
+
+def get_logger(category):
+    logger = _loggers.get(category)
+    if logger is None:
+        logger = _loggers[category] = CategoryLogger(logging.getLogger(f"{ROOT_LOGGER}.{category}"), {})
+    return logger
+
+
+# ============================================================
+# HANDLER Y FORMATO
+# ============================================================
+class _AsyncHandler(QueueHandler):
+    """
+    Encola sin bloquear. filter() y prepare() corren en el hilo que loguea:
+    muestrean, toman trace_id (ContextVar de la petición) y dejan el
+    registro acotado.
+    El hilo de escritura se arranca por proceso (el del master de gunicorn
+    no sobrevive al fork).
+    """
+
+    def __init__(self, target):
+        super().__init__(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        self.target = target
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            rate = sample_rate_for(record.name[len(ROOT_LOGGER) + 1:])
+            if rate < 1.0 and random.random() >= rate:
+                return False
+        return super().filter(record)
+
+    def prepare(self, record):
+        record.trace_id = tracing.current_trace_id()
+        record.message = record.getMessage()
+        record.fields = sanitize(getattr(record, "fields", None) or {})
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+
+        if self.dropped:
+            record.fields["logs_descartados"] = self.dropped
+            self.dropped = 0
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_listener(self):
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+                self.listener = QueueListener(self.queue, self.target)
+                self.listener.start()
+                self.pid = os.getpid()
+
+    def stop(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self.pid = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "category": record.name[len(ROOT_LOGGER) + 1:] or ROOT_LOGGER,
+            "msg": record.getMessage(),
+            "trace_id": getattr(record, "trace_id", None),
+            "pid": record.process,
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = " ".join(f"{key}={value}" for key, value in (getattr(record, "fields", None) or {}).items())
+        trace_id = getattr(record, "trace_id", None)
+        line = (
+            f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.levelname:7} "
+            f"[{record.name[len(ROOT_LOGGER) + 1:]}] {record.getMessage()}"
+            + (f" {fields}" if fields else "")
+            + (f" trace={trace_id}" if trace_id else "")
+        )
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+def _configure():
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+
+    handler = _AsyncHandler(output)
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    root.addHandler(handler)
+    root.propagate = False
+    return handler
+
+
+_handler = _configure()
+atexit.register(_handler.stop)
+
+
+def flush():
+    """Escribe lo encolado (salidas de scripts y CLI)."""
+    _handler.stop()
@@ -0,0 +1,376 @@
+"""
+Multimedia entrante (imágenes, audios, notas de voz, documentos).
+
+El webhook solo registra el Message con media_status='pending'; este módulo
+(ejecutado como `python media_store.py` en el servicio `media` de
+docker-compose) descarga cada archivo desde WPPConnect por bloques, sin
+cargarlo completo en memoria, y lo guarda en MEDIA_DIR con su SHA-256 como
+nombre: un mismo archivo reenviado por varios clientes se guarda una vez.
+
+El worker toma cada mensaje (media_status='downloading', media_claimed_at)
+con un commit corto y descarga sin transacción abierta: ni conexión del
+pool ocupada ni lock de fila durante la descarga. El resultado se guarda
+solo si el mensaje sigue siendo de esa toma. Un mensaje en downloading
+más viejo que MEDIA_STALE_MINUTES (su worker murió) vuelve a pending.
+"""
+import argparse
+import base64
+import hashlib
+import os
+import re
+import tempfile
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.exc import IntegrityError
+
+import logs
+import whatsappservice
+from models import db, Message, MediaAsset, Session, User
+from session_deadlines import naive_utc
+
+
+MEDIA_DIR = os.getenv(
+    "MEDIA_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "media"),
+)
+MEDIA_CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_SIZE", str(64 * 1024)))
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(100 * 1024 * 1024)))
+MEDIA_POLL_SECONDS = float(os.getenv("MEDIA_POLL_SECONDS", "2"))
+MEDIA_MAX_ATTEMPTS = int(os.getenv("MEDIA_MAX_ATTEMPTS", "5"))
+MEDIA_STALE_MINUTES = int(os.getenv("MEDIA_STALE_MINUTES", "15"))
+
+log = logs.get_logger("media")
+
+# Tipo de WPPConnect -> (message_type guardado, etiqueta para el texto)
+MEDIA_TYPES = {
+    "image": ("image", "Imagen"),
+    "video": ("video", "Video"),
+    "audio": ("audio", "Audio"),
+    "ptt": ("voice", "Nota de voz"),
+    "document": ("document", "Documento"),
+    "sticker": ("sticker", "Sticker"),
+}
+
+# WPPConnect responde {"base64": "..."} o {"data": "data:<mime>;base64,..."}.
+_BASE64_FIELD = re.compile(rb'"(?:base64|data)"\s*:\s*"')
+_KEY_LOOKBEHIND = 64
+
+
+# Lo que la descarga necesita del mensaje, leído antes de soltar la transacción.
+MediaClaim = namedtuple("MediaClaim", ["message_id", "attempt", "external_id", "bot_session", "mime_type"])
+
+
+def utcnow():
+    return naive_utc(datetime.now(timezone.utc))
+
+
+class MediaDownloadError(Exception):
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+def media_message_fields(wpp_type, caption=None, filename=None):
+    """(message_type, message_text) para registrar un mensaje multimedia."""
+    message_type, label = MEDIA_TYPES[wpp_type]
+    text = (caption or "").strip()
+
+    if not text:
+        text = f"[{label}] {filename}" if filename else f"[{label}]"
+
+    return message_type, text
+
+
+def asset_path(sha256):
+    return os.path.join(MEDIA_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+# ============================================================
+# DESCARGA POR BLOQUES
+# ============================================================
+def iter_base64_field(chunks):
+    """
+    Decodifica el campo base64 de una respuesta JSON a medida que llega,
+    sin armar el JSON en memoria: busca la clave, salta un posible prefijo
+    data URI y decodifica de a múltiplos de 4 caracteres.
+    """
+    chunks = iter(chunks)
+    buffer = b""
+
+    for chunk in chunks:
+        buffer += chunk
+        match = _BASE64_FIELD.search(buffer)
+        if match:
+            buffer = buffer[match.end():]
+            break
+        buffer = buffer[-_KEY_LOOKBEHIND:]
+    else:
+        raise MediaDownloadError("La respuesta de WPPConnect no trae el archivo", permanent=True)
+
+    # Prefijo data:<mime>;base64, (corto: cabe en uno o dos bloques)
+    while len(buffer) < 5 or (buffer.startswith(b"data:") and b"," not in buffer):
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        buffer += chunk
+    if buffer.startswith(b"data:") and b"," in buffer:
+        buffer = buffer.split(b",", 1)[1]
+
+    pending = b""
+    pieces = [buffer]
+
+    while True:
+        for piece in pieces:
+            end = piece.find(b'"')
+            data = pending + (piece if end < 0 else piece[:end])
+            usable = len(data) - len(data) % 4
+            if usable:
+                yield base64.b64decode(data[:usable])
+            pending = data[usable:]
+
+            if end >= 0:
+                if pending:
+                    yield base64.b64decode(pending + b"=" * (-len(pending) % 4))
+                return
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise MediaDownloadError("Respuesta de WPPConnect incompleta")
+        pieces = [chunk]
+
+
+def iter_media_chunks(response):
+    chunks = response.iter_content(MEDIA_CHUNK_SIZE)
+
+    if "json" in (response.headers.get("Content-Type") or "").lower():
+        return iter_base64_field(chunks)
+
+    return chunks
+
+
+def store_stream(chunks):
+    """
+    Escribe los bloques en un temporal calculando el SHA-256 al vuelo y lo
+    mueve a su ruta definitiva; si ya existía (mismo contenido) se descarta.
+    Devuelve (sha256, tamaño).
+    """
+    tmp_dir = os.path.join(MEDIA_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix=".part")
+    digest = hashlib.sha256()
+    size = 0
+
+    try:
+        with os.fdopen(fd, "wb") as fileobj:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > MEDIA_MAX_BYTES:
+                    raise MediaDownloadError(f"Archivo mayor a {MEDIA_MAX_BYTES} bytes", permanent=True)
+                digest.update(chunk)
+                fileobj.write(chunk)
+
+        if size == 0:
+            raise MediaDownloadError("Archivo vacío")
+
+        sha256 = digest.hexdigest()
+        final_path = asset_path(sha256)
+
+        if os.path.exists(final_path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+
+        return sha256, size
+
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def register_asset(sha256, size, mime_type):
+    asset = MediaAsset.query.filter_by(sha256=sha256).first()
+    if asset:
+        return asset
+
+    try:
+        # Savepoint: otro worker pudo registrar el mismo contenido a la vez.
+        with db.session.begin_nested():
+            asset = MediaAsset(sha256=sha256, size=size, mime_type=mime_type)
+            db.session.add(asset)
+    except IntegrityError:
+        asset = MediaAsset.query.filter_by(sha256=sha256).one()
+
+    return asset
+
+
+def download_message_media(claim):
+    """Descarga y guarda el archivo, sin tocar la base de datos. Devuelve (sha256, tamaño, mime)."""
+    response = whatsappservice.open_media_stream(claim.external_id, session_name=claim.bot_session)
+
+    with response:
+        if response.status_code >= 400:
+            raise MediaDownloadError(
+                f"WPPConnect respondió {response.status_code}",
+                permanent=400 <= response.status_code < 500 and response.status_code != 429,
+            )
+
+        sha256, size = store_stream(iter_media_chunks(response))
+
+    mime_type = claim.mime_type
+    if not mime_type and "json" not in (response.headers.get("Content-Type") or ""):
+        mime_type = response.headers.get("Content-Type")
+
+    return sha256, size, mime_type
+
+
+# ============================================================
+# WORKER
+# ============================================================
+def claim_next_download():
+    """
+    Toma el siguiente mensaje pendiente: downloading, media_claimed_at y un
+    intento más, confirmados antes de descargar. SKIP LOCKED reparte entre
+    varios workers; el lock dura solo este commit. Devuelve un MediaClaim o
+    None.
+    """
+    row = (
+        db.session.query(Message, User.bot_session)
+        .outerjoin(Session, Session.id == Message.session_id)
+        .outerjoin(User, User.id == Session.user_id)
+        .filter(Message.media_status == "pending")
+        .order_by(Message.media_attempts.asc(), Message.id.asc())
+        .with_for_update(of=Message, skip_locked=True)
+        .first()
+    )
+
+    if not row:
+        db.session.rollback()
+        return None
+
+    message, bot_session = row
+    message.media_status = "downloading"
+    message.media_claimed_at = utcnow()
+    message.media_attempts += 1
+    claim = MediaClaim(message.id, message.media_attempts, message.external_id, bot_session, message.media_mime_type)
+    db.session.commit()
+    return claim
+
+
+def _update_claimed(claim, values):
+    """Guarda el resultado solo si el mensaje sigue siendo de esta toma."""
+    count = (
+        Message.query
+        .filter_by(id=claim.message_id, media_status="downloading", media_attempts=claim.attempt)
+        .update(values, synchronize_session=False)
+    )
+    db.session.commit()
+    return count
+
+
+def process_download(claim):
+    """Descarga un mensaje reclamado. Devuelve True si quedó listo."""
+    started = time.monotonic()
+
+    try:
+        sha256, size, mime_type = download_message_media(claim)
+    except Exception as e:
+        permanent = isinstance(e, MediaDownloadError) and e.permanent
+        status = "error" if permanent or claim.attempt >= MEDIA_MAX_ATTEMPTS else "pending"
+        _update_claimed(claim, {"media_status": status, "media_claimed_at": None})
+
+        log.error(
+            "❌ Descarga de multimedia falló", message_id=claim.message_id, attempt=claim.attempt,
+            status=status, error=repr(e),
+        )
+        return False
+
+    # Transacción nueva, después de la descarga.
+    try:
+        asset = register_asset(sha256, size, mime_type)
+        updated = _update_claimed(claim, {
+            "media_asset_id": asset.id,
+            "media_status": "ready",
+            "media_claimed_at": None,
+        })
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if not updated:
+        log.warning("⚠️ Descarga retomada por otro worker; se descarta", message_id=claim.message_id)
+        return False
+
+    log.info(
+        "Multimedia lista", message_id=claim.message_id, sha256=sha256[:12],
+        bytes=size, seconds=round(time.monotonic() - started, 1),
+    )
+    return True
+
+
+def requeue_stale_downloads():
+    """
+    Devuelve a pending las descargas cuyo worker murió a mitad de camino
+    (o a error, si ya agotaron sus intentos).
+    """
+    cutoff = utcnow() - timedelta(minutes=MEDIA_STALE_MINUTES)
+    stale = (
+        Message.query
+        .filter(Message.media_status == "downloading", Message.media_claimed_at < cutoff)
+    )
+    exhausted = stale.filter(Message.media_attempts >= MEDIA_MAX_ATTEMPTS).update(
+        {"media_status": "error", "media_claimed_at": None}, synchronize_session=False
+    )
+    count = stale.update({"media_status": "pending", "media_claimed_at": None}, synchronize_session=False)
+    db.session.commit()
+
+    if count or exhausted:
+        log.warning("Reencoladas descargas sin terminar", messages=count, errors=exhausted)
+
+
+def run_worker(once=False):
+    from app import app
+
+    with app.app_context():
+        os.makedirs(MEDIA_DIR, exist_ok=True)
+        log.info("Worker iniciado", directory=MEDIA_DIR)
+
+        last_maintenance = 0.0
+
+        while True:
+            try:
+                if time.monotonic() - last_maintenance > 60:
+                    requeue_stale_downloads()
+                    last_maintenance = time.monotonic()
+
+                claim = claim_next_download()
+
+                if claim:
+                    # Tras un fallo se espera un poco para no reintentar en caliente.
+                    if process_download(claim) or once:
+                        continue
+
+                elif once:
+                    return
+
+            except Exception as e:
+                db.session.rollback()
+                log.error("❌ Error en el worker de multimedia", error=repr(e), exc_info=True)
+                if once:
+                    raise
+
+            time.sleep(MEDIA_POLL_SECONDS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker de descargas de multimedia")
+    parser.add_argument("--once", action="store_true", help="Procesa las descargas pendientes y termina")
+    args = parser.parse_args()
+
+    run_worker(once=args.once)
@@ -0,0 +1,217 @@
+"""
+Métricas en formato Prometheus, expuestas en GET /metrics.
+
+Con gunicorn cada worker es un proceso con sus propios contadores: si
+PROMETHEUS_MULTIPROC_DIR está definido (gunicorn.conf.py lo define antes de
+cargar la app), prometheus_client escribe los valores en archivos mmap de
+ese directorio y /metrics los agrega entre todos los workers, vivos o
+reciclados. Sin la variable (flask run, scripts) se usa el registro del
+proceso.
+
+Las consultas y commits se cuentan por petición con eventos de SQLAlchemy;
+fuera de una petición (scheduler, workers) no se cuentan.
+"""
+import glob
+import os
+import time
+
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session as OrmSession
+
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 20, 30, 50, 100, 200)
+
+
+# ============================================================
+# MÉTRICAS
+# ============================================================
+HTTP_REQUEST_SECONDS = Histogram(
+    "alestur_http_request_seconds",
+    "Latencia de las peticiones HTTP por ruta",
+    ["route", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "alestur_db_queries_per_request",
+    "Consultas SQL ejecutadas por petición",
+    ["route"],
+    buckets=COUNT_BUCKETS,
+)
+DB_COMMITS_PER_REQUEST = Histogram(
+    "alestur_db_commits_per_request",
+    "Commits por petición",
+    ["route"],
+    buckets=COUNT_BUCKETS,
+)
+CONVERSATION_SECONDS = Histogram(
+    "alestur_conversation_seconds",
+    "Procesamiento de los mensajes de una conversación (handle_new_message), por estado inicial",
+    ["state"],
+    buckets=LATENCY_BUCKETS,
+)
+WPP_REQUEST_SECONDS = Histogram(
+    "alestur_wpp_request_seconds",
+    "Latencia de las llamadas a WPPConnect (incluye la espera por ritmo de la sesión)",
+    ["session", "path"],
+    buckets=LATENCY_BUCKETS,
+)
+WPP_REQUESTS = Counter(
+    "alestur_wpp_requests_total",
+    "Llamadas a WPPConnect por resultado HTTP (2xx, 4xx, 5xx, error)",
+    ["session", "path", "outcome"],
+)
+WPP_FALLBACKS = Counter(
+    "alestur_wpp_fallbacks_total",
+    "Mensajes reenviados como texto porque el formato original falló (list, buttons, document)",
+    ["session", "kind"],
+)
+WPP_UNDELIVERED = Counter(
+    "alestur_wpp_undelivered_total",
+    "Envíos que WhatsApp no entregó, por endpoint (lista y archivo se reintentan como texto)",
+    ["session", "path"],
+)
+PHP_LEAD_SECONDS = Histogram(
+    "alestur_php_lead_seconds",
+    "Latencia del envío de leads a la API PHP",
+    ["outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+SESSION_QUEUE_DEPTH = Gauge(
+    "alestur_session_queue_depth",
+    "Contactos con envíos en cola o en curso por sesión de bot (suma de los workers vivos)",
+    ["session"],
+    multiprocess_mode="livesum",
+)
+SESSION_QUEUE_WAIT_SECONDS = Histogram(
+    "alestur_session_queue_wait_seconds",
+    "Espera en la cola de la sesión de bot antes de empezar los envíos",
+    ["session"],
+    buckets=LATENCY_BUCKETS,
+)
+SESSION_JOB_SECONDS = Histogram(
+    "alestur_session_job_seconds",
+    "Duración de los envíos de una conversación en el carril de su sesión de bot",
+    ["session"],
+    buckets=LATENCY_BUCKETS,
+)
+SESSION_QUEUE_OVERFLOWS = Counter(
+    "alestur_session_queue_overflows_total",
+    "Contactos que no entraron en la cola llena de la sesión de bot (sus envíos esperan al barrido)",
+    ["session"],
+)
+BUDGET_OVERRUNS = Counter(
+    "alestur_budget_overruns_total",
+    "Presupuesto de tiempo de la petición agotado: trabajo diferido o petición pasada de su deadline",
+    ["budget", "stage"],
+)
+WPP_SESSION_CONNECTED = Gauge(
+    "alestur_wpp_session_connected",
+    "1 si WPPConnect reporta la sesión conectada, 0 si está pausada (mínimo de los workers vivos)",
+    ["session"],
+    multiprocess_mode="livemin",
+)
+
+
+def outcome_for_status(status_code):
+    return f"{status_code // 100}xx"
+
+
+# ============================================================
+# POR PETICIÓN
+# ============================================================
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g._metrics_queries = g.get("_metrics_queries", 0) + 1
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _count_commit(session):
+    if has_request_context():
+        g._metrics_commits = g.get("_metrics_commits", 0) + 1
+
+
+def _start_request():
+    g._metrics_started = time.perf_counter()
+
+
+def _observe_request(response):
+    started = g.get("_metrics_started")
+    if started is None:
+        return response
+
+    route = request.url_rule.rule if request.url_rule else "<sin_ruta>"
+    if route == "/metrics":
+        return response
+
+    HTTP_REQUEST_SECONDS.labels(route, request.method, outcome_for_status(response.status_code)).observe(
+        time.perf_counter() - started
+    )
+    DB_QUERIES_PER_REQUEST.labels(route).observe(g.get("_metrics_queries", 0))
+    DB_COMMITS_PER_REQUEST.labels(route).observe(g.get("_metrics_commits", 0))
+    return response
+
+
+def metrics_view():
+    if METRICS_TOKEN:
+        auth = request.headers.get("Authorization", "")
+        if auth != f"Bearer {METRICS_TOKEN}":
+            return Response("No autorizado\n", status=401, mimetype="text/plain")
+
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def live_totals(metric_name, label):
+    """
+    {valor de `label`: suma} de un Gauge livesum entre los workers vivos
+    (o del proceso, sin PROMETHEUS_MULTIPROC_DIR).
+    """
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        families = multiprocess.MultiProcessCollector.merge(
+            glob.glob(os.path.join(metrics_dir, "gauge_livesum_*.db")), accumulate=True
+        )
+    else:
+        families = REGISTRY.collect()
+
+    totals = {}
+    for family in families:
+        if family.name != metric_name:
+            continue
+        for sample in family.samples:
+            key = sample.labels.get(label)
+            totals[key] = totals.get(key, 0) + sample.value
+    return totals
+
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_observe_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view, methods=["GET"])
+
+
+def mark_process_dead(pid):
+    """Para gunicorn child_exit: descarta los archivos live de un worker muerto."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
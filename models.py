@@ -29,6 +29,24 @@ class Session(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     current_state_id = db.Column(db.Integer, db.ForeignKey("states.id"))
     last_message_time = db.Column(db.DateTime, server_default=db.func.now())
+    # Próximo vencimiento del barrido de inactividad (ver session_deadlines.py).
+    next_deadline = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # Índice parcial para el tablero de sesiones activas y el cron:
+        # solo indexa las sesiones abiertas, que son una fracción de la tabla.
+        db.Index(
+            "ix_sessions_active_id",
+            "id",
+            postgresql_where=db.text("is_active = true"),
+        ),
+        db.Index(
+            "ix_sessions_next_deadline",
+            "next_deadline",
+            postgresql_where=db.text("is_active = true"),
+        ),
+        db.Index("ix_sessions_user_id", "user_id"),
+    )
 
     user = db.relationship("User", back_populates="sessions")
     messages = db.relationship("Message", back_populates="session", cascade="all, delete-orphan")
@@ -54,8 +72,42 @@ class Message(db.Model):
     message_text = db.Column(db.Text, nullable=False)
     message_type = db.Column(db.String(20), default="text")
     timestamp = db.Column(db.DateTime, server_default=db.func.now())
+    # Id del mensaje en WPPConnect; lo necesita la descarga de multimedia.
+    external_id = db.Column(db.String(255))
+    # Multimedia entrante: pending -> downloading -> ready | error (ver media_store.py).
+    media_status = db.Column(db.String(20))
+    media_asset_id = db.Column(db.Integer, db.ForeignKey("media_assets.id"))
+    media_filename = db.Column(db.String(255))
+    media_mime_type = db.Column(db.String(120))
+    media_attempts = db.Column(db.Integer, nullable=False, default=0)
+    media_claimed_at = db.Column(db.DateTime)  # toma del worker en curso (downloading)
+
+    __table_args__ = (
+        db.Index(
+            "ix_messages_media_pending",
+            "id",
+            postgresql_where=db.text("media_status = 'pending'"),
+        ),
+        db.Index(
+            "ix_messages_media_downloading",
+            "media_claimed_at",
+            postgresql_where=db.text("media_status = 'downloading'"),
+        ),
+    )
 
     session = db.relationship("Session", back_populates="messages")
+    media_asset = db.relationship("MediaAsset")
+
+
+class MediaAsset(db.Model):
+    """Archivo recibido, guardado una sola vez por contenido (SHA-256)."""
+    __tablename__ = "media_assets"
+
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)
+    mime_type = db.Column(db.String(120))
+    size = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
 
 
 class SessionContext(db.Model):
@@ -67,6 +119,10 @@ class SessionContext(db.Model):
     context_value = db.Column(db.Text)
     updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
 
+    __table_args__ = (
+        db.Index("ix_session_context_session_key", "session_id", "context_key"),
+    )
+
     session = db.relationship("Session", back_populates="context")
 
 
@@ -81,3 +137,129 @@ class PolicyConsent(db.Model):
 
     user = db.relationship("User", backref="policy_consents")
     session = db.relationship("Session", backref="policy_consents")
+
+
+class ExportJob(db.Model):
+    __tablename__ = "export_jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'contacts', 'messages' o 'conversation'
+    export_format = db.Column(db.String(10), nullable=False, default="csv")  # 'csv' o 'jsonl'
+    params = db.Column(db.Text)  # JSON con filtros (rango de fechas, user_id, bot_session)
+    status = db.Column(db.String(20), nullable=False, default="pending")  # pending, running, done, error
+    rows_written = db.Column(db.Integer, nullable=False, default=0)
+    total_rows = db.Column(db.Integer)
+    file_path = db.Column(db.Text)
+    file_size = db.Column(db.BigInteger)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # último lote escrito por el worker que lo tiene
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # cada toma suma uno
+
+    __table_args__ = (
+        db.Index("ix_export_jobs_status_id", "status", "id"),
+    )
+
+
+class LeadOutbox(db.Model):
+    """Cola persistente de leads hacia la API PHP (ver php_leads_service.py)."""
+    __tablename__ = "lead_outbox"
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey("sessions.id"), nullable=False)
+    external_reference = db.Column(db.String(255), nullable=False)  # bot_session:teléfono, clave de upsert en PHP
+    payload = db.Column(db.Text, nullable=False)  # JSON del lead
+    status = db.Column(db.String(20), nullable=False, default="pending")  # pending, sending, sent, error
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, server_default=db.func.now())
+    claimed_at = db.Column(db.DateTime)  # toma del worker en curso (sending)
+    # Error definitivo (4xx de PHP): reconcile() no lo reencola.
+    permanent = db.Column(db.Boolean, nullable=False, default=False)
+    response_status = db.Column(db.Integer)
+    last_error = db.Column(db.Text)
+    trace_id = db.Column(db.String(32))
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index(
+            "ix_lead_outbox_pending_due",
+            "next_attempt_at",
+            postgresql_where=db.text("status = 'pending'"),
+        ),
+        db.Index(
+            "ix_lead_outbox_pending_reference",
+            "external_reference",
+            postgresql_where=db.text("status = 'pending'"),
+        ),
+        db.Index("ix_lead_outbox_session_id", "session_id"),
+        db.Index(
+            "ix_lead_outbox_sending",
+            "claimed_at",
+            postgresql_where=db.text("status = 'sending'"),
+        ),
+    )
+
+
+class OutboundMessage(db.Model):
+    """
+    Envíos a WPPConnect pendientes de una conversación (ver outbound.py). Se
+    insertan en la misma transacción que la transición que los produce y los
+    drenan, en orden por contacto, los carriles de bot_sessions.
+    """
+    __tablename__ = "outbound_messages"
+
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey("sessions.id"), nullable=False)
+    bot_session = db.Column(db.String(80), nullable=False)
+    number = db.Column(db.String(80), nullable=False)  # identidad del contacto (JID), clave del carril
+    effect = db.Column(db.Text, nullable=False)  # JSON del efecto de conversation_flow
+    status = db.Column(db.String(20), nullable=False, default="pending")  # pending, sending, sent, error
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, server_default=db.func.now())
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    trace_id = db.Column(db.String(32))
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # Lo pendiente o en curso de un contacto, en orden de inserción.
+        db.Index(
+            "ix_outbound_messages_open_contact",
+            "bot_session",
+            "number",
+            "id",
+            postgresql_where=db.text("status IN ('pending', 'sending')"),
+        ),
+    )
+
+
+class WppSessionPace(db.Model):
+    """
+    Próximo turno de envío de cada sesión WPP, compartido por todos los
+    procesos que envían (workers de gunicorn y cron). Ver
+    whatsappservice._SessionPacer.
+    """
+    __tablename__ = "wpp_session_pace"
+
+    bot_session = db.Column(db.String(80), primary_key=True)
+    next_send_at = db.Column(db.DateTime, nullable=False)
+
+
+class WppSessionStatus(db.Model):
+    """
+    Último estado de cada sesión WPP según WPPConnect. Lo escribe un solo
+    proceso (el líder del scheduler) y lo leen los workers para pausar sus
+    carriles (ver session_health).
+    """
+    __tablename__ = "wpp_session_status"
+
+    bot_session = db.Column(db.String(80), primary_key=True)
+    status = db.Column(db.String(40), nullable=False)  # CONNECTED, QRCODE, CLOSED... o UNKNOWN
+    paused = db.Column(db.Boolean, nullable=False, default=False)
+    error = db.Column(db.Text)
+    checked_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,309 @@
+"""
+Envíos salientes de las conversaciones por una cola persistente (tabla
+outbound_messages).
+
+handle_conversation_messages guarda los efectos salientes de cada
+transición (SendText, SendYesNo, ...) con stage(), en la misma transacción
+que el estado y los mensajes entrantes: si el proceso muere después del
+commit, los envíos siguen en la tabla. Después despierta el carril del
+contacto en su sesión WPP (bot_sessions), que los envía con drain():
+
+- Orden por contacto: claim() toma todo lo abierto del contacto, en orden
+  de id, solo si nadie lo está enviando. El UPDATE vuelve a exigir cada
+  fila libre y, si otro worker tomó alguna en el medio, no toma ninguna:
+  dos workers de gunicorn nunca envían a la vez al mismo contacto.
+- Cada envío se confirma junto con su mensaje saliente. Si drain() se corta
+  (presupuesto de la petición, sesión pausada) lo que falta vuelve a
+  pending, también el envío que falló si la sesión ya estaba en pausa.
+- Una excepción (también NotDelivered: WPPConnect no confirmó el envío)
+  reintenta con backoff (OUTBOUND_RETRY_BASE_SECONDS) hasta
+  OUTBOUND_MAX_ATTEMPTS; lo que sigue del contacto espera detrás.
+- Una fila en sending más vieja que OUTBOUND_STALE_SECONDS (worker muerto a
+  mitad de envío) se vuelve a tomar: a lo sumo se repite ese envío.
+
+start_sweeper() (un hilo por worker de gunicorn) despierta cada
+OUTBOUND_SWEEP_SECONDS los contactos con envíos abiertos de más de
+OUTBOUND_ORPHAN_SECONDS: los de un worker que murió o se recicló, los que
+no entraron en un carril lleno y los retenidos mientras la sesión WPP
+estuvo pausada (cualquier worker los drena al reanudarse).
+"""
+import json
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import bot_sessions
+import conversation_flow
+import logs
+import tracing
+from models import db, OutboundMessage, Session
+from session_deadlines import naive_utc
+
+
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "5"))
+OUTBOUND_RETRY_BASE_SECONDS = float(os.getenv("OUTBOUND_RETRY_BASE_SECONDS", "5"))
+OUTBOUND_STALE_SECONDS = float(os.getenv("OUTBOUND_STALE_SECONDS", "300"))
+OUTBOUND_SWEEP_SECONDS = float(os.getenv("OUTBOUND_SWEEP_SECONDS", "10"))
+OUTBOUND_ORPHAN_SECONDS = float(os.getenv("OUTBOUND_ORPHAN_SECONDS", "30"))
+OUTBOUND_SWEEP_LIMIT = int(os.getenv("OUTBOUND_SWEEP_LIMIT", "500"))
+
+OPEN_STATUSES = ("pending", "sending")
+
+log = logs.get_logger("outbound")
+
+_EFFECTS = {effect.__name__: effect for effect in conversation_flow.OUTBOUND_EFFECTS}
+
+class NotDelivered(Exception):
+    """execute() no logró el envío: la fila no se marca sent y se reintenta."""
+
+
+# Fila tomada por claim(); se lee antes del commit para no recargarla.
+Claimed = namedtuple("Claimed", ["id", "session_id", "effect"])
+
+
+def utcnow():
+    return naive_utc(datetime.now(timezone.utc))
+
+
+def serialize_effect(effect):
+    return json.dumps({"type": type(effect).__name__, **effect._asdict()}, ensure_ascii=False)
+
+
+def deserialize_effect(raw):
+    data = json.loads(raw)
+    return _EFFECTS[data.pop("type")](**data)
+
+
+def stage(session, number, bot_session, effects):
+    """Agrega los envíos de una transición a la sesión de BD, sin commit."""
+    now = utcnow()
+    trace_id = tracing.current_trace_id()
+    for effect in effects:
+        db.session.add(OutboundMessage(
+            session_id=session.id,
+            bot_session=bot_session,
+            number=number,
+            effect=serialize_effect(effect),
+            status="pending",
+            attempts=0,
+            next_attempt_at=now,
+            created_at=now,
+            trace_id=trace_id,
+        ))
+
+
+def _update(ids, *conditions, **values):
+    return db.session.execute(
+        db.update(OutboundMessage)
+        .where(OutboundMessage.id.in_(ids), *conditions)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def _claimable(now):
+    """Pendiente, o en sending de un worker que ya no la está enviando."""
+    return db.or_(
+        OutboundMessage.status == "pending",
+        db.and_(
+            OutboundMessage.status == "sending",
+            OutboundMessage.claimed_at < now - timedelta(seconds=OUTBOUND_STALE_SECONDS),
+        ),
+    )
+
+
+def claim(bot_session, number):
+    """
+    Toma (status sending) lo abierto del contacto y lo devuelve en orden, o
+    [] si otro lo está enviando o el primero espera su reintento.
+    """
+    now = utcnow()
+    stale_cutoff = now - timedelta(seconds=OUTBOUND_STALE_SECONDS)
+    rows = (
+        db.session.query(
+            OutboundMessage.id,
+            OutboundMessage.session_id,
+            OutboundMessage.effect,
+            OutboundMessage.status,
+            OutboundMessage.claimed_at,
+            OutboundMessage.next_attempt_at,
+        )
+        .filter(
+            OutboundMessage.bot_session == bot_session,
+            OutboundMessage.number == number,
+            OutboundMessage.status.in_(OPEN_STATUSES),
+        )
+        .order_by(OutboundMessage.id.asc())
+        .all()
+    )
+
+    busy = any(row.status == "sending" and row.claimed_at and row.claimed_at >= stale_cutoff for row in rows)
+    waiting = rows and rows[0].next_attempt_at and rows[0].next_attempt_at > now
+    if not rows or busy or waiting:
+        db.session.rollback()
+        return []
+
+    ids = [row.id for row in rows]
+    if _update(ids, _claimable(now), status="sending", claimed_at=now) != len(ids):
+        # Otro worker tomó alguna entre la lectura y el UPDATE.
+        db.session.rollback()
+        return []
+
+    db.session.commit()
+    return [Claimed(row.id, row.session_id, row.effect) for row in rows]
+
+
+def release(ids):
+    """Lo tomado que no se llegó a enviar vuelve a pending, en su orden."""
+    if ids:
+        _update(ids, OutboundMessage.status == "sending", status="pending", claimed_at=None)
+        db.session.commit()
+
+
+def _fail(item, rest, error):
+    row = db.session.get(OutboundMessage, item.id)
+    row.attempts += 1
+    row.last_error = error
+    row.claimed_at = None
+
+    if row.attempts >= OUTBOUND_MAX_ATTEMPTS:
+        row.status = "error"
+    else:
+        row.status = "pending"
+        delay = OUTBOUND_RETRY_BASE_SECONDS * 2 ** (row.attempts - 1)
+        row.next_attempt_at = utcnow() + timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+    db.session.commit()
+    release([other.id for other in rest])
+    return row.status
+
+
+def drain(bot_session, number, execute, should_stop=None):
+    """
+    Envía en orden lo abierto del contacto con execute(efecto, sesión,
+    número), que registra su mensaje saliente sin commit y lanza si no pudo
+    enviar. Sigue mientras aparezcan envíos nuevos; should_stop() se
+    consulta antes de cada uno.
+    Devuelve (enviados, devueltos a pending por should_stop).
+    """
+    # Un commit por envío: las sesiones cargadas siguen válidas entre commits
+    # (si no, cada envío volvería a leer sesión y usuario).
+    orm_session = db.session()
+    expire_on_commit = orm_session.expire_on_commit
+    orm_session.expire_on_commit = False
+    try:
+        return _drain(bot_session, number, execute, should_stop)
+    finally:
+        orm_session.expire_on_commit = expire_on_commit
+
+
+def _drain(bot_session, number, execute, should_stop):
+    sent = 0
+    while True:
+        claimed = claim(bot_session, number)
+        if not claimed:
+            return sent, 0
+
+        for index, item in enumerate(claimed):
+            if should_stop is not None and should_stop():
+                release([other.id for other in claimed[index:]])
+                return sent, len(claimed) - index
+
+            try:
+                execute(deserialize_effect(item.effect), db.session.get(Session, item.session_id), number)
+                _update([item.id], status="sent", sent_at=utcnow(), attempts=OutboundMessage.attempts + 1)
+                db.session.commit()
+                sent += 1
+            except Exception as e:
+                db.session.rollback()
+                if should_stop is not None and should_stop():
+                    # Falló con la sesión ya pausada (desconectada): no es un
+                    # intento del envío, queda pendiente para la reconexión.
+                    release([other.id for other in claimed[index:]])
+                    log.warning(
+                        "⚠️ Envío no entregado con la sesión en pausa: queda pendiente",
+                        id=item.id, bot_session=bot_session, number=number, error=repr(e),
+                    )
+                    return sent, len(claimed) - index
+                status = _fail(item, claimed[index + 1:], repr(e))
+                log.error(
+                    "❌ Error enviando a WPPConnect desde la cola",
+                    id=item.id, status=status, bot_session=bot_session, number=number, error=repr(e),
+                    exc_info=not isinstance(e, NotDelivered),
+                )
+                if status != "error":
+                    # Lo que sigue del contacto espera detrás del reintento.
+                    return sent, 0
+                break
+
+
+def due_contacts(limit=OUTBOUND_SWEEP_LIMIT):
+    """(bot_session, number) con envíos abiertos que nadie está drenando."""
+    now = utcnow()
+    rows = (
+        db.session.query(OutboundMessage.bot_session, OutboundMessage.number)
+        .filter(
+            OutboundMessage.status.in_(OPEN_STATUSES),
+            _claimable(now),
+            OutboundMessage.next_attempt_at <= now,
+            OutboundMessage.created_at <= now - timedelta(seconds=OUTBOUND_ORPHAN_SECONDS),
+        )
+        .distinct()
+        .limit(limit)
+        .all()
+    )
+    db.session.rollback()
+    return [(row.bot_session, row.number) for row in rows]
+
+
+def open_counts():
+    """{bot_session: envíos abiertos} entre todos los workers."""
+    rows = (
+        db.session.query(OutboundMessage.bot_session, db.func.count(OutboundMessage.id))
+        .filter(OutboundMessage.status.in_(OPEN_STATUSES))
+        .group_by(OutboundMessage.bot_session)
+        .all()
+    )
+    return dict(rows)
+
+
+# ============================================================
+# BARRIDO
+# ============================================================
+_sweeper_pid = None
+_sweeper_lock = threading.Lock()
+
+
+def _run_sweeper(app, wake):
+    while True:
+        time.sleep(OUTBOUND_SWEEP_SECONDS)
+        try:
+            with app.app_context():
+                contacts = due_contacts()
+            woken = [
+                (bot_session, number)
+                for bot_session, number in contacts
+                if not bot_sessions.is_paused(bot_session) and wake(bot_session, number)
+            ]
+            if woken:
+                log.info("Envíos abiertos retomados por el barrido", contacts=len(woken))
+        except Exception as e:
+            log.error("❌ Error en el barrido de envíos", error=repr(e), exc_info=True)
+
+
+def start_sweeper(app, wake):
+    """
+    Arranca el barrido de este proceso (una vez por pid). wake(bot_session,
+    number) debe encolar el drenado del contacto sin bloquear.
+    """
+    global _sweeper_pid
+
+    if OUTBOUND_SWEEP_SECONDS <= 0 or _sweeper_pid == os.getpid():
+        return
+    with _sweeper_lock:
+        if _sweeper_pid != os.getpid():
+            threading.Thread(target=_run_sweeper, args=(app, wake), name="outbound-sweeper", daemon=True).start()
+            _sweeper_pid = os.getpid()
@@ -1,64 +1,427 @@
+"""
+Leads hacia la API PHP por una cola persistente (tabla lead_outbox).
+
+La conversación solo inserta la fila, en la misma transacción que el
+consentimiento (enqueue_lead); la respuesta al cliente no espera a PHP.
+Este worker los envía aparte:
+
+- Lotes de hasta LEAD_BATCH_SIZE pendientes vencidos, tomados con SKIP
+  LOCKED y marcados status='sending' (claimed_at) en un commit corto: los
+  POST corren sin transacción abierta ni locks, y enqueue_lead no espera
+  a PHP. El resultado solo se guarda si el lead sigue siendo de esa toma.
+  Un lead en sending más viejo que LEAD_STALE_MINUTES (el worker murió a
+  mitad de envío) vuelve a pending.
+- Con PHP_LEADS_BULK=true el lote va en una sola petición
+  {"leads": [...]} a PHP_LEADS_BULK_API_URL (o PHP_LEADS_API_URL). Si la
+  respuesta trae "results" con external_reference, cada lead se marca por
+  separado; si no, el estado HTTP vale para todo el lote. Sin bulk se
+  envían de a uno sobre una conexión reutilizada.
+- external_reference (bot_session:teléfono) es la clave de upsert del PHP:
+  un lead pendiente se actualiza en vez de duplicarse y dentro de un lote
+  cada referencia se envía una sola vez.
+- Un fallo reintenta con backoff exponencial (LEAD_RETRY_BASE_SECONDS,
+  tope LEAD_RETRY_MAX_SECONDS) hasta LEAD_MAX_ATTEMPTS; un 4xx (salvo 408
+  y 429) es definitivo (permanent). En ambos casos queda status='error'.
+- reconcile() compara los PolicyConsent aceptados de los últimos
+  LEAD_RECONCILE_DAYS con la cola y reencola los que no tienen un lead
+  enviado ni pendiente (también los que agotaron los reintentos, no los
+  rechazados de forma definitiva). El worker la corre al arrancar y cada
+  LEAD_RECONCILE_MINUTES; los consentimientos de antes de la cola quedan
+  como enviados por la migración (scripts/add_lead_outbox.sql).
+
+Uso:
+    python php_leads_service.py              # worker
+    python php_leads_service.py --once       # envía lo pendiente y termina
+    python php_leads_service.py --reconcile  # solo la reconciliación
+"""
+import argparse
+import json
 import os
+import random
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
 import requests
 
+import logs
+import metrics
+import request_deadline
+import tracing
+from models import db, LeadOutbox, PolicyConsent
+from session_deadlines import naive_utc
+
 
 PHP_LEADS_API_URL = os.getenv("PHP_LEADS_API_URL", "").strip()
 PHP_LEADS_API_TOKEN = os.getenv("PHP_LEADS_API_TOKEN", "").strip()
+PHP_LEADS_BULK = os.getenv("PHP_LEADS_BULK", "false").lower() == "true"
+PHP_LEADS_BULK_API_URL = os.getenv("PHP_LEADS_BULK_API_URL", "").strip() or PHP_LEADS_API_URL
+PHP_LEADS_TIMEOUT_SECONDS = float(os.getenv("PHP_LEADS_TIMEOUT_SECONDS", "15"))
 
+LEAD_BATCH_SIZE = int(os.getenv("LEAD_BATCH_SIZE", "50"))
+LEAD_POLL_SECONDS = float(os.getenv("LEAD_POLL_SECONDS", "2"))
+LEAD_MAX_ATTEMPTS = int(os.getenv("LEAD_MAX_ATTEMPTS", "8"))
+LEAD_RETRY_BASE_SECONDS = float(os.getenv("LEAD_RETRY_BASE_SECONDS", "30"))
+LEAD_RETRY_MAX_SECONDS = float(os.getenv("LEAD_RETRY_MAX_SECONDS", "3600"))
+LEAD_RECONCILE_DAYS = int(os.getenv("LEAD_RECONCILE_DAYS", "7"))
+LEAD_RECONCILE_MINUTES = float(os.getenv("LEAD_RECONCILE_MINUTES", "60"))
+LEAD_STALE_MINUTES = int(os.getenv("LEAD_STALE_MINUTES", "10"))
+
+log = logs.get_logger("php")
+
+# ok: PHP lo aceptó; permanent: no tiene sentido reintentar.
+LeadResult = namedtuple("LeadResult", ["ok", "status", "error", "permanent"])
+
+# Lead tomado por claim_batch(); se lee antes del commit para enviarlo sin BD.
+LeadClaim = namedtuple("LeadClaim", ["id", "external_reference", "payload", "attempts", "claimed_at", "trace_id"])
 
-def create_or_update_php_lead(user, session, accepted=True, latest_message=None):
-    """
-    Envía un lead al sistema PHP cuando el usuario acepta la política.
-    No rompe el chatbot si la API PHP falla.
-    """
 
-    if not PHP_LEADS_API_URL:
-        print("⚠️ PHP_LEADS_API_URL no configurado. Lead no enviado a PHP.", flush=True)
-        return False
+def utcnow():
+    return naive_utc(datetime.now(timezone.utc))
 
-    if not PHP_LEADS_API_TOKEN:
-        print("⚠️ PHP_LEADS_API_TOKEN no configurado. Lead no enviado a PHP.", flush=True)
-        return False
 
-    payload = {
-        "phone": user.phone_number,
+def external_reference(user):
+    return f"{user.bot_session}:{user.phone_number}"
+
+
+def build_lead_payload(user, session, delivery_phone, first_message=None):
+    """Payload del lead: campos que espera el PHP más los de compatibilidad."""
+    phone_value = user.phone_number or ""
+    message = first_message or "Aceptó la política de tratamiento de datos personales"
+
+    return {
+        "accepted": True,
+        "phone": delivery_phone or (phone_value.replace("@lid", "").replace("@c.us", "") if phone_value else ""),
+        "phone_number": phone_value,
+        "phone_jid": phone_value if "@" in phone_value else "",
+        "jid": phone_value if "@" in phone_value else "",
+        "delivery_phone": delivery_phone,
         "name": user.name or "Contacto externo / WhatsApp",
         "bot_session": user.bot_session,
-        "source": "whatsapp",
+        "session": user.bot_session,
+        "last_message": message,
+        "message": message,
+        "chatbot_user_id": user.id,
+        "chatbot_session_id": session.id,
+        "consent_at": datetime.now(timezone.utc).isoformat(),
+        "external_reference": external_reference(user),
+
+        # Compatibilidad adicional
+        "source": "chatbot_whatsapp",
+        "channel": "whatsapp",
         "origin": "contacto externo/whatsapp",
-        "policy_accepted": bool(accepted),
-        "message": latest_message or "",
-        "external_reference": f"{user.bot_session}:{user.phone_number}",
+        "policy_accepted": True,
         "metadata": {
             "chatbot_user_id": user.id,
-            "chatbot_session_id": session.id if session else None,
+            "chatbot_session_id": session.id,
             "wpp_session": user.bot_session,
+            "trace_id": tracing.current_trace_id(),
         },
     }
 
-    headers = {
+
+def enqueue_lead(user, session, delivery_phone, first_message=None, commit=True):
+    """
+    Deja el lead en la cola. Si ya hay uno pendiente para la misma
+    referencia (y ningún worker lo está enviando) se actualiza ese.
+    """
+    payload = build_lead_payload(user, session, delivery_phone, first_message)
+    reference = payload["external_reference"]
+
+    lead = (
+        LeadOutbox.query
+        .filter(LeadOutbox.status == "pending", LeadOutbox.external_reference == reference)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+
+    if lead is None:
+        lead = LeadOutbox(user_id=user.id, external_reference=reference, status="pending", attempts=0)
+        db.session.add(lead)
+
+    lead.session_id = session.id
+    lead.payload = json.dumps(payload, ensure_ascii=False)
+    lead.next_attempt_at = utcnow()
+    lead.trace_id = payload["metadata"]["trace_id"]
+
+    if commit:
+        db.session.commit()
+
+    return lead
+
+
+# ============================================================
+# ENVÍO
+# ============================================================
+def _headers():
+    return tracing.inject_headers({
         "Accept": "application/json",
         "Content-Type": "application/json",
         "Authorization": f"Bearer {PHP_LEADS_API_TOKEN}",
-    }
+    })
 
+
+def _result_for_status(status_code, text):
+    if 200 <= status_code < 300:
+        return LeadResult(True, status_code, None, False)
+    permanent = 400 <= status_code < 500 and status_code not in (408, 429)
+    return LeadResult(False, status_code, f"PHP respondió {status_code}: {text[:500]}", permanent)
+
+
+def _post(http, url, body):
+    started = time.perf_counter()
+    outcome = "error"
     try:
-        response = requests.post(
-            PHP_LEADS_API_URL,
-            json=payload,
-            headers=headers,
-            timeout=20,
+        # El worker no tiene deadline; si se llama dentro de una petición, usa lo que queda.
+        timeout = request_deadline.timeout(PHP_LEADS_TIMEOUT_SECONDS)
+        response = http.post(url, json=body, headers=_headers(), timeout=timeout)
+        outcome = metrics.outcome_for_status(response.status_code)
+        return response
+    finally:
+        metrics.PHP_LEAD_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+
+
+def send_single(http, payloads):
+    """{external_reference: LeadResult}, un POST por lead."""
+    results = {}
+    for reference, payload in payloads.items():
+        try:
+            response = _post(http, PHP_LEADS_API_URL, payload)
+            results[reference] = _result_for_status(response.status_code, response.text)
+        except requests.RequestException as e:
+            results[reference] = LeadResult(False, None, repr(e), False)
+    return results
+
+
+def send_bulk(http, payloads):
+    """{external_reference: LeadResult}, un POST con todo el lote."""
+    try:
+        response = _post(http, PHP_LEADS_BULK_API_URL, {"leads": list(payloads.values())})
+    except requests.RequestException as e:
+        return {reference: LeadResult(False, None, repr(e), False) for reference in payloads}
+
+    batch_result = _result_for_status(response.status_code, response.text)
+    results = {reference: batch_result for reference in payloads}
+
+    if batch_result.ok:
+        try:
+            items = response.json().get("results") or []
+        except (ValueError, AttributeError):
+            items = []
+
+        for item in items:
+            reference = item.get("external_reference") if isinstance(item, dict) else None
+            if reference not in results:
+                continue
+            ok = item.get("ok", str(item.get("status", "ok")).lower() in ("ok", "success", "created", "updated"))
+            if not ok:
+                error = item.get("error") or item.get("message") or "rechazado por PHP"
+                results[reference] = LeadResult(False, response.status_code, str(error)[:500], True)
+
+    return results
+
+
+def retry_delay(attempts):
+    delay = min(LEAD_RETRY_MAX_SECONDS, LEAD_RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def apply_result(attempts, result, now):
+    """Columnas a guardar para un lead con `attempts` intentos previos."""
+    attempts += 1
+    values = {"attempts": attempts, "response_status": result.status, "claimed_at": None}
+
+    if result.ok:
+        values.update(status="sent", sent_at=now, last_error=None)
+    elif result.permanent or attempts >= LEAD_MAX_ATTEMPTS:
+        values.update(status="error", permanent=result.permanent, last_error=result.error)
+    else:
+        values.update(
+            status="pending",
+            next_attempt_at=now + timedelta(seconds=retry_delay(attempts)),
+            last_error=result.error,
         )
+    return values
+
+
+# ============================================================
+# WORKER
+# ============================================================
+def claim_batch():
+    """
+    Pendientes vencidos, marcados sending y confirmados: el lock de fila
+    dura solo este commit. Devuelve LeadClaim en orden de id.
+    """
+    now = utcnow()
+    leads = (
+        LeadOutbox.query
+        .filter(LeadOutbox.status == "pending", LeadOutbox.next_attempt_at <= now)
+        .order_by(LeadOutbox.next_attempt_at.asc(), LeadOutbox.id.asc())
+        .limit(LEAD_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+    if not leads:
+        db.session.rollback()
+        return []
+
+    claims = []
+    for lead in sorted(leads, key=lambda item: item.id):
+        lead.status = "sending"
+        lead.claimed_at = now
+        claims.append(LeadClaim(lead.id, lead.external_reference, lead.payload, lead.attempts, now, lead.trace_id))
+    db.session.commit()
+    return claims
+
 
-        print(
-            "📤 PHP Leads API:",
-            response.status_code,
-            response.text[:1000],
-            flush=True,
+def deliver_batch(http, claims):
+    # Una referencia por envío: si se repite, va el payload del lead más
+    # nuevo y todos los de esa referencia toman el mismo resultado.
+    payloads = {}
+    for claim in claims:
+        payloads[claim.external_reference] = json.loads(claim.payload)
+
+    started = time.perf_counter()
+    results = (send_bulk if PHP_LEADS_BULK else send_single)(http, payloads)
+
+    now = utcnow()
+    failed = []
+    lost = 0
+    for claim in claims:
+        values = apply_result(claim.attempts, results[claim.external_reference], now)
+        count = (
+            LeadOutbox.query
+            .filter_by(id=claim.id, status="sending", claimed_at=claim.claimed_at)
+            .update(values, synchronize_session=False)
         )
+        if not count:
+            # requeue_stale_leads() ya lo devolvió a la cola.
+            lost += 1
+        elif values["status"] != "sent":
+            failed.append((claim, values))
+    db.session.commit()
+
+    (log.warning if failed or lost else log.info)(
+        "📤 Leads enviados a PHP",
+        leads=len(claims),
+        requests=1 if PHP_LEADS_BULK else len(payloads),
+        failed=len(failed),
+        lost=lost,
+        ms=round((time.perf_counter() - started) * 1000, 1),
+        errors=[
+            {"id": claim.id, "status": values["status"], "attempts": values["attempts"],
+             "error": values["last_error"], "trace_id": claim.trace_id}
+            for claim, values in failed
+        ],
+    )
+    return len(claims) - len(failed) - lost
+
+
+def requeue_stale_leads():
+    """Devuelve a pending los leads en sending cuyo worker murió a mitad de envío."""
+    cutoff = utcnow() - timedelta(minutes=LEAD_STALE_MINUTES)
+    count = (
+        LeadOutbox.query
+        .filter(LeadOutbox.status == "sending", LeadOutbox.claimed_at < cutoff)
+        .update({"status": "pending", "claimed_at": None}, synchronize_session=False)
+    )
+    db.session.commit()
+
+    if count:
+        log.warning("Leads reencolados sin terminar", leads=count)
+    return count
+
+
+def reconcile(days=LEAD_RECONCILE_DAYS):
+    """
+    Reencola los consentimientos aceptados sin lead enviado ni pendiente.
+    Los que PHP rechazó de forma definitiva no se reintentan.
+    """
+    from app import lead_delivery_phone
+
+    since = utcnow() - timedelta(days=days)
+    covered = (
+        db.session.query(LeadOutbox.session_id)
+        .filter(db.or_(LeadOutbox.status.in_(("pending", "sending", "sent")), LeadOutbox.permanent.is_(True)))
+    )
+    consents = (
+        PolicyConsent.query
+        .filter(
+            PolicyConsent.accepted.is_(True),
+            PolicyConsent.created_at >= since,
+            PolicyConsent.session_id.not_in(covered),
+        )
+        .order_by(PolicyConsent.id.asc())
+        .all()
+    )
+
+    for consent in consents:
+        enqueue_lead(
+            consent.user,
+            consent.session,
+            lead_delivery_phone(consent.session, consent.user.phone_number or ""),
+            commit=False,
+        )
+    db.session.commit()
+
+    if consents:
+        log.warning("Leads reencolados por reconciliación", leads=len(consents), days=days)
+    return len(consents)
+
+
+def run_worker(once=False):
+    from app import app
+
+    with app.app_context():
+        if not PHP_LEADS_API_URL or not PHP_LEADS_API_TOKEN:
+            log.warning("⚠️ PHP_LEADS_API_URL o PHP_LEADS_API_TOKEN no configurado. Los leads quedan en cola.")
+
+        log.info("Worker iniciado", bulk=PHP_LEADS_BULK, batch_size=LEAD_BATCH_SIZE)
+        http = requests.Session()
+        last_reconcile = last_maintenance = 0.0
+
+        while True:
+            try:
+                if time.monotonic() - last_maintenance > 60:
+                    requeue_stale_leads()
+                    last_maintenance = time.monotonic()
+
+                if time.monotonic() - last_reconcile > LEAD_RECONCILE_MINUTES * 60 and not once:
+                    reconcile()
+                    last_reconcile = time.monotonic()
+
+                claims = claim_batch() if PHP_LEADS_API_URL and PHP_LEADS_API_TOKEN else []
+
+                if claims:
+                    deliver_batch(http, claims)
+                    continue
+
+                if once:
+                    return
+
+            except Exception as e:
+                db.session.rollback()
+                log.error("❌ Error en el worker de leads", error=repr(e), exc_info=True)
+                if once:
+                    raise
+
+            time.sleep(LEAD_POLL_SECONDS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker de leads hacia la API PHP")
+    parser.add_argument("--once", action="store_true", help="Envía los leads pendientes y termina")
+    parser.add_argument("--reconcile", action="store_true", help="Solo reencola consentimientos sin lead enviado")
+    parser.add_argument("--days", type=int, default=LEAD_RECONCILE_DAYS)
+    args = parser.parse_args()
+
+    if args.reconcile:
+        from app import app
 
-        return 200 <= response.status_code < 300
+        with app.app_context():
+            reconcile(args.days)
+    else:
+        run_worker(once=args.once)
 
-    except Exception as e:
-        print("❌ Error enviando lead al PHP:", repr(e), flush=True)
-        return False
\ No newline at end of file
+    logs.flush()
@@ -0,0 +1,87 @@
+"""
+Presupuesto de tiempo por petición.
+
+bounded_view() fija un deadline al entrar al webhook (WEBHOOK_BUDGET_SECONDS)
+en un ContextVar, así llega sin pasar parámetros a handle_new_message, a
+SendMessageWhatsapp y al envío de leads:
+
+- timeout(default): las llamadas idempotentes o con su propia
+  reconciliación (envío de leads, espera de lugar en el carril) usan lo que
+  queda del presupuesto (nunca menos de DEADLINE_MIN_CALL_SECONDS) en vez
+  de su timeout fijo. Los envíos a WPPConnect no: un POST cortado a mitad
+  puede duplicar el mensaje, así que mantienen su timeout.
+- exhausted(reserve): los envíos que se drenan en la petición (colas de
+  sesión desactivadas) se miran antes de empezar cada uno; lo que no entra
+  queda pendiente en outbound_messages y pasa al carril de la sesión con
+  bot_sessions.defer(), que no espera lugar.
+
+Fuera de una petición con presupuesto (carriles, workers, cron) no hay
+deadline: timeout() devuelve el default y exhausted() es False.
+
+alestur_budget_overruns_total cuenta, por presupuesto, los trabajos
+diferidos ("deferred") y las peticiones que terminaron pasado su deadline
+("exceeded").
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+import metrics
+
+
+WEBHOOK_BUDGET_SECONDS = float(os.getenv("WEBHOOK_BUDGET_SECONDS", "10"))
+DEADLINE_MIN_CALL_SECONDS = float(os.getenv("DEADLINE_MIN_CALL_SECONDS", "1"))
+
+# (nombre del presupuesto, instante monotonic del deadline)
+_deadline = ContextVar("request_deadline", default=None)
+
+
+@contextmanager
+def start(name, budget_seconds):
+    token = _deadline.set((name, time.monotonic() + budget_seconds))
+    try:
+        yield
+    finally:
+        if remaining() < 0:
+            metrics.BUDGET_OVERRUNS.labels(name, "exceeded").inc()
+        _deadline.reset(token)
+
+
+def bounded_view(name, budget_seconds=None):
+    """Decorador para vistas Flask: la petición corre con su deadline."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with start(name, WEBHOOK_BUDGET_SECONDS if budget_seconds is None else budget_seconds):
+                return view(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+def remaining():
+    """Segundos que quedan del presupuesto actual (negativo si pasó), o None."""
+    current = _deadline.get()
+    return None if current is None else current[1] - time.monotonic()
+
+
+def timeout(default):
+    """Timeout de una llamada externa acotado por el presupuesto."""
+    left = remaining()
+    if left is None:
+        return default
+    return max(DEADLINE_MIN_CALL_SECONDS, min(default, left))
+
+
+def exhausted(reserve=0.0):
+    """True si ya no entra una llamada (más `reserve` segundos) en el presupuesto."""
+    left = remaining()
+    return left is not None and left < DEADLINE_MIN_CALL_SECONDS + reserve
+
+
+def record_deferred():
+    current = _deadline.get()
+    if current is not None:
+        metrics.BUDGET_OVERRUNS.labels(current[0], "deferred").inc()
@@ -0,0 +1,324 @@
+"""
+Scheduler de inactividad guiado por sessions.next_deadline.
+
+Reemplaza el loop `while true; python cron_close_sessions.py; sleep 60`: es
+un proceso persistente con elección de líder por pg_try_advisory_lock.
+
+En lugar de recorrer todas las sesiones activas cada 60 segundos, duerme
+hasta el vencimiento más cercano y corre el barrido solo sobre las sesiones
+vencidas. En Postgres escucha el canal `session_deadline` (trigger de
+scripts/add_session_next_deadline.sql) para despertarse antes si aparece un
+vencimiento más cercano.
+
+El barrido corre en conexiones del pool, no en la de control: antes de
+escribir y antes de cada tanda de encuestas se vuelve a verificar que la
+conexión de control siga viva y con el lock (ControlConnection.verify); si
+no, el barrido se corta en vez de enviar junto a un nuevo líder. --once y
+cron_close_sessions.py toman el mismo lock.
+
+El líder es también el único que consulta a WPPConnect el estado de las
+sesiones (session_health.poll_due): despierta a más tardar en la próxima
+consulta y los workers leen el resultado de wpp_session_status.
+
+Uso:
+    python scheduler.py             # loop continuo
+    python scheduler.py --once      # un solo barrido de lo vencido
+    python scheduler.py --backfill  # rellena next_deadline tras la migración
+"""
+import argparse
+import os
+import select
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import logs
+import session_health
+from models import db, Session
+from app import app, seed_default_states
+from cron_close_sessions import run_sweep, recompute_all_deadlines
+from session_deadlines import naive_utc
+
+log = logs.get_logger("scheduler")
+
+
+SCHEDULER_MAX_SLEEP_SECONDS = float(os.getenv("SCHEDULER_MAX_SLEEP_SECONDS", "300"))
+SCHEDULER_MIN_SLEEP_SECONDS = float(os.getenv("SCHEDULER_MIN_SLEEP_SECONDS", "2"))
+SCHEDULER_STANDBY_POLL_SECONDS = float(os.getenv("SCHEDULER_STANDBY_POLL_SECONDS", "5"))
+# Clave del pg_try_advisory_lock; cualquier entero fijo compartido por las réplicas.
+SCHEDULER_LOCK_KEY = int(os.getenv("SCHEDULER_LOCK_KEY", "727001"))
+DEADLINE_CHANNEL = "session_deadline"
+
+
+class LeadershipLost(Exception):
+    """La conexión de control ya no sostiene el advisory lock."""
+
+
+def earliest_deadline():
+    value = (
+        db.session.query(db.func.min(Session.next_deadline))
+        .filter(Session.is_active.is_(True))
+        .scalar()
+    )
+    # No dejar una transacción abierta mientras se duerme.
+    db.session.commit()
+    return value
+
+
+class ControlConnection:
+    """
+    Conexión dedicada del scheduler. En Postgres sostiene el advisory lock de
+    líder (de sesión: se libera solo si el proceso o la conexión mueren) y el
+    LISTEN de vencimientos. Con otros motores (SQLite en desarrollo) siempre
+    es líder y simplemente duerme.
+    """
+
+    def __init__(self, engine):
+        self.connection = None
+        self.raw = None
+
+        if engine.dialect.name != "postgresql":
+            return
+
+        self.connection = engine.raw_connection()
+        self.raw = self.connection.driver_connection
+        self.raw.autocommit = True
+
+    def _execute(self, sql, params=None):
+        with self.raw.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone() if cursor.description else None
+
+    def try_acquire_leadership(self):
+        if self.raw is None:
+            return True
+        return bool(self._execute("SELECT pg_try_advisory_lock(%s)", (SCHEDULER_LOCK_KEY,))[0])
+
+    def listen(self):
+        if self.raw is not None:
+            self._execute(f"LISTEN {DEADLINE_CHANNEL}")
+
+    def ping(self):
+        """Si la conexión cayó, el lock se perdió con ella: lanza excepción."""
+        if self.raw is not None:
+            self._execute("SELECT 1")
+
+    def holds_leadership(self):
+        """El lock sigue concedido a esta conexión (pg_locks de su backend)."""
+        if self.raw is None:
+            return True
+        # pg_try_advisory_lock(bigint): 32 bits altos en classid, bajos en objid.
+        return bool(self._execute(
+            """
+            SELECT EXISTS (
+                SELECT 1 FROM pg_locks
+                WHERE locktype = 'advisory'
+                  AND pid = pg_backend_pid()
+                  AND classid::bigint = %s
+                  AND objid::bigint = %s
+                  AND objsubid = 1
+                  AND granted
+            )
+            """,
+            ((SCHEDULER_LOCK_KEY >> 32) & 0xFFFFFFFF, SCHEDULER_LOCK_KEY & 0xFFFFFFFF),
+        )[0])
+
+    def verify(self):
+        """Guard de run_sweep: lanza si la conexión cayó o ya no tiene el lock."""
+        try:
+            self.ping()
+            held = self.holds_leadership()
+        except Exception as e:
+            raise LeadershipLost(repr(e)) from e
+        if not held:
+            raise LeadershipLost("advisory lock no concedido")
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.invalidate()
+            except Exception:
+                pass
+        self.connection = None
+        self.raw = None
+
+    def wait(self, timeout):
+        """
+        Espera hasta `timeout` segundos. Devuelve True si un NOTIFY anunció
+        un vencimiento anterior al despertar planeado.
+        """
+        if self.raw is None:
+            time.sleep(timeout)
+            return False
+
+        wake_at = time.time() + timeout
+
+        while True:
+            remaining = wake_at - time.time()
+            if remaining <= 0:
+                return False
+
+            readable, _, _ = select.select([self.raw], [], [], remaining)
+            if not readable:
+                return False
+
+            self.raw.poll()
+            notified = []
+            while self.raw.notifies:
+                notify = self.raw.notifies.pop(0)
+                try:
+                    notified.append(float(notify.payload))
+                except ValueError:
+                    continue
+
+            if notified and min(notified) < wake_at:
+                return True
+
+
+def seconds_until(deadline, now):
+    if deadline is None:
+        return SCHEDULER_MAX_SLEEP_SECONDS
+
+    seconds = (deadline - naive_utc(now)).total_seconds()
+    return max(SCHEDULER_MIN_SLEEP_SECONDS, min(SCHEDULER_MAX_SLEEP_SECONDS, seconds))
+
+
+class SchedulerStats:
+    def __init__(self):
+        self.runs = 0
+        self.processed = 0
+        self.total_seconds = 0.0
+
+    def record(self, counts, seconds):
+        processed = sum(counts.values())
+        self.runs += 1
+        self.processed += processed
+        self.total_seconds += seconds
+        return processed
+
+
+def run_due_sessions(now=None, stats=None, guard=None):
+    now = now or datetime.now(timezone.utc)
+    started = time.monotonic()
+    counts = run_sweep(now, guard=guard)
+    elapsed = time.monotonic() - started
+
+    stats = stats or SchedulerStats()
+    processed = stats.record(counts, elapsed)
+
+    log.info(
+        "Ciclo del barrido",
+        cycle=stats.runs,
+        seconds=round(elapsed, 2),
+        processed=processed,
+        counts=counts,
+        total_processed=stats.processed,
+        total_seconds=round(stats.total_seconds, 1),
+    )
+    return counts
+
+
+def lead(control, stats):
+    """
+    Loop del líder: duerme hasta el próximo vencimiento y barre lo vencido.
+    Entre barridos consulta el estado de las sesiones WPP (session_health).
+    """
+    control.listen()
+
+    while True:
+        control.ping()
+        health_wait = session_health.poll_due()
+
+        now = datetime.now(timezone.utc)
+        deadline = earliest_deadline()
+
+        if deadline is not None and deadline <= naive_utc(now):
+            try:
+                run_due_sessions(now, stats, guard=control.verify)
+            except LeadershipLost:
+                db.session.rollback()
+                raise
+            except Exception as e:
+                db.session.rollback()
+                log.error("❌ Error en el barrido", error=repr(e), exc_info=True)
+            # Aunque quede algo vencido por carreras o errores, no girar en vacío.
+            control.wait(SCHEDULER_MIN_SLEEP_SECONDS)
+            continue
+
+        timeout = min(seconds_until(deadline, now), health_wait)
+        if control.wait(timeout):
+            log.debug("Despertado por un vencimiento más cercano")
+
+
+@contextmanager
+def exclusive_leadership():
+    """
+    Para barridos sueltos (--once, cron_close_sessions.py): toma el lock sin
+    esperar. Entrega el guard de run_sweep, o None si otra instancia es líder.
+    """
+    control = ControlConnection(db.engine)
+    try:
+        if not control.try_acquire_leadership():
+            log.info("Otra instancia es líder: no se barre")
+            yield None
+            return
+        yield control.verify
+    finally:
+        control.close()
+
+
+def run_forever():
+    """
+    Proceso persistente: motor, estados y cachés quedan calientes entre
+    ciclos. Varias réplicas pueden correr a la vez; solo la que tiene el
+    advisory lock barre, las demás esperan en standby y toman el relevo en
+    SCHEDULER_STANDBY_POLL_SECONDS si el líder muere.
+    """
+    stats = SchedulerStats()
+    log.info("Iniciado", engine=db.engine.dialect.name)
+
+    while True:
+        control = None
+        try:
+            control = ControlConnection(db.engine)
+
+            announced = False
+            while not control.try_acquire_leadership():
+                if not announced:
+                    log.info("Standby: otra instancia es líder")
+                    announced = True
+                time.sleep(SCHEDULER_STANDBY_POLL_SECONDS)
+
+            log.info("Esta instancia es líder")
+            lead(control, stats)
+
+        except Exception as e:
+            db.session.rollback()
+            log.error("❌ Conexión de control perdida, se reintenta", error=repr(e))
+            time.sleep(SCHEDULER_STANDBY_POLL_SECONDS)
+
+        finally:
+            if control is not None:
+                control.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scheduler de inactividad por next_deadline")
+    parser.add_argument("--once", action="store_true", help="Procesa solo lo vencido ahora y termina")
+    parser.add_argument("--backfill", action="store_true", help="Recalcula next_deadline de todas las sesiones activas")
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed_default_states()
+
+        if args.backfill:
+            total = recompute_all_deadlines()
+            log.info("next_deadline recalculado", active_sessions=total)
+        elif args.once:
+            with exclusive_leadership() as guard:
+                if guard is None:
+                    sys.exit(1)
+                run_due_sessions(guard=guard)
+        else:
+            run_forever()
@@ -0,0 +1,9 @@
+-- Índices para el tablero /sessions/active.
+-- Se pueden crear en caliente; CONCURRENTLY no bloquea escrituras.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_sessions_active_id
+    ON sessions (id)
+    WHERE is_active = true;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_sessions_user_id
+    ON sessions (user_id);
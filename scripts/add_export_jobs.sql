@@ -0,0 +1,19 @@
+-- Tabla de trabajos de exportación en segundo plano (ver export_jobs.py).
+
+CREATE TABLE IF NOT EXISTS export_jobs (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(20) NOT NULL,
+    export_format VARCHAR(10) NOT NULL DEFAULT 'csv',
+    params TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    rows_written INTEGER NOT NULL DEFAULT 0,
+    total_rows INTEGER,
+    file_path TEXT,
+    file_size BIGINT,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT NOW(),
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS ix_export_jobs_status_id ON export_jobs (status, id);
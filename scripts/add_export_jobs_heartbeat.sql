@@ -0,0 +1,7 @@
+-- Latido de los trabajos de exportación (ver export_jobs.py): un trabajo
+-- en curso se reencola solo si su worker dejó de reportar lotes, y cada
+-- toma tiene su número para que un worker que perdió el trabajo no lo
+-- siga escribiendo.
+
+ALTER TABLE export_jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP;
+ALTER TABLE export_jobs ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
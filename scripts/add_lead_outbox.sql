@@ -0,0 +1,51 @@
+-- Cola persistente de leads hacia la API PHP (ver php_leads_service.py).
+
+CREATE TABLE IF NOT EXISTS lead_outbox (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    session_id INTEGER NOT NULL REFERENCES sessions (id),
+    external_reference VARCHAR(255) NOT NULL,
+    payload TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP DEFAULT NOW(),
+    claimed_at TIMESTAMP,
+    permanent BOOLEAN NOT NULL DEFAULT FALSE,
+    response_status INTEGER,
+    last_error TEXT,
+    trace_id VARCHAR(32),
+    created_at TIMESTAMP DEFAULT NOW(),
+    sent_at TIMESTAMP
+);
+
+-- Los pendientes son una fracción mínima de la tabla.
+CREATE INDEX IF NOT EXISTS ix_lead_outbox_pending_due
+    ON lead_outbox (next_attempt_at)
+    WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS ix_lead_outbox_pending_reference
+    ON lead_outbox (external_reference)
+    WHERE status = 'pending';
+
+-- Bases donde la tabla ya existía sin la columna.
+ALTER TABLE lead_outbox ADD COLUMN IF NOT EXISTS permanent BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE lead_outbox ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP;
+
+-- Envíos en curso: los busca requeue_stale_leads().
+CREATE INDEX IF NOT EXISTS ix_lead_outbox_sending
+    ON lead_outbox (claimed_at)
+    WHERE status = 'sending';
+
+CREATE INDEX IF NOT EXISTS ix_lead_outbox_session_id
+    ON lead_outbox (session_id);
+
+-- Los leads de antes de la cola se enviaron en línea y no quedaron
+-- registrados: sin esto la reconciliación (que el worker corre al arrancar)
+-- los reenviaría. Se marcan como enviados; volver a correr el script no
+-- agrega nada porque todo consentimiento posterior ya tiene su fila.
+INSERT INTO lead_outbox (user_id, session_id, external_reference, payload, status, sent_at)
+SELECT pc.user_id, pc.session_id, u.bot_session || ':' || u.phone_number, '{}', 'sent', pc.created_at
+FROM policy_consents pc
+JOIN users u ON u.id = pc.user_id
+WHERE pc.accepted = true
+  AND NOT EXISTS (SELECT 1 FROM lead_outbox lo WHERE lo.session_id = pc.session_id);
@@ -0,0 +1,27 @@
+-- Multimedia entrante guardada por contenido (ver media_store.py).
+
+CREATE TABLE IF NOT EXISTS media_assets (
+    id SERIAL PRIMARY KEY,
+    sha256 VARCHAR(64) NOT NULL UNIQUE,
+    mime_type VARCHAR(120),
+    size BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS external_id VARCHAR(255);
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS media_status VARCHAR(20);
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS media_asset_id INTEGER REFERENCES media_assets (id);
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS media_filename VARCHAR(255);
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS media_mime_type VARCHAR(120);
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS media_attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS media_claimed_at TIMESTAMP;
+
+-- La cola de descargas pendientes es una fracción mínima de messages.
+CREATE INDEX IF NOT EXISTS ix_messages_media_pending
+    ON messages (id)
+    WHERE media_status = 'pending';
+
+-- Descargas en curso: las busca requeue_stale_downloads().
+CREATE INDEX IF NOT EXISTS ix_messages_media_downloading
+    ON messages (media_claimed_at)
+    WHERE media_status = 'downloading';
@@ -0,0 +1,22 @@
+-- Cola persistente de envíos a WPPConnect de las conversaciones (ver outbound.py).
+
+CREATE TABLE IF NOT EXISTS outbound_messages (
+    id SERIAL PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions (id),
+    bot_session VARCHAR(80) NOT NULL,
+    number VARCHAR(80) NOT NULL,
+    effect TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP DEFAULT NOW(),
+    claimed_at TIMESTAMP,
+    last_error TEXT,
+    trace_id VARCHAR(32),
+    created_at TIMESTAMP DEFAULT NOW(),
+    sent_at TIMESTAMP
+);
+
+-- Lo abierto es una fracción mínima de la tabla: drenado por contacto y barrido.
+CREATE INDEX IF NOT EXISTS ix_outbound_messages_open_contact
+    ON outbound_messages (bot_session, number, id)
+    WHERE status IN ('pending', 'sending');
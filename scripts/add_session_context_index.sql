@@ -0,0 +1,5 @@
+-- Índice para búsquedas de contexto por sesión (timeout_poll_sent,
+-- delivery_phone, close_reason...) usadas por el webhook y el barrido del cron.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_session_context_session_key
+    ON session_context (session_id, context_key);
@@ -0,0 +1,34 @@
+-- Columna next_deadline para el scheduler de inactividad (scheduler.py).
+-- Después de correr este script, rellenar los valores con:
+--     python scheduler.py --backfill
+
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS next_deadline TIMESTAMP;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_sessions_next_deadline
+    ON sessions (next_deadline)
+    WHERE is_active = true;
+
+-- Avisa al scheduler cuando aparece un vencimiento más cercano que el que
+-- tenía la sesión, para que se despierte antes de lo planeado.
+CREATE OR REPLACE FUNCTION notify_session_deadline() RETURNS trigger AS $$
+BEGIN
+    IF NEW.is_active
+       AND NEW.next_deadline IS NOT NULL
+       AND (
+           TG_OP = 'INSERT'
+           OR OLD.next_deadline IS NULL
+           OR NEW.next_deadline < OLD.next_deadline
+       )
+    THEN
+        PERFORM pg_notify('session_deadline', extract(epoch FROM NEW.next_deadline)::text);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sessions_notify_deadline ON sessions;
+
+CREATE TRIGGER sessions_notify_deadline
+    AFTER INSERT OR UPDATE OF next_deadline ON sessions
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_session_deadline();
@@ -0,0 +1,6 @@
+-- Ritmo de envío por sesión WPP compartido entre procesos (ver whatsappservice._SessionPacer).
+
+CREATE TABLE IF NOT EXISTS wpp_session_pace (
+    bot_session VARCHAR(80) PRIMARY KEY,
+    next_send_at TIMESTAMP NOT NULL
+);
@@ -0,0 +1,10 @@
+-- Estado de las sesiones WPP compartido entre procesos (ver session_health.py):
+-- lo escribe el líder del scheduler y lo leen los workers de gunicorn.
+
+CREATE TABLE IF NOT EXISTS wpp_session_status (
+    bot_session VARCHAR(80) PRIMARY KEY,
+    status VARCHAR(40) NOT NULL,
+    paused BOOLEAN NOT NULL DEFAULT FALSE,
+    error TEXT,
+    checked_at TIMESTAMP NOT NULL
+);
@@ -0,0 +1,188 @@
+"""
+Serialización de las respuestas JSON del CRM.
+
+- Encoders de filas compilados una sola vez (dict literal generado), en lugar
+  de armar cada dict campo por campo en cada request.
+- Modo compacto (?compact=1 o header X-Compact: 1) que omite los alias
+  heredados del PHP viejo (data, content, user_id).
+- Compresión gzip/deflate transparente por encima de COMPRESS_MIN_BYTES.
+"""
+import gzip
+import json
+import os
+import zlib
+
+from flask import Response, request
+
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "5"))
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/x-ndjson",
+    "text/csv",
+    "text/plain",
+}
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def format_datetime(value):
+    """Formato 'YYYY-MM-DD HH:MM:SS' que consume el PHP."""
+    if not value:
+        return None
+
+    try:
+        # isoformat es bastante más rápido que strftime y da el mismo texto
+        # para datetimes naive (los que devuelve la base de datos).
+        if value.tzinfo is None:
+            return value.isoformat(sep=" ", timespec="seconds")
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    except Exception:
+        return str(value)
+
+
+def compile_row_encoder(fields):
+    """
+    Compila una función row -> dict a partir de (clave, origen, conversor).
+
+    origen puede ser un índice (filas tipo tupla) o un nombre de atributo.
+    El resultado es un único dict literal, sin bucles por campo.
+    """
+    namespace = {}
+    items = []
+
+    for position, (key, source, converter) in enumerate(fields):
+        if isinstance(source, int):
+            access = f"row[{source}]"
+        else:
+            access = f"row.{source}"
+
+        if converter is not None:
+            name = f"_conv{position}"
+            namespace[name] = converter
+            access = f"{name}({access})"
+
+        items.append(f"{key!r}: {access}")
+
+    source_code = "def encode(row):\n    return {" + ", ".join(items) + "}\n"
+    exec(compile(source_code, "<row_encoder>", "exec"), namespace)
+    return namespace["encode"]
+
+
+class RowEncoder:
+    """Par de encoders (completo con alias / compacto) para un tipo de fila."""
+
+    def __init__(self, fields, aliases=()):
+        self.fields = list(fields)
+        self.aliases = list(aliases)
+        self._full = compile_row_encoder(self.fields + self.aliases)
+        self._compact = compile_row_encoder(self.fields)
+
+    def encode(self, row, compact=False):
+        return (self._compact if compact else self._full)(row)
+
+    def encode_many(self, rows, compact=False):
+        return list(map(self._compact if compact else self._full, rows))
+
+
+def wants_compact():
+    value = request.args.get("compact") or request.headers.get("X-Compact") or ""
+    return value.strip().lower() in ["1", "true", "yes", "si"]
+
+
+def json_response(payload, status=200, aliases=None, compact=None):
+    """
+    Reemplazo de jsonify para el CRM.
+
+    aliases: {"alias": "clave"} se agregan solo en modo no compacto,
+    p. ej. {"data": "contacts"}.
+    """
+    if compact is None:
+        compact = wants_compact()
+
+    if aliases and not compact:
+        payload = dict(payload)
+        for alias, key in aliases.items():
+            payload[alias] = payload.get(key)
+
+    body = _json_encoder.encode(payload)
+    return Response(body, status=status, mimetype="application/json")
+
+
+def _accepted_encoding(accept_encoding):
+    accept_encoding = (accept_encoding or "").lower()
+
+    for token in accept_encoding.split(","):
+        name, _, params = token.strip().partition(";")
+        if params.replace(" ", "") in ["q=0", "q=0.0"]:
+            continue
+        if name in ["gzip", "deflate"]:
+            return name
+
+    return None
+
+
+def compress_response(response):
+    """Hook after_request: comprime respuestas grandes si el cliente lo acepta."""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code in [204, 206, 304]
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+
+    encoding = _accepted_encoding(request.headers.get("Accept-Encoding"))
+    if not encoding:
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    if encoding == "gzip":
+        compressed = gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+    else:
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    response.headers["Content-Length"] = str(len(compressed))
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+# ============================================================
+# ENCODERS DEL CRM
+# ============================================================
+
+MESSAGE_ENCODER = RowEncoder(
+    fields=[
+        ("id", "id", None),
+        ("session_id", "session_id", None),
+        ("direction", "direction", None),
+        ("message_text", "message_text", None),
+        ("message_type", "message_type", None),
+        ("timestamp", "timestamp", format_datetime),
+        # pending/ready/error en multimedia; el archivo está en /api/crm/messages/<id>/media
+        ("media_status", "media_status", None),
+    ],
+    # Alias para compatibilidad con PHP viejo
+    aliases=[
+        ("content", "message_text", None),
+    ],
+)
+
+ACTIVE_SESSION_ENCODER = RowEncoder(
+    fields=[
+        ("id", 0, None),
+        ("bot_session", 1, None),
+        ("user_phone", 2, None),
+        ("start_time", 3, lambda value: value.isoformat() if value else None),
+        ("last_message_time", 4, lambda value: value.isoformat() if value else None),
+        ("state", 5, None),
+    ],
+)
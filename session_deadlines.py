@@ -0,0 +1,170 @@
+"""
+Cálculo de sessions.next_deadline.
+
+Cada sesión activa guarda el próximo momento en que el barrido de
+inactividad tiene algo que hacer con ella (corte por inactividad, vencimiento
+de la encuesta). Se recalcula en el flush de SQLAlchemy cada vez que cambia
+last_message_time, el estado, is_active o el contexto timeout_poll_sent, así
+que ningún llamador tiene que acordarse de actualizarlo.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session as OrmSession
+
+from models import Session, SessionContext, State
+
+
+INACTIVITY_DAYS = int(os.getenv("INACTIVITY_DAYS", "15"))
+SURVEY_TTL_DAYS = int(os.getenv("SURVEY_TTL_DAYS", "7"))
+
+INACTIVITY_DELTA = timedelta(days=INACTIVITY_DAYS)
+SURVEY_TTL_DELTA = timedelta(days=SURVEY_TTL_DAYS)
+
+FINAL_STATES = {"finalizado", "rechazado"}
+SURVEY_STATES = {"esperando_calificacion", "encuesta_satisfaccion"}
+PRE_CONSENT_STATES = {"inicio", "esperando_aceptacion"}
+
+DEADLINE_FIELDS = ("last_message_time", "start_time", "current_state_id", "is_active")
+POLL_KEY = "timeout_poll_sent"
+
+# Los estados no cambian en caliente: id -> nombre se carga una vez.
+_state_names = {}
+
+
+def naive_utc(dt):
+    """Las columnas son timestamp sin zona y guardan UTC."""
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        return dt
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def utcnow_naive():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def compute_next_deadline(state_name, is_active, last_activity, poll_sent_at, now):
+    """
+    Regla única del próximo vencimiento (todas las fechas naive UTC):
+    - sesión cerrada: sin vencimiento
+    - estado final todavía activo: vence ya (se corrige)
+    - esperando encuesta: marca timeout_poll_sent + SURVEY_TTL (o ya, si falta la marca)
+    - antes de aceptar política: última actividad + INACTIVITY
+    - aceptada: última actividad + INACTIVITY, salvo que ya se haya enviado la encuesta
+    """
+    if not is_active:
+        return None
+
+    state_name = (state_name or "inicio").lower()
+
+    if state_name in FINAL_STATES:
+        return now
+
+    if state_name in SURVEY_STATES:
+        return poll_sent_at + SURVEY_TTL_DELTA if poll_sent_at else now
+
+    if state_name in PRE_CONSENT_STATES:
+        return last_activity + INACTIVITY_DELTA if last_activity else None
+
+    if poll_sent_at:
+        return None
+
+    return last_activity + INACTIVITY_DELTA if last_activity else None
+
+
+def state_name_for(db_session, state_id):
+    if state_id is None:
+        return None
+
+    if state_id not in _state_names:
+        _state_names.update(dict(db_session.query(State.id, State.state_name).all()))
+
+    return _state_names.get(state_id)
+
+
+def _poll_sent_at(db_session, session_obj, pending_polls):
+    if session_obj.id in pending_polls:
+        return pending_polls[session_obj.id]
+
+    if session_obj.id is None:
+        return None
+
+    with db_session.no_autoflush:
+        row = (
+            db_session.query(SessionContext.updated_at)
+            .filter(
+                SessionContext.session_id == session_obj.id,
+                SessionContext.context_key == POLL_KEY,
+            )
+            .first()
+        )
+
+    return naive_utc(row[0]) if row else None
+
+
+def refresh_session_deadline(db_session, session_obj, pending_polls=None, now=None):
+    now = now or utcnow_naive()
+    pending_polls = pending_polls or {}
+
+    state_name = state_name_for(db_session, session_obj.current_state_id)
+    needs_poll = session_obj.is_active and (state_name or "inicio") not in FINAL_STATES | PRE_CONSENT_STATES
+    poll_sent_at = _poll_sent_at(db_session, session_obj, pending_polls) if needs_poll else None
+
+    last_activity = naive_utc(session_obj.last_message_time or session_obj.start_time)
+    if last_activity is None and session_obj.id is None:
+        # Sesión nueva sin fechas explícitas: el server_default será NOW().
+        last_activity = now
+
+    session_obj.next_deadline = compute_next_deadline(
+        state_name,
+        session_obj.is_active is not False,
+        last_activity,
+        poll_sent_at,
+        now,
+    )
+
+
+def _changed(obj, fields):
+    state = inspect(obj)
+    return any(state.attrs[field].history.has_changes() for field in fields)
+
+
+@event.listens_for(OrmSession, "before_flush")
+def _recompute_deadlines_before_flush(db_session, flush_context, instances):
+    touched = {}
+    touched_ids = set()
+    pending_polls = {}
+
+    for obj in db_session.new:
+        if isinstance(obj, Session):
+            touched[id(obj)] = obj
+
+    for obj in db_session.dirty:
+        if isinstance(obj, Session) and _changed(obj, DEADLINE_FIELDS):
+            touched[id(obj)] = obj
+
+    for obj in list(db_session.new) + list(db_session.dirty):
+        if isinstance(obj, SessionContext) and obj.context_key == POLL_KEY and obj.session_id:
+            pending_polls[obj.session_id] = naive_utc(obj.updated_at) or utcnow_naive()
+            touched_ids.add(obj.session_id)
+
+    for obj in db_session.deleted:
+        if isinstance(obj, SessionContext) and obj.context_key == POLL_KEY and obj.session_id:
+            pending_polls[obj.session_id] = None
+            touched_ids.add(obj.session_id)
+
+    for session_id in touched_ids:
+        with db_session.no_autoflush:
+            session_obj = db_session.get(Session, session_id)
+        if session_obj is not None:
+            touched[id(session_obj)] = session_obj
+
+    if not touched:
+        return
+
+    now = utcnow_naive()
+    for session_obj in touched.values():
+        refresh_session_deadline(db_session, session_obj, pending_polls, now)
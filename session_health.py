@@ -0,0 +1,251 @@
+"""
+Vigilancia del estado de las sesiones de WhatsApp Web en WPPConnect.
+
+Un solo proceso consulta WPPConnect: el líder del scheduler (scheduler.lead
+llama a poll_due() entre barridos) pide status-session de cada sesión del
+registro (bot_sessions.names()) y guarda el resultado en wpp_session_status:
+
+- CONNECTED: paused=false, los carriles de la sesión envían.
+- Otro estado informado por WPPConnect (QRCODE, CLOSED, DISCONNECTED...):
+  hay que volver a escanear el QR; paused=true y los envíos de la sesión
+  quedan pendientes en outbound_messages en vez de fallar. Al volver a
+  CONNECTED lo retenido sale al ritmo de la sesión, desde el carril que lo
+  esperaba o desde el barrido de cualquier worker (outbound.py).
+- Sin respuesta o sin estado (WPPConnect caído, endpoint no disponible):
+  "UNKNOWN", no cambia paused; la falla real la ven los envíos.
+
+Mientras la sesión está conectada se consulta cada
+SESSION_HEALTH_POLL_SECONDS; si no, el intervalo se duplica en cada
+consulta hasta SESSION_HEALTH_MAX_BACKOFF_SECONDS. El barrido de encuestas
+(cron_close_sessions.py, también bajo el lock del líder) consulta con
+check() antes de cada tanda.
+
+Los workers de gunicorn no consultan WPPConnect: start() (post_fork)
+arranca un hilo que lee la tabla cada SESSION_HEALTH_READ_SECONDS y pausa
+o reanuda los carriles del proceso (bot_sessions.pause/resume). Una fila
+sin consultar hace más de SESSION_HEALTH_STALE_SECONDS (scheduler caído)
+no pausa: sin vigilancia, los envíos siguen y sus fallas se reintentan.
+/health muestra por sesión el estado leído por el worker que responde, los
+contactos en cola de todos los workers (alestur_session_queue_depth) y los
+envíos pendientes en BD (conteo reutilizado unos segundos).
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import bot_sessions
+import logs
+import metrics
+import outbound
+import whatsappservice
+from models import db, WppSessionStatus
+from session_deadlines import naive_utc
+
+
+SESSION_HEALTH_ENABLED = os.getenv("SESSION_HEALTH_ENABLED", "true").lower() == "true"
+SESSION_HEALTH_POLL_SECONDS = float(os.getenv("SESSION_HEALTH_POLL_SECONDS", "15"))
+SESSION_HEALTH_MAX_BACKOFF_SECONDS = float(os.getenv("SESSION_HEALTH_MAX_BACKOFF_SECONDS", "120"))
+SESSION_HEALTH_READ_SECONDS = float(os.getenv("SESSION_HEALTH_READ_SECONDS", "5"))
+SESSION_HEALTH_STALE_SECONDS = float(os.getenv("SESSION_HEALTH_STALE_SECONDS", "600"))
+# /health no cuenta outbound_messages en cada sonda: reutiliza el conteo este tiempo.
+SESSION_HEALTH_PENDING_CACHE_SECONDS = float(os.getenv("SESSION_HEALTH_PENDING_CACHE_SECONDS", "10"))
+
+CONNECTED = "CONNECTED"
+UNKNOWN = "UNKNOWN"
+
+log = logs.get_logger("sessions.health")
+
+SessionStatus = namedtuple("SessionStatus", ["status", "paused", "checked_at", "error"])
+
+# Poller (líder del scheduler): nombre -> (intervalo, próxima consulta en monotonic).
+_schedule = {}
+# Workers: última lectura de wpp_session_status.
+_statuses = {}
+_lock = threading.Lock()
+_pid = None
+# (monotonic del conteo, {bot_session: envíos abiertos}) para snapshot().
+_pending_cache = (None, None)
+
+
+def _next_interval(status, previous_status, previous_interval):
+    if status == CONNECTED or previous_status in (None, CONNECTED):
+        return SESSION_HEALTH_POLL_SECONDS
+    return min(previous_interval * 2, SESSION_HEALTH_MAX_BACKOFF_SECONDS)
+
+
+# ============================================================
+# CONSULTA (un solo proceso)
+# ============================================================
+def _store(name, status, error, checked_at):
+    """
+    Escribe el estado en su propia transacción, sin tocar la de db.session.
+    UNKNOWN no cambia paused. Devuelve (SessionStatus guardado, estado
+    anterior o None).
+    """
+    table = WppSessionStatus.__table__
+    values = {"status": status, "error": error, "checked_at": checked_at}
+    if status != UNKNOWN:
+        values["paused"] = status != CONNECTED
+
+    with db.engine.begin() as conn:
+        previous = conn.execute(
+            db.select(table.c.status, table.c.paused).where(table.c.bot_session == name)
+        ).first()
+        if previous is None:
+            conn.execute(table.insert().values(bot_session=name, **{"paused": False, **values}))
+        else:
+            conn.execute(table.update().where(table.c.bot_session == name).values(**values))
+
+    was_paused = previous.paused if previous else False
+    paused = values.get("paused", was_paused)
+    if paused != was_paused:
+        if paused:
+            log.warning("⚠️ Sesión WPPConnect desconectada: envíos en pausa", session=name, status=status)
+        else:
+            log.info("✅ Sesión WPPConnect reconectada: se reanudan los envíos", session=name)
+
+    return SessionStatus(status, paused, checked_at, error), previous.status if previous else None
+
+
+def check(session_name):
+    """
+    Consulta una sesión en WPPConnect, guarda su estado en
+    wpp_session_status y lo devuelve (requiere contexto de app).
+    """
+    name = bot_sessions.normalize(session_name)
+    status, error = UNKNOWN, None
+    try:
+        status = whatsappservice.get_session_status(name) or UNKNOWN
+    except Exception as e:
+        error = repr(e)
+        log.debug("⚠️ No se pudo consultar status-session", session=name, error=error)
+
+    result, previous_status = _store(name, status, error, naive_utc(datetime.now(timezone.utc)))
+
+    with _lock:
+        previous_interval = _schedule.get(name, (SESSION_HEALTH_POLL_SECONDS, 0.0))[0]
+        interval = _next_interval(status, previous_status, previous_interval)
+        _schedule[name] = (interval, time.monotonic() + interval)
+    return result
+
+
+def poll_due():
+    """
+    Consulta las sesiones a las que les toca y devuelve los segundos hasta
+    la próxima consulta. Lo llama solo el líder del scheduler.
+    """
+    if not SESSION_HEALTH_ENABLED:
+        return float("inf")
+
+    for name in bot_sessions.names():
+        scheduled = _schedule.get(name)
+        if scheduled is None or scheduled[1] <= time.monotonic():
+            try:
+                check(name)
+            except Exception as e:
+                log.error("❌ Error vigilando la sesión", session=name, error=repr(e), exc_info=True)
+                _schedule[name] = (SESSION_HEALTH_POLL_SECONDS, time.monotonic() + SESSION_HEALTH_POLL_SECONDS)
+
+    next_check = min((scheduled[1] for scheduled in _schedule.values()), default=time.monotonic())
+    return max(1.0, next_check - time.monotonic())
+
+
+# ============================================================
+# LECTURA (cada worker)
+# ============================================================
+def refresh():
+    """
+    Lee wpp_session_status y pausa o reanuda los carriles de este proceso
+    (requiere contexto de app).
+    """
+    rows = db.session.query(
+        WppSessionStatus.bot_session,
+        WppSessionStatus.status,
+        WppSessionStatus.paused,
+        WppSessionStatus.checked_at,
+        WppSessionStatus.error,
+    ).all()
+    db.session.rollback()
+    stale_cutoff = naive_utc(datetime.now(timezone.utc)) - timedelta(seconds=SESSION_HEALTH_STALE_SECONDS)
+
+    for row in rows:
+        # Sin vigilancia reciente la pausa ya no dice nada: no retiene envíos.
+        paused = row.paused and row.checked_at >= stale_cutoff
+        _statuses[row.bot_session] = SessionStatus(row.status, paused, row.checked_at, row.error)
+
+        if row.status != UNKNOWN:
+            metrics.WPP_SESSION_CONNECTED.labels(row.bot_session).set(0 if paused else 1)
+        if paused and not bot_sessions.is_paused(row.bot_session):
+            bot_sessions.pause(row.bot_session)
+            log.debug("Carriles en pausa", session=row.bot_session, status=row.status)
+        elif not paused and bot_sessions.is_paused(row.bot_session):
+            bot_sessions.resume(row.bot_session)
+            log.debug("Carriles reanudados", session=row.bot_session, status=row.status)
+
+
+def _run(app):
+    while True:
+        try:
+            with app.app_context():
+                refresh()
+        except Exception as e:
+            log.error("❌ Error leyendo el estado de las sesiones", error=repr(e), exc_info=True)
+        time.sleep(SESSION_HEALTH_READ_SECONDS)
+
+
+def start(app):
+    """Arranca el hilo de lectura de este proceso (una vez por pid)."""
+    global _pid
+
+    if not SESSION_HEALTH_ENABLED or _pid == os.getpid():
+        return
+    with _lock:
+        if _pid != os.getpid():
+            _statuses.clear()
+            threading.Thread(target=_run, args=(app,), name="session-health", daemon=True).start()
+            _pid = os.getpid()
+
+
+def _pending_counts():
+    """outbound.open_counts() de hace a lo sumo SESSION_HEALTH_PENDING_CACHE_SECONDS."""
+    global _pending_cache
+
+    counted_at, counts = _pending_cache
+    if counted_at is not None and time.monotonic() - counted_at < SESSION_HEALTH_PENDING_CACHE_SECONDS:
+        return counts
+
+    try:
+        counts = outbound.open_counts()
+    except Exception as e:
+        db.session.rollback()
+        log.warning("⚠️ No se pudo contar outbound_messages", error=repr(e))
+        return None
+
+    _pending_cache = (time.monotonic(), counts)
+    return counts
+
+
+def snapshot():
+    """
+    Por sesión del registro: estado y pausa (última lectura de este
+    worker), contactos en cola de todos los workers y envíos pendientes en
+    BD, contados a lo sumo cada SESSION_HEALTH_PENDING_CACHE_SECONDS
+    (requiere contexto de app).
+    """
+    queued = metrics.live_totals("alestur_session_queue_depth", "session")
+    pending = _pending_counts()
+
+    result = {}
+    for name in bot_sessions.names():
+        status = _statuses.get(name)
+        result[name] = {
+            "status": status.status if status else UNKNOWN,
+            "checked_at": status.checked_at.replace(tzinfo=timezone.utc).isoformat() if status else None,
+            "error": status.error if status else None,
+            "paused": bot_sessions.is_paused(name),
+            "queued": int(queued.get(name, 0)),
+            "pending": pending.get(name, 0) if pending is not None else None,
+        }
+    return result
@@ -0,0 +1,180 @@
+"""
+Perfilador de consultas SQL por petición, con detección de N+1.
+
+Opt-in: con SQL_PROFILE=true cada petición cuenta sus consultas, el tiempo
+total en BD y cuántas veces se repite cada "forma" de sentencia (el SQL con
+parámetros, que ya no lleva los valores: la misma consulta con distinto id
+es la misma forma). Las respuestas traen los totales en cabeceras
+X-Debug-DB-* y las peticiones que superan SQL_QUERY_BUDGET se registran
+con las formas más repetidas.
+
+Sin la variable, los eventos de SQLAlchemy solo miran un ContextVar vacío.
+
+En pruebas locales o scripts, max_queries() sirve de aserción:
+
+    with sql_profiler.max_queries(8):
+        client.get("/api/crm/contacts")
+"""
+import os
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import logs
+
+
+SQL_PROFILE = os.getenv("SQL_PROFILE", "false").lower() == "true"
+SQL_QUERY_BUDGET = int(os.getenv("SQL_QUERY_BUDGET", "30"))
+
+# Una forma repetida este número de veces en la misma petición se reporta como N+1.
+N_PLUS_ONE_THRESHOLD = int(os.getenv("SQL_N_PLUS_ONE_THRESHOLD", "3"))
+
+log = logs.get_logger("sql")
+
+_SPACES = re.compile(r"\s+")
+# IN con listas de distinto largo: (?, ?, ?) / (%(id_1)s, %(id_2)s) -> (?)
+_IN_LIST = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|:\w+)\s*\)")
+_POSTCOMPILE = re.compile(r"\(__\[POSTCOMPILE_\w+\]\)")
+
+_active = ContextVar("sql_profiler_active", default=())
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def statement_shape(statement):
+    shape = _SPACES.sub(" ", statement).strip()
+    shape = _POSTCOMPILE.sub("(?)", shape)
+    return _IN_LIST.sub("(?)", shape)
+
+
+class QueryProfile:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.shapes[statement_shape(statement)] += 1
+
+    def duplicates(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """[(veces, forma)] de las formas repetidas al menos threshold veces."""
+        return [
+            (times, shape)
+            for shape, times in self.shapes.most_common()
+            if times >= threshold
+        ]
+
+    def report(self, limit=5):
+        lines = [f"consultas={self.count} tiempo_bd={self.seconds * 1000:.1f} ms"]
+        for times, shape in self.duplicates()[:limit]:
+            lines.append(f"  {times}x {shape[:300]}")
+        return "\n".join(lines)
+
+
+# ============================================================
+# EVENTOS DE SQLALCHEMY
+# ============================================================
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active.get():
+        conn.info.setdefault("sql_profiler_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    profiles = _active.get()
+    if not profiles:
+        return
+
+    started = conn.info.get("sql_profiler_started")
+    seconds = time.perf_counter() - started.pop() if started else 0.0
+
+    for profile in profiles:
+        profile.record(statement, seconds)
+
+
+@contextmanager
+def profile_queries():
+    """Registra las consultas del bloque (anidable) y entrega el QueryProfile."""
+    profile = QueryProfile()
+    token = _active.set(_active.get() + (profile,))
+    try:
+        yield profile
+    finally:
+        _active.reset(token)
+
+
+@contextmanager
+def max_queries(limit, max_duplicates=None):
+    """
+    Falla con QueryBudgetExceeded si el bloque ejecuta más de `limit`
+    consultas, o si alguna forma se repite más de `max_duplicates` veces.
+    """
+    with profile_queries() as profile:
+        yield profile
+
+    if profile.count > limit:
+        raise QueryBudgetExceeded(f"Se esperaban <= {limit} consultas: {profile.report()}")
+
+    if max_duplicates is not None:
+        worst = profile.shapes.most_common(1)
+        if worst and worst[0][1] > max_duplicates:
+            raise QueryBudgetExceeded(
+                f"Consulta repetida {worst[0][1]} veces (máx {max_duplicates}): {profile.report()}"
+            )
+
+
+# ============================================================
+# FLASK
+# ============================================================
+def _start_request():
+    g._sql_profile_cm = profile_queries()
+    g._sql_profile = g._sql_profile_cm.__enter__()
+
+
+def _finish_request(response):
+    profile = g.get("_sql_profile")
+    if profile is None:
+        return response
+
+    duplicates = profile.duplicates()
+    response.headers["X-Debug-DB-Queries"] = str(profile.count)
+    response.headers["X-Debug-DB-Time-Ms"] = f"{profile.seconds * 1000:.1f}"
+    response.headers["X-Debug-DB-Duplicates"] = str(duplicates[0][0] if duplicates else 0)
+
+    if profile.count > SQL_QUERY_BUDGET or duplicates:
+        log.warning(
+            "⚠️ Consultas sobre presupuesto o repetidas",
+            method=request.method,
+            path=request.path,
+            budget=SQL_QUERY_BUDGET,
+            queries=profile.count,
+            report=profile.report().splitlines(),
+        )
+    return response
+
+
+def _teardown_request(exc):
+    cm = g.pop("_sql_profile_cm", None)
+    if cm is not None:
+        cm.__exit__(None, None, None)
+
+
+def init_app(app, enabled=None):
+    if not (SQL_PROFILE if enabled is None else enabled):
+        return
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+    log.info("Perfilador de consultas activo", budget=SQL_QUERY_BUDGET)
@@ -0,0 +1,370 @@
+"""
+Trazas livianas del recorrido de un mensaje, exportadas en OTLP/JSON.
+
+Cada webhook abre una traza (raíz) y las etapas abren spans hijos:
+extracción, carga de usuario/sesión, cada transición, cada llamada a
+WPPConnect (con la espera por ritmo aparte), cada commit y el lead a PHP.
+Así se ve si la demora de una respuesta fue la BD, SEND_DELAY_SECONDS,
+WPPConnect o PHP.
+
+- Muestreo por traza: TRACE_SAMPLE_RATE (0 a 1). Una traza no muestreada
+  solo tiene id (para los logs y X-Trace-Id) y sus spans son un objeto
+  vacío compartido: el costo es leer un ContextVar.
+- Un traceparent W3C entrante continúa la traza del llamador, y las
+  llamadas salientes a WPPConnect y PHP llevan el traceparent propio.
+- Exportación en un hilo aparte, por lotes: TRACE_FILE agrega una línea
+  OTLP/JSON por lote (formato del receptor otlpjsonfile del collector) y
+  TRACE_COLLECTOR_URL lo envía a un collector OTLP/HTTP
+  (http://otel-collector:4318/v1/traces). Sin ninguno no se muestrea.
+  Si la cola se llena, los spans se descartan en vez de frenar la petición.
+"""
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+import requests
+from flask import make_response, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE = os.getenv("TRACE_FILE", "").strip()
+TRACE_COLLECTOR_URL = os.getenv("TRACE_COLLECTOR_URL", "").strip()
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "alestur-chatbot")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "2048"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "256"))
+TRACE_FLUSH_SECONDS = float(os.getenv("TRACE_FLUSH_SECONDS", "2"))
+
+EXPORT_ENABLED = bool(TRACE_FILE or TRACE_COLLECTOR_URL)
+
+# OTLP: SPAN_KIND_INTERNAL, SERVER, CLIENT / STATUS_CODE_ERROR
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT = 1, 2, 3
+STATUS_ERROR = 2
+
+_current_span = ContextVar("tracing_span", default=None)
+_current_trace = ContextVar("tracing_trace", default=None)
+
+
+def _new_id(bytes_count):
+    return random.getrandbits(bytes_count * 8).to_bytes(bytes_count, "big").hex()
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace_id, parent_id, name, kind=KIND_INTERNAL, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        self.error = repr(error)[:500]
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            _exporter.submit(self)
+
+
+class _NoopSpan:
+    """Span de una traza no muestreada: todo se ignora."""
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def record_error(self, error):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+# ============================================================
+# API
+# ============================================================
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace[0] if trace else None
+
+
+def traceparent():
+    """Cabecera W3C para propagar la traza a un servicio externo, o None."""
+    trace = _current_trace.get()
+    if not trace:
+        return None
+
+    span = _current_span.get()
+    span_id = span.span_id if span else _new_id(8)
+    return f"00-{trace[0]}-{span_id}-{'01' if trace[1] else '00'}"
+
+
+def inject_headers(headers):
+    """Agrega traceparent (si hay traza) a un dict de cabeceras y lo devuelve."""
+    value = traceparent()
+    if value:
+        headers["traceparent"] = value
+    return headers
+
+
+def _parse_traceparent(value):
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None, False
+    try:
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None, None, False
+    return parts[1], parts[2], sampled
+
+
+@contextmanager
+def start_trace(name, traceparent_header=None, kind=KIND_SERVER, **attributes):
+    """Abre la traza de una petición (o continúa la del traceparent entrante)."""
+    trace_id, parent_id, parent_sampled = _parse_traceparent(traceparent_header)
+    trace_id = trace_id or _new_id(16)
+
+    sampled = EXPORT_ENABLED and (parent_sampled or random.random() < TRACE_SAMPLE_RATE)
+    trace_token = _current_trace.set((trace_id, sampled))
+
+    if not sampled:
+        span_token = _current_span.set(None)
+        try:
+            yield NOOP_SPAN
+        finally:
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+        return
+
+    root = Span(trace_id, parent_id, name, kind, attributes)
+    span_token = _current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.record_error(e)
+        raise
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        root.end()
+
+
+@contextmanager
+def span(name, kind=KIND_INTERNAL, **attributes):
+    """Span hijo del actual; sin traza muestreada no registra nada."""
+    parent = _current_span.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+
+    child = Span(parent.trace_id, parent.span_id, name, kind, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+def begin_span(name, **attributes):
+    """
+    Span que se cierra desde otro callback (commits de SQLAlchemy): no pasa
+    a ser el span actual. Devuelve None fuera de una traza muestreada.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    return Span(parent.trace_id, parent.span_id, name, KIND_INTERNAL, attributes)
+
+
+@event.listens_for(OrmSession, "before_commit")
+def _before_commit(session):
+    commit_span = begin_span("db.commit")
+    if commit_span is not None:
+        session.info["tracing_commit_span"] = commit_span
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _after_commit(session):
+    commit_span = session.info.pop("tracing_commit_span", None)
+    if commit_span is not None:
+        commit_span.end()
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _after_rollback(session):
+    commit_span = session.info.pop("tracing_commit_span", None)
+    if commit_span is not None:
+        commit_span.record_error("rollback")
+        commit_span.end()
+
+
+def traced_view(name):
+    """Decorador para vistas Flask: abre la traza y responde X-Trace-Id."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with start_trace(
+                name,
+                request.headers.get("traceparent"),
+                **{"http.method": request.method, "http.route": request.url_rule.rule if request.url_rule else ""},
+            ) as root:
+                response = make_response(view(*args, **kwargs))
+                root.set_attribute("http.status_code", response.status_code)
+                response.headers["X-Trace-Id"] = current_trace_id()
+                return response
+
+        return wrapper
+    return decorator
+
+
+# ============================================================
+# EXPORTACIÓN
+# ============================================================
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(item):
+    span = {
+        "traceId": item.trace_id,
+        "spanId": item.span_id,
+        "name": item.name,
+        "kind": item.kind,
+        "startTimeUnixNano": str(item.start_ns),
+        "endTimeUnixNano": str(item.end_ns),
+        "attributes": [
+            {"key": key, "value": _otlp_value(value)}
+            for key, value in item.attributes.items()
+            if value is not None
+        ],
+    }
+    if item.parent_id:
+        span["parentSpanId"] = item.parent_id
+    if item.error:
+        span["status"] = {"code": STATUS_ERROR, "message": item.error}
+    return span
+
+
+def otlp_payload(spans):
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}},
+                {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+            ]},
+            "scopeSpans": [{
+                "scope": {"name": "alestur.tracing"},
+                "spans": [_otlp_span(item) for item in spans],
+            }],
+        }],
+    }
+
+
+class _Exporter:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def submit(self, item):
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_thread(self):
+        # Un hilo por proceso: tras el fork de gunicorn el del master no existe.
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+                threading.Thread(target=self._run, name="tracing-exporter", daemon=True).start()
+                self.pid = os.getpid()
+
+    def _drain(self, timeout):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=timeout))
+            while len(batch) < TRACE_BATCH_SIZE:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._drain(TRACE_FLUSH_SECONDS)
+            if batch:
+                self.export(batch)
+
+    def flush(self):
+        if self.pid != os.getpid():
+            return
+        while True:
+            batch = self._drain(0)
+            if not batch:
+                return
+            self.export(batch)
+
+    def export(self, batch):
+        # logs importa tracing (trace_id de cada registro): se importa aquí.
+        import logs
+
+        log = logs.get_logger("trace")
+        payload = otlp_payload(batch)
+
+        if self.dropped:
+            log.warning("⚠️ Spans descartados (cola llena)", spans=self.dropped)
+            self.dropped = 0
+
+        try:
+            if TRACE_FILE:
+                with open(TRACE_FILE, "a", encoding="utf-8") as fileobj:
+                    fileobj.write(json.dumps(payload, separators=(",", ":")) + "\n")
+
+            if TRACE_COLLECTOR_URL:
+                requests.post(TRACE_COLLECTOR_URL, json=payload, timeout=5)
+
+        except Exception as e:
+            log.error("❌ Error exportando spans", spans=len(batch), error=repr(e))
+
+
+_exporter = _Exporter()
+atexit.register(_exporter.flush)
+
+
+def flush():
+    _exporter.flush()
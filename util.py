@@ -1,4 +1,9 @@
 import os
+from urllib.parse import quote
+
+import logs
+
+log = logs.get_logger("webhook")
 
 
 PUBLIC_FILES_BASE_URL = os.getenv(
@@ -6,6 +11,24 @@ PUBLIC_FILES_BASE_URL = os.getenv(
     "https://alesturslimitadaapi.top/archivos"
 )
 
+# Copia local de los mismos archivos que nginx publica en PUBLIC_FILES_BASE_URL.
+ARCHIVOS_DIR = os.getenv(
+    "ARCHIVOS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "archivos")
+)
+
+# (archivo en archivos/, nombre con el que lo recibe el cliente)
+POLICY_DOCUMENTS = [
+    (
+        "POLÍTICA DE TRATAMIENTO DE DATOS PERSONALES - MODELO AGENCIAS DE VIAJE (3).pdf",
+        "Política de tratamiento de datos personales.pdf",
+    ),
+    (
+        "AUTORIZACIÓN DE TRATAMIENTO DE DATOS PARA LA PRESTACIÓN DE SERVICIOS DE INTERMEDIACIÓN TURÍSTICA.pdf",
+        "Autorización de tratamiento de datos.pdf",
+    ),
+]
+
 
 def GetTextUser(message):
     text = ""
@@ -23,14 +46,39 @@ def GetTextUser(message):
         elif typeInteractive == "list_reply":
             text = interactiveObject["list_reply"]["title"]
         else:
-            print("sin mensaje", flush=True)
+            log.debug("sin mensaje")
 
     else:
-        print("sin mensaje", flush=True)
+        log.debug("sin mensaje")
 
     return text
 
 
+# Tipo de Meta -> tipo de WPPConnect (media_store.MEDIA_TYPES).
+META_MEDIA_TYPES = {"image": "image", "video": "video", "audio": "audio", "document": "document", "sticker": "sticker"}
+
+
+def GetMediaUser(message):
+    """
+    Multimedia de un mensaje de Meta como el "media" de un mensaje de
+    WPPConnect ({"type", "mime_type", "filename"}) más su caption, o
+    (None, "") si no trae multimedia.
+    """
+    typeMessage = message.get("type")
+    if typeMessage not in META_MEDIA_TYPES:
+        return None, ""
+
+    mediaObject = message.get(typeMessage) or {}
+    mediaType = "ptt" if typeMessage == "audio" and mediaObject.get("voice") else META_MEDIA_TYPES[typeMessage]
+
+    media = {
+        "type": mediaType,
+        "mime_type": mediaObject.get("mime_type"),
+        "filename": mediaObject.get("filename"),
+    }
+    return media, mediaObject.get("caption") or ""
+
+
 def TextMessage(text, number):
     return {
         "messaging_product": "whatsapp",
@@ -40,8 +88,12 @@ def TextMessage(text, number):
     }
 
 
-def TextDocumentMessage(number, filename):
-    link = f"{PUBLIC_FILES_BASE_URL.rstrip('/')}/{filename}"
+def TextDocumentMessage(number, filename, display_name=None, caption="Documento adjunto"):
+    """
+    Documento de archivos/. whatsappservice.py lo envía como archivo real
+    (send-file-base64) y, si falla, como texto con el link público.
+    """
+    link = f"{PUBLIC_FILES_BASE_URL.rstrip('/')}/{quote(filename)}"
 
     return {
         "messaging_product": "whatsapp",
@@ -49,7 +101,9 @@ def TextDocumentMessage(number, filename):
         "type": "document",
         "document": {
             "link": link,
-            "caption": "Documento adjunto",
+            "caption": caption,
+            "filename": display_name or filename,
+            "path": os.path.join(ARCHIVOS_DIR, filename),
         },
     }
 
@@ -1,24 +1,40 @@
+import base64
+import hashlib
+import json
+import mimetypes
+import mmap
 import os
+import threading
 import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
 import requests
+from sqlalchemy.exc import IntegrityError
+from urllib.parse import quote
 
+import bot_sessions
+import logs
+import metrics
+import tracing
+from models import db, WppSessionPace
+from session_deadlines import naive_utc
 
-WPPCONNECT_URL = os.getenv("WPPCONNECT_URL", "http://wppconnect:21465").rstrip("/")
-DEFAULT_SESSION = os.getenv("WPPCONNECT_SESSION") or os.getenv("WPPCONNECT_DEFAULT_SESSION", "alestur_ventas")
-DEFAULT_TOKEN = os.getenv("WPPCONNECT_TOKEN", "")
 
-SEND_DELAY_SECONDS = float(os.getenv("WPPCONNECT_SEND_DELAY_SECONDS", "1.2"))
+WPPCONNECT_URL = os.getenv("WPPCONNECT_URL", "http://wppconnect:21465").rstrip("/")
+# Token y ritmo de cada sesión: bot_sessions.
+DEFAULT_SESSION = bot_sessions.DEFAULT_SESSION
 REQUEST_TIMEOUT_SECONDS = int(os.getenv("WPPCONNECT_REQUEST_TIMEOUT_SECONDS", "30"))
+STATUS_TIMEOUT_SECONDS = float(os.getenv("WPPCONNECT_STATUS_TIMEOUT_SECONDS", "5"))
+# Timeout de lectura entre bloques de una descarga, no del archivo completo.
+MEDIA_READ_TIMEOUT_SECONDS = int(os.getenv("WPPCONNECT_MEDIA_READ_TIMEOUT_SECONDS", "60"))
+# Reintentos de la reserva de turno en wpp_session_pace ante otro proceso.
+SHARED_PACE_ATTEMPTS = int(os.getenv("WPPCONNECT_SHARED_PACE_ATTEMPTS", "20"))
 
-
-def _env_key_for_session(session_name):
-    safe = "".join(ch if ch.isalnum() else "_" for ch in str(session_name).upper())
-    return f"WPPCONNECT_TOKEN_{safe}"
+log = logs.get_logger("wpp")
 
 
 def get_token(session_name=None):
-    session_name = session_name or DEFAULT_SESSION
-    return os.getenv(_env_key_for_session(session_name)) or DEFAULT_TOKEN
+    return bot_sessions.get(session_name).token
 
 
 def _headers(session_name=None):
@@ -32,9 +48,158 @@ def _headers(session_name=None):
     return headers
 
 
-def _sleep_between_messages():
-    if SEND_DELAY_SECONDS > 0:
-        time.sleep(SEND_DELAY_SECONDS)
+class _SessionPacer:
+    """
+    Mantiene el send_delay_seconds de cada sesión WPPConnect entre sus envíos.
+
+    El turno se reserva en la fila de la sesión en wpp_session_pace con un
+    UPDATE que exige el valor leído (si otro proceso tomó un turno en el
+    medio, se vuelve a leer) y se duerme fuera de la transacción. Todos los
+    procesos que envían (workers de gunicorn, sus carriles y el cron)
+    comparten así el mismo ritmo: la sesión no supera un envío cada
+    send_delay_seconds aunque haya varios workers. Los turnos se calculan
+    con el reloj de cada proceso; entre máquinas desfasadas el intervalo
+    puede acortarse en ese desfase.
+
+    Sin motor registrado (use_shared_pace), si la BD falla o si en
+    SHARED_PACE_ATTEMPTS intentos no consigue turno, el envío lo reserva en
+    memoria: ese ritmo es por proceso y, con N procesos enviando a la misma
+    sesión, el intervalo efectivo baja a send_delay_seconds / N.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_slot = {}
+        self.engine = None
+
+    def wait(self, session_name):
+        interval = bot_sessions.get(session_name).send_delay_seconds
+        if interval <= 0:
+            return
+
+        delay = None
+        if self.engine is not None:
+            try:
+                delay = self._reserve_shared(session_name, interval)
+            except Exception as e:
+                log.warning("⚠️ Ritmo compartido no disponible, se usa el del proceso", session=session_name, error=repr(e))
+
+        if delay is None:
+            delay = self._reserve_local(session_name, interval)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def _reserve_local(self, session_name, interval):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(session_name, 0.0))
+            self.next_slot[session_name] = slot + interval
+        return slot - now
+
+    def _reserve_shared(self, session_name, interval):
+        table = WppSessionPace.__table__
+        step = timedelta(seconds=interval)
+
+        for _ in range(SHARED_PACE_ATTEMPTS):
+            with self.engine.begin() as conn:
+                current = conn.execute(
+                    db.select(table.c.next_send_at).where(table.c.bot_session == session_name)
+                ).scalar()
+                now = naive_utc(datetime.now(timezone.utc))
+
+                if current is None:
+                    try:
+                        conn.execute(table.insert().values(bot_session=session_name, next_send_at=now + step))
+                    except IntegrityError:
+                        # Otro proceso creó la fila en el medio: se vuelve a leer.
+                        continue
+                    return 0.0
+
+                # Solo si nadie tomó un turno desde la lectura.
+                slot = max(now, current)
+                taken = conn.execute(
+                    table.update()
+                    .where(table.c.bot_session == session_name, table.c.next_send_at == current)
+                    .values(next_send_at=slot + step)
+                ).rowcount
+            if taken:
+                return (slot - now).total_seconds()
+
+        return None
+
+
+_pacer = _SessionPacer()
+
+
+def use_shared_pace(engine):
+    """Reserva los turnos de envío en wpp_session_pace a través de `engine`."""
+    _pacer.engine = engine
+
+
+def _sleep_between_messages(session_name=None):
+    _pacer.wait(session_name or DEFAULT_SESSION)
+
+
+EncodedFile = namedtuple("EncodedFile", ["sha256", "size", "json_value"])
+
+
+class _EncodedFileCache:
+    """
+    Archivos a enviar (los PDF de archivos/) codificados una sola vez.
+
+    El archivo se lee por mmap, sin copia intermedia; se guarda su SHA-256 y
+    el valor JSON ya serializado del campo base64 ("data:<mime>;base64,...").
+    ruta -> (mtime, tamaño, sha256) y sha256 -> EncodedFile: dos rutas con
+    el mismo contenido comparten payload, y un archivo reemplazado en disco
+    se vuelve a codificar en el siguiente envío.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_path = {}
+        self.by_hash = {}
+
+    def get(self, path):
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            entry = self.by_path.get(path)
+            if entry and entry[0] == version:
+                return self.by_hash[entry[1]]
+
+        encoded = self._encode(path)
+
+        with self.lock:
+            self.by_path[path] = (version, encoded.sha256)
+            return self.by_hash.setdefault(encoded.sha256, encoded)
+
+    @staticmethod
+    def _encode(path):
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        with open(path, "rb") as fileobj:
+            with mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                sha256 = hashlib.sha256(mapped).hexdigest()
+                size = len(mapped)
+                encoded = base64.b64encode(mapped)
+
+        # El alfabeto base64 no necesita escapes JSON: basta con las comillas.
+        json_value = b"".join([b'"data:', mime_type.encode("ascii"), b";base64,", encoded, b'"'])
+        return EncodedFile(sha256, size, json_value)
+
+
+_file_cache = _EncodedFileCache()
+
+
+def preload_files(paths):
+    """Codifica por adelantado (arranque del worker) para que el primer envío no pague."""
+    for path in paths:
+        try:
+            _file_cache.get(path)
+        except OSError as e:
+            log.warning("⚠️ No se pudo precargar archivo", path=path, error=repr(e))
 
 
 def build_wpp_phone_payload(number):
@@ -102,25 +267,111 @@ def _wpp_response_was_delivered(response):
     return True
 
 
-def _post_wpp(path, payload, session_name=None):
+def _post_wpp(path, payload, session_name=None, body=None):
+    """
+    body: cuerpo JSON ya serializado (envío de archivos); en ese caso
+    payload solo se usa para el log, sin el base64.
+    """
     session_name = session_name or DEFAULT_SESSION
     url = f"{WPPCONNECT_URL}/api/{session_name}/{path.lstrip('/')}"
 
-    print("📤 WPPConnect URL:", url, flush=True)
-    print("📤 WPPConnect payload:", payload, flush=True)
+    log.debug("📤 WPPConnect payload", path=path, session=session_name, payload=payload)
+
+    started = time.perf_counter()
+    outcome = "error"
+
+    with tracing.span(f"wpp.{path}", tracing.KIND_CLIENT, **{"wpp.session": session_name}) as wpp_span:
+        try:
+            with tracing.span("wpp.pace"):
+                _sleep_between_messages(session_name)
+
+            # Timeout fijo: un POST de envío no es idempotente y cortarlo a
+            # mitad puede duplicar el mensaje al reintentar. El presupuesto
+            # de la petición se mira antes de empezar cada envío (app.py).
+            headers = tracing.inject_headers(_headers(session_name))
+
+            if body is None:
+                response = requests.post(
+                    url,
+                    json=payload,
+                    headers=headers,
+                    timeout=REQUEST_TIMEOUT_SECONDS,
+                )
+            else:
+                response = requests.post(
+                    url,
+                    data=body,
+                    headers=headers,
+                    timeout=REQUEST_TIMEOUT_SECONDS,
+                )
+            outcome = metrics.outcome_for_status(response.status_code)
+            wpp_span.set_attribute("http.status_code", response.status_code)
+
+        finally:
+            metrics.WPP_REQUEST_SECONDS.labels(session_name, path).observe(time.perf_counter() - started)
+            metrics.WPP_REQUESTS.labels(session_name, path, outcome).inc()
+
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    if response.status_code >= 400:
+        log.warning(
+            "⚠️ WPPConnect respondió con error", path=path, session=session_name,
+            status=response.status_code, ms=elapsed_ms, response=response.text,
+        )
+    else:
+        log.info("📤 WPPConnect", path=path, session=session_name, status=response.status_code, ms=elapsed_ms)
+        log.debug("📤 WPPConnect response", path=path, session=session_name, response=response.text)
+    return response
+
+
+def get_session_status(session_name=None):
+    """
+    Estado de la sesión en WPPConnect (status-session): "CONNECTED",
+    "QRCODE", "CLOSED"... en mayúsculas, o None si la respuesta no lo trae.
+    Los errores de red se propagan (los maneja session_health).
+    """
+    session_name = session_name or DEFAULT_SESSION
+    url = f"{WPPCONNECT_URL}/api/{session_name}/status-session"
+    started = time.perf_counter()
+    outcome = "error"
+
+    try:
+        response = requests.get(url, headers=_headers(session_name), timeout=STATUS_TIMEOUT_SECONDS)
+        outcome = metrics.outcome_for_status(response.status_code)
+    finally:
+        metrics.WPP_REQUEST_SECONDS.labels(session_name, "status-session").observe(time.perf_counter() - started)
+        metrics.WPP_REQUESTS.labels(session_name, "status-session", outcome).inc()
+
+    if response.status_code >= 400:
+        log.debug("⚠️ WPPConnect status-session con error", session=session_name, status=response.status_code)
+        return None
+
+    try:
+        status = response.json().get("status")
+    except (ValueError, AttributeError):
+        return None
+    return str(status).upper() if isinstance(status, str) and status else None
+
+
+def open_media_stream(message_id, session_name=None):
+    """
+    Abre la descarga de la multimedia de un mensaje recibido sin leer el
+    cuerpo (stream=True). El llamador itera por bloques y cierra la respuesta.
+    """
+    session_name = session_name or DEFAULT_SESSION
+    url = f"{WPPCONNECT_URL}/api/{session_name}/get-media-by-message/{quote(str(message_id), safe='')}"
+
+    headers = _headers(session_name)
+    headers["Accept"] = "*/*"
 
-    _sleep_between_messages()
+    log.debug("📥 WPPConnect media", session=session_name, message_id=message_id)
 
-    response = requests.post(
+    return requests.get(
         url,
-        json=payload,
-        headers=_headers(session_name),
-        timeout=REQUEST_TIMEOUT_SECONDS,
+        headers=headers,
+        timeout=(REQUEST_TIMEOUT_SECONDS, MEDIA_READ_TIMEOUT_SECONDS),
+        stream=True,
     )
 
-    print("📤 WPPConnect response:", response.status_code, response.text, flush=True)
-    return response
-
 
 def SendMessageWhatsapp(data, session_name=None):
     """
@@ -133,7 +384,7 @@ def SendMessageWhatsapp(data, session_name=None):
         message_type = data.get("type", "text")
 
         if not number:
-            print("❌ No llegó número destino en data:", data, flush=True)
+            log.error("❌ No llegó número destino", data=data)
             return False
 
         if message_type == "text":
@@ -156,16 +407,25 @@ def SendMessageWhatsapp(data, session_name=None):
 
         if message_type == "document":
             doc = data.get("document", {})
+            path = doc.get("path")
+
+            if path and os.path.isfile(path):
+                filename = doc.get("filename") or os.path.basename(path)
+                if _send_file(number, path, filename, doc.get("caption") or "", session_name=session_name):
+                    return True
+                log.warning("⚠️ Envío de archivo falló. Enviando el link como texto.", session=session_name, filename=filename)
+                metrics.WPP_FALLBACKS.labels(session_name, "document").inc()
+
             link = doc.get("link", "")
             caption = doc.get("caption", "Documento adjunto")
             text = f"{caption}:\n{link}" if link else caption
             return _send_text(number, text, session_name=session_name, label="document-as-link")
 
-        print("⚠️ Tipo de mensaje no soportado todavía:", message_type, data, flush=True)
+        log.warning("⚠️ Tipo de mensaje no soportado todavía", message_type=message_type, data=data)
         return False
 
     except Exception as exception:
-        print("❌ Error enviando por WPPConnect:", repr(exception), flush=True)
+        log.error("❌ Error enviando por WPPConnect", session=session_name, error=repr(exception))
         return False
 
 
@@ -173,16 +433,39 @@ def _send_text(number, text, session_name=None, label="send-message"):
     payload = build_wpp_phone_payload(number)
     payload["message"] = text
 
-    print(
-        f"📞 Destino WPPConnect: {payload.get('phone')} | isLid={payload.get('isLid')}",
-        flush=True,
-    )
+    log.debug("📞 Destino WPPConnect", phone=payload.get("phone"), is_lid=payload.get("isLid"))
 
     response = _post_wpp("send-message", payload, session_name=session_name)
     delivered = _wpp_response_was_delivered(response)
 
     if not delivered:
-        print(f"⚠️ WPPConnect {label}: WhatsApp NO entregó el mensaje", flush=True)
+        log.warning("⚠️ WhatsApp NO entregó el mensaje", label=label, session=session_name or DEFAULT_SESSION)
+        metrics.WPP_UNDELIVERED.labels(session_name or DEFAULT_SESSION, "send-message").inc()
+
+    return delivered
+
+
+def _send_file(number, path, filename, caption, session_name=None):
+    """
+    Envía un archivo real por send-file-base64. El base64 sale de la caché:
+    por envío solo se serializan los campos chicos y se unen con el valor
+    ya codificado en un único bytes.
+    """
+    encoded = _file_cache.get(path)
+
+    payload = build_wpp_phone_payload(number)
+    payload.update({"filename": filename, "caption": caption})
+
+    head = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    body = b"".join([head[:-1], b', "base64": ', encoded.json_value, b"}"])
+
+    log_payload = dict(payload, file=f"<{encoded.size} bytes sha256={encoded.sha256[:12]}>")
+    response = _post_wpp("send-file-base64", log_payload, session_name=session_name, body=body)
+    delivered = _wpp_response_was_delivered(response)
+
+    if not delivered:
+        log.warning("⚠️ WhatsApp NO entregó el archivo", filename=filename, session=session_name or DEFAULT_SESSION)
+        metrics.WPP_UNDELIVERED.labels(session_name or DEFAULT_SESSION, "send-file-base64").inc()
 
     return delivered
 
@@ -256,7 +539,9 @@ def _send_interactive_list(data, number, session_name=None):
     if _wpp_response_was_delivered(response):
         return True
 
-    print("⚠️ Lista falló. Enviando fallback como texto.", flush=True)
+    log.warning("⚠️ Lista falló. Enviando fallback como texto.", session=session_name or DEFAULT_SESSION)
+    metrics.WPP_UNDELIVERED.labels(session_name or DEFAULT_SESSION, "send-list-message").inc()
+    metrics.WPP_FALLBACKS.labels(session_name or DEFAULT_SESSION, "list").inc()
     fallback_text = _interactive_to_text(data)
     return _send_text(number, fallback_text, session_name=session_name, label="fallback-list-text")
 
@@ -291,7 +576,9 @@ def _send_buttons_as_list(data, number, session_name=None):
     if _wpp_response_was_delivered(response):
         return True
 
-    print("⚠️ Botones convertidos a lista fallaron. Enviando fallback como texto.", flush=True)
+    log.warning("⚠️ Botones convertidos a lista fallaron. Enviando fallback como texto.", session=session_name or DEFAULT_SESSION)
+    metrics.WPP_UNDELIVERED.labels(session_name or DEFAULT_SESSION, "send-list-message").inc()
+    metrics.WPP_FALLBACKS.labels(session_name or DEFAULT_SESSION, "buttons").inc()
     fallback_text = _interactive_to_text(data)
     return _send_text(number, fallback_text, session_name=session_name, label="fallback-buttons-text")
 